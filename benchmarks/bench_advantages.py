@@ -0,0 +1,119 @@
+"""CPU micro-benchmark for GAE / discounted returns.
+
+Compares the vectorized `compute_gae` / `compute_cumulative_returns` in `openrlhf.models.utils`
+against the per-timestep loop they replace, for padded and packed inputs, and checks that both agree.
+
+    python benchmarks/bench_advantages.py --batch_size 64 --lengths 128,512,1024,4096
+"""
+
+import argparse
+import time
+
+import torch
+
+from openrlhf.models.utils import compute_cumulative_returns, compute_gae
+
+
+def loop_gae(values, rewards, action_mask, gamma, lambd):
+    if isinstance(values, list):
+        advantages, returns = [], []
+        for v, r in zip(values, rewards):
+            adv, ret = loop_gae(v.unsqueeze(0), r.unsqueeze(0), None, gamma, lambd)
+            advantages.append(adv.squeeze(0))
+            returns.append(ret.squeeze(0))
+        return advantages, returns
+
+    lastgaelam = 0
+    advantages_reversed = []
+    response_length = rewards.size(1)
+    if action_mask is not None:
+        values = action_mask * values
+        rewards = action_mask * rewards
+    for t in reversed(range(response_length)):
+        nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
+        delta = rewards[:, t] + gamma * nextvalues - values[:, t]
+        lastgaelam = delta + gamma * lambd * lastgaelam
+        advantages_reversed.append(lastgaelam)
+    advantages = torch.stack(advantages_reversed[::-1], dim=1)
+    return advantages, advantages + values
+
+
+def loop_cumulative_returns(rewards, action_mask, gamma):
+    if isinstance(rewards, list):
+        return [loop_cumulative_returns(r.unsqueeze(0), None, gamma).squeeze(0) for r in rewards]
+
+    returns = torch.zeros_like(rewards)
+    cumulative_return = torch.zeros(rewards.size(0), device=rewards.device)
+    if action_mask is not None:
+        rewards = action_mask * rewards
+    for t in reversed(range(rewards.size(1))):
+        cumulative_return = rewards[:, t] + gamma * cumulative_return
+        returns[:, t] = cumulative_return
+    return returns
+
+
+def timeit(fn, repeat):
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def max_error(a, b):
+    if isinstance(a, list):
+        return max(max_error(x, y) for x, y in zip(a, b))
+    return (a - b).abs().max().item()
+
+
+def make_inputs(batch_size, length, packed):
+    lengths = torch.randint(1, length + 1, (batch_size,)).tolist()
+    if packed:
+        values = [torch.randn(l) for l in lengths]
+        rewards = [torch.randn(l) * 0.01 for l in lengths]
+        return values, rewards, None
+    values = torch.randn(batch_size, length)
+    rewards = torch.randn(batch_size, length) * 0.01
+    action_mask = torch.arange(length).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)
+    return values, rewards, action_mask
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    header = f"{'mode':<8}{'length':>8}{'loop gae(ms)':>14}{'vec gae(ms)':>13}{'speedup':>9}"
+    header += f"{'loop ret(ms)':>14}{'vec ret(ms)':>13}{'speedup':>9}{'max err':>11}"
+    print(header)
+    for packed in (False, True):
+        for length in map(int, args.lengths.split(",")):
+            values, rewards, action_mask = make_inputs(args.batch_size, length, packed)
+
+            ref = loop_gae(values, rewards, action_mask, args.gamma, args.lambd)
+            out = compute_gae(values, rewards, action_mask, args.gamma, args.lambd)
+            err = max(max_error(ref[0], out[0]), max_error(ref[1], out[1]))
+            ref = loop_cumulative_returns(rewards, action_mask, args.gamma)
+            out = compute_cumulative_returns(rewards, action_mask, args.gamma)
+            err = max(err, max_error(ref, out))
+            assert err < args.atol, f"vectorized result differs from loop by {err}"
+
+            t_loop_gae = timeit(lambda: loop_gae(values, rewards, action_mask, args.gamma, args.lambd), args.repeat)
+            t_vec_gae = timeit(lambda: compute_gae(values, rewards, action_mask, args.gamma, args.lambd), args.repeat)
+            t_loop_ret = timeit(lambda: loop_cumulative_returns(rewards, action_mask, args.gamma), args.repeat)
+            t_vec_ret = timeit(lambda: compute_cumulative_returns(rewards, action_mask, args.gamma), args.repeat)
+            print(
+                f"{'packed' if packed else 'padded':<8}{length:>8}"
+                f"{t_loop_gae * 1e3:>14.2f}{t_vec_gae * 1e3:>13.2f}{t_loop_gae / t_vec_gae:>8.1f}x"
+                f"{t_loop_ret * 1e3:>14.2f}{t_vec_ret * 1e3:>13.2f}{t_loop_ret / t_vec_ret:>8.1f}x"
+                f"{err:>11.2e}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--lengths", type=str, default="128,512,1024,4096", help="comma separated max lengths")
+    parser.add_argument("--gamma", type=float, default=1.0)
+    parser.add_argument("--lambd", type=float, default=0.95)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-3)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
@@ -0,0 +1,128 @@
+"""CPU equivalence check and micro-benchmark for chunked log-prob computation.
+
+Compares `log_probs_from_hidden_states` in `openrlhf.models.utils` against applying the LM head to the
+whole sequence, upcasting the logits to float32 and calling `log_probs_from_logits` (the path
+`Actor.forward` takes without `--logprobs_chunk_size`). Checks that log probs and gradients match, then
+reports forward + backward time, the bytes kept alive for backward and the peak RSS growth of each.
+
+    python benchmarks/bench_logprobs.py --seq_len 2048 --vocab_size 32000 --chunk_size 256,1024
+"""
+
+import argparse
+import gc
+import time
+
+import torch
+import torch.nn as nn
+
+from openrlhf.models.utils import log_probs_from_hidden_states, log_probs_from_logits
+
+
+def full_log_probs(hidden_states, lm_head, labels, chunk_size=None):
+    logits = lm_head(hidden_states).to(torch.float32)
+    return log_probs_from_logits(logits, labels)
+
+
+def chunked_log_probs(hidden_states, lm_head, labels, chunk_size):
+    return log_probs_from_hidden_states(hidden_states, lm_head, labels, chunk_size)
+
+
+def forward_backward(fn, hidden_states, lm_head, labels, chunk_size):
+    hidden_states = hidden_states.detach().requires_grad_()
+    lm_head.zero_grad(set_to_none=True)
+    log_probs = fn(hidden_states, lm_head, labels, chunk_size)
+    log_probs.sum().backward()
+    return log_probs.detach(), hidden_states.grad, lm_head.weight.grad
+
+
+def saved_bytes(fn, hidden_states, lm_head, labels, chunk_size):
+    """Bytes of the tensors autograd keeps alive between forward and backward."""
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    hidden_states = hidden_states.detach().requires_grad_()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn(hidden_states, lm_head, labels, chunk_size)
+    storages.pop(lm_head.weight.untyped_storage().data_ptr(), None)
+    storages.pop(hidden_states.untyped_storage().data_ptr(), None)
+    return sum(storages.values())
+
+
+def _proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+
+def peak_rss_growth(fn, *args):
+    """Peak resident memory growth of fn(*args) in bytes, or None where /proc is unavailable (Linux only)."""
+    gc.collect()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # reset VmHWM to the current RSS
+        baseline = _proc_status("VmRSS:")
+        fn(*args)
+        return _proc_status("VmHWM:") - baseline
+    except OSError:
+        fn(*args)
+        return None
+
+
+def timeit(fn, repeat, *args):
+    fn(*args)  # warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def fmt_mb(nbytes):
+    return "n/a" if nbytes is None else f"{nbytes / 2**20:.1f}"
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    dtype = getattr(torch, args.dtype)
+    lm_head = nn.Linear(args.hidden_size, args.vocab_size, bias=False).to(dtype)
+    hidden_states = torch.randn(args.batch_size, args.seq_len, args.hidden_size, dtype=dtype)
+    labels = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len))
+    atol, rtol = (1e-5, 1e-3) if dtype == torch.float32 else (5e-2, 2e-2)
+
+    ref = forward_backward(full_log_probs, hidden_states, lm_head, labels, None)
+    with torch.no_grad():
+        for chunk_size in map(int, args.chunk_size.split(",")):
+            out = chunked_log_probs(hidden_states, lm_head, labels, chunk_size)
+            assert torch.allclose(out, ref[0], atol=atol, rtol=rtol), "no_grad log probs mismatch"
+
+    print(f"{'path':<14}{'fwd+bwd(ms)':>13}{'saved(MB)':>11}{'peak RSS(MB)':>14}{'max err':>10}")
+    runs = [("full", full_log_probs, None)]
+    runs += [(f"chunk={c}", chunked_log_probs, int(c)) for c in args.chunk_size.split(",")]
+    for name, fn, chunk_size in runs:
+        out = forward_backward(fn, hidden_states, lm_head, labels, chunk_size)
+        err = max((a.float() - b.float()).abs().max().item() for a, b in zip(out, ref))
+        for a, b in zip(out, ref):
+            assert torch.allclose(a.float(), b.float(), atol=atol, rtol=rtol), f"{name} mismatch"
+
+        run_args = (fn, hidden_states, lm_head, labels, chunk_size)
+        elapsed = timeit(forward_backward, args.repeat, *run_args)
+        saved = saved_bytes(*run_args)
+        peak = peak_rss_growth(forward_backward, *run_args)
+        print(f"{name:<14}{elapsed * 1e3:>13.1f}{fmt_mb(saved):>11}{fmt_mb(peak):>14}{err:>10.1e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    parser.add_argument("--chunk_size", type=str, default="128,512", help="comma separated chunk sizes")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
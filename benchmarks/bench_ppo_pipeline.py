@@ -0,0 +1,392 @@
+"""CPU benchmark of the PPO experience and training data path with stub models.
+
+Drives the host-side stages of a PPO step on synthetic variable-length rollouts: building padded or
+packed samples, `make_experience` (tiny stub actor, reference, critic and reward models), reward shaping
+in `process_experiences`, `compute_reward` + advantages, `NaiveReplayBuffer.append`, `normalize` and
+collating the micro-batches of every training epoch. Model compute is kept negligible, so the timings
+are dominated by the padding, packing and bookkeeping overheads that regress silently.
+
+It also reports the bytes a Ray step sends to the reference, critic and reward models as plain tensors
+and in the compact wire format (`ppo_utils.wire`), with the time to encode and decode them.
+
+Results are written as JSON, and a previous result can be passed with `--compare` to flag stages that
+got slower, e.g. between two commits:
+
+    python benchmarks/bench_ppo_pipeline.py --output base.json
+    python benchmarks/bench_ppo_pipeline.py --compare base.json --tolerance 0.1
+"""
+
+import argparse
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+from argparse import Namespace
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+
+from openrlhf.models.utils import PackedSeqInfo, compute_approx_kl, log_probs_from_logits, unpacking_samples
+from openrlhf.trainer.ppo_utils import FixedKLController, LengthGroupedBatchSampler, NaiveReplayBuffer
+from openrlhf.trainer.ppo_utils.experience_maker import Experience, NaiveExperienceMaker, Samples
+from openrlhf.trainer.ppo_utils.wire import CRITIC_LOSSY_KEYS, decode_batch, encode_model_inputs, nbytes
+
+STAGES = ["samples", "make_experience", "process_experiences", "advantages", "buffer_append", "normalize", "collate"]
+# reference, critic and reward model, the remote models a Ray PPO step sends every micro-batch to
+NUM_REMOTE_MODELS = 3
+
+
+class StubModel(nn.Module):
+    """
+    Tiny stand-in for the actor, reference, critic and reward models with their call signatures and
+    output shapes. Packed inputs go through `PackedSeqInfo` like the real models.
+    """
+
+    def __init__(self, kind, vocab_size, hidden_size):
+        super().__init__()
+        self.kind = kind
+        self.embed = nn.Embedding(vocab_size, hidden_size)
+        self.head = nn.Linear(hidden_size, vocab_size if kind == "actor" else 1)
+
+    def forward(self, sequences, num_actions=None, attention_mask=None, packed_seq_lens=None, visual_inputs=None):
+        output = self.head(self.embed(sequences)).float()
+        if self.kind == "actor":
+            output = log_probs_from_logits(output[:, :-1], sequences[:, 1:])
+        else:
+            output = output[:, :-1, 0]
+        if packed_seq_lens is None:
+            return output[:, -num_actions:]
+        packed_seq_info = PackedSeqInfo.build(packed_seq_lens, num_actions, total_len=sequences.numel())
+        return packed_seq_info.gather_actions(output)
+
+
+class StubRewardModel(StubModel):
+    def __init__(self, vocab_size, hidden_size):
+        super().__init__("reward", vocab_size, hidden_size)
+
+    def forward(self, sequences, attention_mask=None, packed_seq_lens=None, visual_inputs=None):
+        # reward of the last token of every sample
+        output = self.head(self.embed(sequences)).float()
+        if packed_seq_lens is None:
+            return output[:, -1, 0]
+        ends = torch.tensor(packed_seq_lens).cumsum(0) - 1
+        return output[0, ends, 0]
+
+
+class PackedStubExperienceMaker(NaiveExperienceMaker):
+    """make_experience for packed samples, as RemoteExperienceMaker computes it once the remote results are in."""
+
+    packing_samples = True
+
+    @torch.no_grad()
+    def make_experience(self, samples: Samples) -> Experience:
+        sequences, num_actions, packed_seq_lens = samples.sequences, samples.num_actions, samples.packed_seq_lens
+        action_log_probs = self.actor(sequences, num_actions, samples.attention_mask, packed_seq_lens=packed_seq_lens)
+        base_action_log_probs = self.initial_model(
+            sequences, num_actions, samples.attention_mask, packed_seq_lens=packed_seq_lens
+        )
+        value = self.critic(sequences, num_actions, samples.attention_mask, packed_seq_lens=packed_seq_lens)
+        r = self.reward_model(sequences, samples.attention_mask, packed_seq_lens=packed_seq_lens)
+        kl = compute_approx_kl(action_log_probs, base_action_log_probs, action_mask=None)
+
+        kl = unpacking_samples(kl, num_actions)
+        info = {
+            "kl": torch.tensor([each_kl.mean() for each_kl in kl]),
+            "reward": r,
+            "response_length": samples.response_length,
+            "total_length": samples.total_length,
+            "num_actions": num_actions,
+        }
+        return Experience(
+            unpacking_samples(sequences, packed_seq_lens),
+            unpacking_samples(action_log_probs, num_actions),
+            unpacking_samples(value, num_actions),
+            None,
+            None,
+            None,
+            None,
+            info,
+            kl,
+        )
+
+
+class LocalStrategy:
+    def __init__(self, args):
+        self.args = args
+
+    def all_reduce(self, data, op="mean"):
+        return data
+
+    def is_rank_0(self):
+        # keeps the tqdm bars of make_experiences quiet
+        return False
+
+
+def sample_lengths(args, num, mean, generator):
+    if args.length_dist == "fixed":
+        lengths = torch.full((num,), float(mean))
+    elif args.length_dist == "uniform":
+        lengths = torch.rand(num, generator=generator) * 2 * mean
+    else:
+        # long-tailed like real rollouts: a few responses are many times longer than the median
+        sigma = args.lognormal_sigma
+        lengths = torch.empty(num).log_normal_(math.log(mean) - sigma**2 / 2, sigma, generator=generator)
+    return lengths.long().clamp(1, 4 * mean).tolist()
+
+
+def make_rollout(args, generator):
+    """Prompt and response lengths of a rollout, samples of the same prompt share the prompt length."""
+    prompt_lens = sample_lengths(args, args.num_prompts, args.prompt_len, generator)
+    prompt_lens = [length for length in prompt_lens for _ in range(args.n_samples_per_prompt)]
+    response_lens = sample_lengths(args, len(prompt_lens), args.response_len, generator)
+    return prompt_lens, response_lens
+
+
+def make_samples(prompt_lens, response_lens, packed, vocab_size, generator):
+    """Samples in the layout the vLLM generation path produces."""
+    batch_size = len(prompt_lens)
+    prompt_lens, response_lens = torch.tensor(prompt_lens), torch.tensor(response_lens)
+    common = dict(
+        response_length=response_lens.float(),
+        total_length=(prompt_lens + response_lens).float(),
+        prompts=[""] * batch_size,
+        visual_inputs=None,
+    )
+    if packed:
+        packed_seq_lens = (prompt_lens + response_lens).tolist()
+        sequences = torch.randint(0, vocab_size, (1, sum(packed_seq_lens)), generator=generator)
+        attention_mask = torch.arange(1, batch_size + 1).repeat_interleave(prompt_lens + response_lens).unsqueeze(0)
+        return Samples(
+            sequences=sequences,
+            attention_mask=attention_mask,
+            action_mask=None,
+            num_actions=response_lens.tolist(),
+            packed_seq_lens=packed_seq_lens,
+            **common,
+        )
+
+    prompt_width, response_width = int(prompt_lens.max()), int(response_lens.max())
+    prompt_mask = torch.arange(prompt_width) >= prompt_width - prompt_lens.unsqueeze(1)
+    action_mask = torch.arange(response_width) < response_lens.unsqueeze(1)
+    attention_mask = torch.cat([prompt_mask, action_mask], dim=1).long()
+    sequences = torch.randint(0, vocab_size, attention_mask.shape, generator=generator) * attention_mask
+    return Samples(
+        sequences=sequences,
+        attention_mask=attention_mask,
+        action_mask=action_mask,
+        num_actions=response_width,
+        packed_seq_lens=None,
+        **common,
+    )
+
+
+def run_step(args, packed, rollout, models, timings):
+    """
+    One PPO step of the data path, the time of every stage is appended to timings. Returns the number of
+    tokens of the step and the bytes RemoteExperienceMaker would send to the other Ray actors.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    strategy = LocalStrategy(
+        Namespace(
+            advantage_estimator=args.advantage_estimator,
+            n_samples_per_prompt=args.n_samples_per_prompt,
+            use_kl_estimator_k3=False,
+            reward_clip_range=(-10, 10),
+        )
+    )
+    maker_cls = PackedStubExperienceMaker if packed else NaiveExperienceMaker
+    maker = maker_cls(*models, None, None, 1024, FixedKLController(0.01), strategy)
+    generate_kwargs = {"gamma": 1.0, "lambd": 0.95}
+
+    def timed(stage, fn, *fn_args):
+        start = time.perf_counter()
+        result = fn(*fn_args)
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    prompt_lens, response_lens = rollout
+    batch = args.micro_rollout_batch_size
+
+    def build_samples():
+        return [
+            make_samples(prompt_lens[i : i + batch], response_lens[i : i + batch], packed, args.vocab_size, generator)
+            for i in range(0, len(prompt_lens), batch)
+        ]
+
+    samples_list = timed("samples", build_samples)
+    experiences = timed("make_experience", maker.make_experiences, samples_list)
+    experiences, rewards = timed("process_experiences", maker.process_experiences, experiences)
+    experiences = timed(
+        "advantages", lambda: maker.compute_advantages_and_returns(experiences, rewards, "cpu", **generate_kwargs)
+    )
+
+    def encode_wire():
+        # the model inputs of every micro-batch and the experiences appended to the critic's buffer
+        batches = [encode_model_inputs(samples.sequences, samples.attention_mask) for samples in samples_list]
+        return batches + [experience.to_wire(CRITIC_LOSSY_KEYS) for experience in experiences]
+
+    batches = timed("wire_encode", encode_wire)
+    timed("wire_decode", lambda: [decode_batch(batch) for batch in batches])
+    raw_bytes = sum(nbytes([samples.sequences, samples.attention_mask]) for samples in samples_list)
+    raw_bytes = raw_bytes * NUM_REMOTE_MODELS + sum(nbytes(experience.__dict__) for experience in experiences)
+    wire_bytes = {"raw_mb": raw_bytes / 2**20, "sent_mb": sum(batch.nbytes for batch in batches) / 2**20}
+
+    buffer = NaiveReplayBuffer(args.micro_train_batch_size, packing_samples=packed)
+    timed("buffer_append", lambda: [buffer.append(experience) for experience in experiences])
+    timed("normalize", buffer.normalize, "advantages", strategy)
+
+    def collate():
+        sampler = LengthGroupedBatchSampler(
+            buffer.sequence_lengths(),
+            args.micro_train_batch_size,
+            group_by_length=args.group_by_length,
+            packing_samples=packed,
+            seed=args.seed,
+        )
+        for epoch in range(args.max_epochs):
+            sampler.set_epoch(epoch)
+            for indices in sampler:
+                buffer.collate_fn(indices)
+
+    timed("collate", collate)
+    return sum(prompt_lens) + sum(response_lens), wire_bytes
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except Exception:
+        return None
+
+
+def summarize(timings, num_tokens, wire_bytes):
+    result = {}
+    for stage in STAGES + ["wire_encode", "wire_decode"]:
+        times = sorted(timings[stage])
+        result[stage] = {"min_ms": times[0] * 1e3, "median_ms": times[len(times) // 2] * 1e3}
+    total = sum(result[stage]["min_ms"] for stage in STAGES)
+    result["total"] = {"min_ms": total, "median_ms": sum(result[stage]["median_ms"] for stage in STAGES)}
+    result["tokens_per_s"] = num_tokens / (total / 1e3)
+    # the compact wire format replaces the serialization of the raw tensors, it is not part of the total
+    result["wire"] = wire_bytes
+    return result
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """
+    Print the change of every stage against baseline, returns the stages that got slower by more than
+    tolerance and min_delta_ms, the latter keeps sub-millisecond stages from flagging timer noise.
+    """
+    ignored = {"output", "compare", "tolerance", "min_delta_ms"}
+    changed = [k for k, v in results["config"].items() if k not in ignored and baseline["config"].get(k) != v]
+    if changed:
+        print(f"[Warning] the baseline was run with a different config: {', '.join(changed)}")
+    regressions = []
+    print(f"\n{'mode':<8}{'stage':<22}{'base(ms)':>10}{'new(ms)':>10}{'change':>9}")
+    for mode, stages in results["results"].items():
+        if mode not in baseline["results"]:
+            continue
+        for stage in STAGES + ["total"]:
+            if stage not in baseline["results"][mode]:
+                continue
+            old, new = baseline["results"][mode][stage]["min_ms"], stages[stage]["min_ms"]
+            change = new / max(old, 1e-9) - 1
+            flag = ""
+            if change > tolerance and new - old > min_delta_ms:
+                regressions.append(f"{mode}/{stage}")
+                flag = "  <-- regression"
+            print(f"{mode:<8}{stage:<22}{old:>10.2f}{new:>10.2f}{change:>+8.1%}{flag}")
+    return regressions
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    generator = torch.Generator().manual_seed(args.seed)
+    rollout = make_rollout(args, generator)
+    models = [
+        StubModel("actor", args.vocab_size, args.hidden_size),
+        StubModel("critic", args.vocab_size, args.hidden_size),
+        StubRewardModel(args.vocab_size, args.hidden_size),
+        StubModel("actor", args.vocab_size, args.hidden_size),
+    ]
+    modes = {"off": [False], "on": [True], "both": [False, True]}[args.packing]
+
+    results = {
+        "config": vars(args),
+        "env": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "commit": git_commit(),
+        },
+        "results": {},
+    }
+    num_samples = len(rollout[0])
+    print(f"{num_samples} samples, {sum(rollout[0]) + sum(rollout[1])} tokens per step")
+    print(f"{'mode':<8}" + "".join(f"{stage[:12]:>13}" for stage in STAGES) + f"{'total(ms)':>11}")
+    for packed in modes:
+        timings = defaultdict(list)
+        for _ in range(args.warmup):
+            run_step(args, packed, rollout, models, defaultdict(list))
+        for _ in range(args.repeat):
+            num_tokens, wire_bytes = run_step(args, packed, rollout, models, timings)
+        mode = "packed" if packed else "padded"
+        results["results"][mode] = summarize(timings, num_tokens, wire_bytes)
+        stages = results["results"][mode]
+        row = "".join(f"{stages[stage]['min_ms']:>13.2f}" for stage in STAGES)
+        print(f"{mode:<8}{row}{stages['total']['min_ms']:>11.2f}")
+
+    print(f"\n{'mode':<8}{'raw(MB)':>10}{'wire(MB)':>10}{'encode(ms)':>12}{'decode(ms)':>12}")
+    for mode, stages in results["results"].items():
+        wire = stages["wire"]
+        print(
+            f"{mode:<8}{wire['raw_mb']:>10.2f}{wire['sent_mb']:>10.2f}"
+            f"{stages['wire_encode']['min_ms']:>12.2f}{stages['wire_decode']['min_ms']:>12.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_prompts", type=int, default=32)
+    parser.add_argument("--n_samples_per_prompt", type=int, default=4)
+    parser.add_argument("--micro_rollout_batch_size", type=int, default=16)
+    parser.add_argument("--micro_train_batch_size", type=int, default=8)
+    parser.add_argument("--max_epochs", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=256, help="mean prompt length")
+    parser.add_argument("--response_len", type=int, default=512, help="mean response length")
+    parser.add_argument("--length_dist", type=str, default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--lognormal_sigma", type=float, default=0.8)
+    parser.add_argument("--packing", type=str, default="both", choices=["off", "on", "both"])
+    parser.add_argument("--group_by_length", action="store_true", default=False)
+    parser.add_argument(
+        "--advantage_estimator", type=str, default="gae", choices=["gae", "reinforce", "rloo", "reinforce_baseline"]
+    )
+    parser.add_argument("--vocab_size", type=int, default=32, help="stub model vocabulary, kept small on purpose")
+    parser.add_argument("--hidden_size", type=int, default=8)
+    parser.add_argument("--num_threads", type=int, default=1, help="torch threads, 1 keeps timings stable")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=str, default=None, help="write the results as JSON")
+    parser.add_argument("--compare", type=str, default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+    parser.add_argument("--min_delta_ms", type=float, default=0.5, help="smallest absolute slowdown reported")
+    main(parser.parse_args())
@@ -0,0 +1,164 @@
+"""CPU micro-benchmark for the replay buffer.
+
+Compares append + normalize + iterate throughput of `NaiveReplayBuffer` in
+`openrlhf.trainer.ppo_utils.replay_buffer` against the `NaiveReplayBuffer` of a git revision,
+e.g. the commit before a change to the buffer, for padded and packed experiences, and checks that
+both collate identical batches. Batches are built as the DataLoader builds them.
+
+    python benchmarks/bench_replay_buffer.py --baseline_ref <commit> --num_experiences 32 --batch_size 16
+"""
+
+import argparse
+import importlib.util
+import random
+import subprocess
+import time
+from unittest import mock
+
+import torch
+
+import openrlhf.trainer.ppo_utils.replay_buffer as replay_buffer
+from openrlhf.trainer.ppo_utils.experience_maker import Experience
+from openrlhf.trainer.ppo_utils.replay_buffer import ACTION_KEYS, SEQUENCE_KEYS
+
+KEYS = SEQUENCE_KEYS + ACTION_KEYS
+
+
+def load_baseline(ref):
+    """The replay_buffer module at git revision `ref`, imported next to the current one."""
+    source = subprocess.check_output(["git", "show", f"{ref}:openrlhf/trainer/ppo_utils/replay_buffer.py"])
+    name = "openrlhf.trainer.ppo_utils._baseline_replay_buffer"
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(name, loader=None))
+    module.__package__ = "openrlhf.trainer.ppo_utils"
+    exec(compile(source, f"{ref}:replay_buffer.py", "exec"), module.__dict__)
+    return module
+
+
+def make_buffer(module, batch_size, packed):
+    if torch.cuda.is_available():
+        return module.NaiveReplayBuffer(batch_size, packing_samples=packed)
+    # older buffers pick their CUDA target device in __init__
+    with mock.patch("torch.cuda.current_device", return_value=0):
+        return module.NaiveReplayBuffer(batch_size, packing_samples=packed)
+
+
+def collate(buffer, batch):
+    # a DataLoader fetches the items of the batch from buffers that are datasets, and collates their indices otherwise
+    if hasattr(buffer, "__getitem__"):
+        return buffer.collate_fn([buffer[i] for i in batch])
+    return buffer.collate_fn(batch)
+
+
+def make_experience(batch_size, max_len, packed):
+    prompt_lens = torch.randint(1, max_len // 2 + 1, (batch_size,))
+    response_lens = torch.randint(1, max_len // 2 + 1, (batch_size,))
+    info = {
+        "kl": torch.randn(batch_size),
+        "reward": torch.randn(batch_size),
+        "response_length": response_lens.float(),
+        "total_length": (prompt_lens + response_lens).float(),
+    }
+    if packed:
+        sequences = [torch.randint(0, 32000, (p + r,)) for p, r in zip(prompt_lens, response_lens)]
+        action_fields = {key: [torch.randn(r) for r in response_lens] for key in ACTION_KEYS if key != "action_mask"}
+        return Experience(sequences=sequences, attention_mask=None, action_mask=None, info=info, **action_fields)
+
+    prompt_width, response_width = int(prompt_lens.max()), int(response_lens.max())
+    sequences = torch.randint(0, 32000, (batch_size, prompt_width + response_width))
+    prompt_mask = torch.arange(prompt_width) >= prompt_width - prompt_lens.unsqueeze(1)
+    action_mask = torch.arange(response_width) < response_lens.unsqueeze(1)
+    attention_mask = torch.cat([prompt_mask, action_mask], dim=1).long()
+    action_fields = {
+        key: torch.randn(batch_size, response_width) * action_mask for key in ACTION_KEYS if key != "action_mask"
+    }
+    return Experience(
+        sequences=sequences * attention_mask,
+        attention_mask=attention_mask,
+        action_mask=action_mask,
+        info=info,
+        **action_fields,
+    )
+
+
+class LocalStrategy:
+    def all_reduce(self, data, op="mean"):
+        return data
+
+
+def run(buffer, experiences, batches):
+    for experience in experiences:
+        buffer.append(experience)
+    buffer.normalize("advantages", LocalStrategy())
+    for batch in batches:
+        collate(buffer, batch)
+
+
+def check_equal(ref, out, batches, atol):
+    def equal(x, y):
+        if x is None or y is None:
+            return x is None and y is None
+        if isinstance(x, list):
+            return len(x) == len(y) and all(equal(u, v) for u, v in zip(x, y))
+        return x.shape == y.shape and torch.allclose(x.float(), y.float(), atol=atol)
+
+    for batch in batches:
+        a, b = collate(ref, batch), collate(out, batch)
+        for key in KEYS:
+            assert equal(getattr(a, key), getattr(b, key)), key
+        for key in a.info.keys():
+            assert torch.allclose(a.info[key].float(), b.info[key].float()), key
+
+
+def main(args):
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    baseline = load_baseline(args.baseline_ref)
+    print(f"{'mode':<8}{'samples':>9}{'baseline(ms)':>14}{'current(ms)':>13}{'speedup':>9}")
+    for packed in (False, True):
+        num_samples = args.num_experiences * args.micro_rollout_batch_size
+        indices = list(range(num_samples))
+        random.shuffle(indices)
+        batches = [indices[i : i + args.batch_size] for i in range(0, num_samples, args.batch_size)]
+
+        def make_experiences():
+            # buffers may keep views of the appended tensors, every run gets its own copies
+            generator_state = torch.get_rng_state()
+            torch.manual_seed(args.seed)
+            experiences = [
+                make_experience(args.micro_rollout_batch_size, args.max_len, packed)
+                for _ in range(args.num_experiences)
+            ]
+            torch.set_rng_state(generator_state)
+            return experiences
+
+        ref, out = make_buffer(baseline, args.batch_size, packed), make_buffer(replay_buffer, args.batch_size, packed)
+        run(ref, make_experiences(), [])
+        run(out, make_experiences(), [])
+        check_equal(ref, out, batches, args.atol)
+
+        timings = []
+        for module in (baseline, replay_buffer):
+            best = float("inf")
+            for _ in range(args.repeat):
+                buffer, experiences = make_buffer(module, args.batch_size, packed), make_experiences()
+                start = time.perf_counter()
+                run(buffer, experiences, batches)
+                best = min(best, time.perf_counter() - start)
+            timings.append(best)
+        print(
+            f"{'packed' if packed else 'padded':<8}{num_samples:>9}"
+            f"{timings[0] * 1e3:>14.1f}{timings[1] * 1e3:>13.1f}{timings[0] / timings[1]:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline_ref", type=str, default="HEAD", help="git revision of the baseline buffer")
+    parser.add_argument("--num_experiences", type=int, default=32)
+    parser.add_argument("--micro_rollout_batch_size", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=16, help="micro train batch size")
+    parser.add_argument("--max_len", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=5, help="best of this many runs is reported")
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
@@ -30,6 +30,7 @@ def train(args):
         target_modules=args.target_modules,
         lora_dropout=args.lora_dropout,
         ds_config=strategy.get_ds_train_config(is_actor=True),
+        logprobs_chunk_size=args.logprobs_chunk_size,
     )
 
     if args.actor_init_on_gpu:
@@ -88,6 +89,7 @@ def train(args):
             bf16=args.bf16,
             load_in_4bit=args.load_in_4bit,
             ds_config=strategy.get_ds_eval_config(offload=False),
+            logprobs_chunk_size=args.logprobs_chunk_size,
         )
 
     if args.enable_ema:
@@ -157,7 +159,11 @@ def train(args):
 
     # prepare dataloader
     prompts_dataloader = strategy.setup_dataloader(
-        prompts_dataset, args.rollout_batch_size // strategy.world_size, True, True
+        prompts_dataset,
+        args.rollout_batch_size // strategy.world_size,
+        True,
+        True,
+        collate_fn=prompts_dataset.collate_fn,
     )
     if args.pretrain_data:
         pretrain_dataloader = itertools.cycle(
@@ -317,6 +323,24 @@ if __name__ == "__main__":
     parser.add_argument("--lambd", type=float, default=0.95, help="PPO GAE lambd")
     parser.add_argument("--gamma", type=float, default=1, help="PPO GAE gamma")
     parser.add_argument("--micro_train_batch_size", type=int, default=4, help="batch size per GPU")
+    parser.add_argument(
+        "--train_group_by_length",
+        action="store_true",
+        default=False,
+        help="Group training micro-batches by sequence length to reduce padding",
+    )
+    parser.add_argument(
+        "--train_max_tokens_per_batch",
+        type=int,
+        default=None,
+        help="Fill training micro-batches up to this many (padded) tokens instead of micro_train_batch_size",
+    )
+    parser.add_argument(
+        "--disable_replay_prefetch",
+        action="store_true",
+        default=False,
+        help="Copy training micro-batches to the GPU synchronously instead of one step ahead",
+    )
     parser.add_argument("--train_batch_size", type=int, default=128, help="Global training batch size")
     parser.add_argument("--normalize_reward", action="store_true", default=False, help="Enable Reward Normazation")
     parser.add_argument("--top_p", type=float, default=1.0)
@@ -359,7 +383,31 @@ if __name__ == "__main__":
     parser.add_argument("--overlap_comm", action="store_true", default=False)
     parser.add_argument("--gradient_checkpointing_use_reentrant", action="store_true", default=False)
     parser.add_argument("--disable_fast_tokenizer", action="store_true", default=False)
+    parser.add_argument(
+        "--logprobs_chunk_size",
+        type=int,
+        default=0,
+        help="Compute action log probs over chunks of this many tokens to bound logits memory, 0 to disable. "
+        "Slower than the full logits, only worth it when the float32 logits of a micro batch reach about 1GB; "
+        "use 1024 or more",
+    )
     parser.add_argument("--train_vlm", action="store_true", default=False)
+    parser.add_argument(
+        "--vision_cache_size_mb",
+        type=int,
+        default=0,
+        help="Memory budget of the cache of decoded images and pixel_values for VLM rollouts, 0 to disable",
+    )
+    parser.add_argument(
+        "--vision_cache_dir", type=str, default=None, help="Directory to also store the vision cache on disk"
+    )
+    parser.add_argument(
+        "--cache_vision_embeds",
+        action="store_true",
+        default=False,
+        help="Encode the images once per rollout with the actor's vision tower and reuse the embeddings in the "
+        "actor and reference forwards, requires the vision tower to be frozen with --freeze_prefix",
+    )
     parser.add_argument("--freeze_prefix", type=str, nargs="+", default=None,
         help="List of parameter name prefixes to freeze during training"
     )
@@ -410,6 +458,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--apply_chat_template", action="store_true", default=False, help="Use HF tokenizer chat template"
     )
+    parser.add_argument(
+        "--pretokenize_prompts",
+        action="store_true",
+        default=False,
+        help="Tokenize the prompts once when loading the dataset instead of on every rollout",
+    )
+    parser.add_argument(
+        "--prompt_cache_dir", type=str, default=None, help="Directory to cache the pre-tokenized prompts in"
+    )
 
     # wandb parameters
     parser.add_argument("--use_wandb", type=str, default=None)
@@ -424,6 +481,12 @@ if __name__ == "__main__":
 
     # TensorBoard parameters
     parser.add_argument("--use_tensorboard", type=str, default=None, help="TensorBoard logging path")
+    parser.add_argument(
+        "--trace_dir",
+        type=str,
+        default=None,
+        help="Directory for a Chrome trace of the spans of every training step, span times are also logged",
+    )
 
     # ModelScope parameters
     parser.add_argument("--use_ms", action="store_true", default=False)
@@ -450,6 +513,11 @@ if __name__ == "__main__":
             "[Warning] input_template contains \\n chracters instead of newline. "
             "You likely want to pass $'\\n' in Bash or \"`n\" in PowerShell."
         )
+
+    if args.logprobs_chunk_size > 0 and args.aux_loss_coef > 1e-8:
+        print("[Warning] --logprobs_chunk_size does not return the MoE aux loss. We will set it to 0")
+        args.logprobs_chunk_size = 0
+
     if args.train_vlm: 
         if args.packing_samples:
             print("[Warning] --train_vlm is not supported with --packing_samples. We will set args.packing_samples to False")
@@ -457,6 +525,18 @@ if __name__ == "__main__":
         if args.pretrain_data:
             print("[Warning] --train_vlm is not supported with --pretrain_data. We will set args.pretrain_data to None")
             args.pretrain_data = None
+        if args.pretokenize_prompts:
+            print("[Warning] --train_vlm is not supported with --pretokenize_prompts. We will set it to False")
+            args.pretokenize_prompts = False
+        if args.cache_vision_embeds and not args.freeze_prefix:
+            print(
+                "[Warning] --cache_vision_embeds requires a frozen vision tower (--freeze_prefix). "
+                "We will set it to False"
+            )
+            args.cache_vision_embeds = False
+    elif args.cache_vision_embeds:
+        print("[Warning] --cache_vision_embeds is only supported with --train_vlm. We will set it to False")
+        args.cache_vision_embeds = False
 
     if args.use_ms:
         from modelscope.utils.hf_util import patch_hub
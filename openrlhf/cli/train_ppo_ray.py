@@ -91,6 +91,10 @@ def train(args):
             pg if args.colocate_all_models else None,
             args.vllm_gpu_memory_utilization,
             args.vllm_enable_sleep,
+            args.vllm_async_engine,
+            args.lora_rank,
+            args.vllm_prefix_routing,
+            trace=bool(args.trace_dir),
         )
 
     actor_model = PPORayActorGroup(
@@ -230,7 +234,22 @@ if __name__ == "__main__":
     )
     parser.add_argument("--vllm_sync_backend", type=str, default="nccl", help="DeepSpeed -> vLLM weight sync backend")
     parser.add_argument("--vllm_sync_with_ray", action="store_true", default=False)
+    parser.add_argument(
+        "--vllm_sync_bucket_size_mb",
+        type=int,
+        default=256,
+        help="Max size of a flattened weight bucket sent to vLLM in one round-trip",
+    )
     parser.add_argument("--enable_prefix_caching", action="store_true", default=False)
+    parser.add_argument(
+        "--vllm_prefix_routing",
+        action="store_true",
+        default=False,
+        help="Route prompts to vLLM engines by prefix for prefix cache reuse, balanced by estimated token load",
+    )
+    parser.add_argument(
+        "--vllm_routing_prefix_len", type=int, default=128, help="Number of leading prompt tokens used for routing"
+    )
     parser.add_argument("--enforce_eager", action="store_true", default=False, help="Disable CUDA graph in vLLM")
     parser.add_argument(
         "--vllm_enable_sleep",
@@ -238,6 +257,12 @@ if __name__ == "__main__":
         default=False,
         help="Enable sleep mode for vLLM when using --colocate_all_models",
     )
+    parser.add_argument(
+        "--vllm_async_engine",
+        action="store_true",
+        default=False,
+        help="Use vLLM's async engine and make experiences from responses as soon as they finish",
+    )
     parser.add_argument(
         "--vllm_gpu_memory_utilization",
         type=float,
@@ -271,6 +296,14 @@ if __name__ == "__main__":
     parser.add_argument("--overlap_comm", action="store_true", default=False)
     parser.add_argument("--gradient_checkpointing_use_reentrant", action="store_true", default=False)
     parser.add_argument("--disable_fast_tokenizer", action="store_true", default=False)
+    parser.add_argument(
+        "--logprobs_chunk_size",
+        type=int,
+        default=0,
+        help="Compute action log probs over chunks of this many tokens to bound logits memory, 0 to disable. "
+        "Slower than the full logits, only worth it when the float32 logits of a micro batch reach about 1GB; "
+        "use 1024 or more",
+    )
 
     # packing samples using Flash Attention2
     parser.add_argument("--packing_samples", action="store_true", default=False)
@@ -287,6 +320,12 @@ if __name__ == "__main__":
     parser.add_argument("--num_episodes", type=int, default=1)
     parser.add_argument("--rollout_batch_size", type=int, default=1024)
     parser.add_argument("--micro_rollout_batch_size", type=int, default=8)
+    parser.add_argument(
+        "--experience_pipeline_depth",
+        type=int,
+        default=1,
+        help="Number of micro-batches with reference/critic/reward requests in flight while making experiences",
+    )
     parser.add_argument("--max_epochs", type=int, default=1)
     parser.add_argument("--prompt_max_len", type=int, default=1024, help="Max tokens for each prompt")
     parser.add_argument("--generate_max_len", type=int, default=1024, help="Max tokens to generate in PPO")
@@ -300,6 +339,30 @@ if __name__ == "__main__":
     parser.add_argument("--lambd", type=float, default=0.95, help="PPO GAE lambd")
     parser.add_argument("--gamma", type=float, default=1, help="PPO GAE gamma")
     parser.add_argument("--micro_train_batch_size", type=int, default=4, help="batch size per GPU")
+    parser.add_argument(
+        "--train_group_by_length",
+        action="store_true",
+        default=False,
+        help="Group training micro-batches by sequence length to reduce padding",
+    )
+    parser.add_argument(
+        "--train_max_tokens_per_batch",
+        type=int,
+        default=None,
+        help="Fill training micro-batches up to this many (padded) tokens instead of micro_train_batch_size",
+    )
+    parser.add_argument(
+        "--disable_replay_prefetch",
+        action="store_true",
+        default=False,
+        help="Copy training micro-batches to the GPU synchronously instead of one step ahead",
+    )
+    parser.add_argument(
+        "--disable_compact_wire",
+        action="store_true",
+        default=False,
+        help="Send experiences and model inputs to the critic, reference and reward models as plain tensors",
+    )
     parser.add_argument("--train_batch_size", type=int, default=128, help="Global training batch size")
     parser.add_argument("--normalize_reward", action="store_true", default=False, help="Enable Reward Normazation")
     parser.add_argument("--top_p", type=float, default=1.0)
@@ -328,6 +391,22 @@ if __name__ == "__main__":
     parser.add_argument("--adam_betas", type=float, nargs=2, default=(0.9, 0.95), help="Betas for Adam optimizer")
     parser.add_argument("--reward_clip_range", type=float, nargs=2, default=(-10, 10), help="Reward clip range")
     parser.add_argument("--train_vlm", action="store_true", default=False)
+    parser.add_argument(
+        "--vision_cache_size_mb",
+        type=int,
+        default=0,
+        help="Memory budget of the cache of decoded images and pixel_values for VLM rollouts, 0 to disable",
+    )
+    parser.add_argument(
+        "--vision_cache_dir", type=str, default=None, help="Directory to also store the vision cache on disk"
+    )
+    parser.add_argument(
+        "--cache_vision_embeds",
+        action="store_true",
+        default=False,
+        help="Encode the images once per rollout with the actor's vision tower and reuse the embeddings in the "
+        "actor and reference forwards, requires the vision tower to be frozen with --freeze_prefix",
+    )
     parser.add_argument("--freeze_prefix", type=str, nargs="+", default=None,
         help="List of parameter name prefixes to freeze during training"
     )
@@ -346,6 +425,23 @@ if __name__ == "__main__":
     parser.add_argument("--pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--reward_pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--remote_rm_url", type=str, default=None, help="remote RM API (HTTP)")
+    parser.add_argument(
+        "--remote_rm_batch_size",
+        type=int,
+        default=0,
+        help="coalesce remote RM requests across micro-batches up to this many queries, 0 to disable",
+    )
+    parser.add_argument(
+        "--remote_rm_max_concurrency", type=int, default=8, help="max in-flight requests per remote RM url"
+    )
+    parser.add_argument("--remote_rm_timeout", type=float, default=180, help="remote RM request timeout (s)")
+    parser.add_argument("--remote_rm_max_retries", type=int, default=5, help="remote RM request attempts")
+    parser.add_argument(
+        "--remote_rm_hedge_delay",
+        type=float,
+        default=None,
+        help="send a duplicate remote RM request if the first one takes longer than this (s)",
+    )
     parser.add_argument("--critic_pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--value_head_prefix", type=str, default="score")
     parser.add_argument("--ref_reward_offload", action="store_true", default=False)
@@ -373,6 +469,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--apply_chat_template", action="store_true", default=False, help="Use HF tokenizer chat template"
     )
+    parser.add_argument(
+        "--pretokenize_prompts",
+        action="store_true",
+        default=False,
+        help="Tokenize the prompts once when loading the dataset instead of on every rollout",
+    )
+    parser.add_argument(
+        "--prompt_cache_dir", type=str, default=None, help="Directory to cache the pre-tokenized prompts in"
+    )
 
     # wandb parameters
     parser.add_argument("--use_wandb", type=str, default=None)
@@ -387,6 +492,12 @@ if __name__ == "__main__":
 
     # TensorBoard parameters
     parser.add_argument("--use_tensorboard", type=str, default=None, help="TensorBoard logging path")
+    parser.add_argument(
+        "--trace_dir",
+        type=str,
+        default=None,
+        help="Directory for a Chrome trace of the spans of every training step, span times are also logged",
+    )
 
     # performance tuning
     parser.add_argument("--perf", action="store_true", default=False)
@@ -420,6 +531,10 @@ if __name__ == "__main__":
             "You likely want to pass $'\\n' in Bash or \"`n\" in PowerShell."
         )
 
+    if args.logprobs_chunk_size > 0 and args.aux_loss_coef > 1e-8:
+        print("[Warning] --logprobs_chunk_size does not return the MoE aux loss. We will set it to 0")
+        args.logprobs_chunk_size = 0
+
     if args.train_vlm: 
         if args.packing_samples:
             print("[Warning] --train_vlm is not supported with --packing_samples. We will set args.packing_samples to False")
@@ -427,6 +542,18 @@ if __name__ == "__main__":
         if args.pretrain_data:
             print("[Warning] --train_vlm is not supported with --pretrain_data. We will set args.pretrain_data to None")
             args.pretrain_data = None
+        if args.pretokenize_prompts:
+            print("[Warning] --train_vlm is not supported with --pretokenize_prompts. We will set it to False")
+            args.pretokenize_prompts = False
+        if args.cache_vision_embeds and not args.freeze_prefix:
+            print(
+                "[Warning] --cache_vision_embeds requires a frozen vision tower (--freeze_prefix). "
+                "We will set it to False"
+            )
+            args.cache_vision_embeds = False
+    elif args.cache_vision_embeds:
+        print("[Warning] --cache_vision_embeds is only supported with --train_vlm. We will set it to False")
+        args.cache_vision_embeds = False
 
     if args.packing_samples:
         if not args.flash_attn:
@@ -439,6 +566,10 @@ if __name__ == "__main__":
         print("Set args.vllm_enable_sleep to False when args.colocate_all_models is disabled.")
         args.vllm_enable_sleep = False
 
+    if args.vllm_async_engine and args.vllm_enable_sleep:
+        print("Set args.vllm_enable_sleep to False, --vllm_async_engine keeps vLLM generating while experiences are made.")
+        args.vllm_enable_sleep = False
+
     if args.use_ms:
         from modelscope.utils.hf_util import patch_hub
 
@@ -1,3 +1,9 @@
+import hashlib
+import json
+import os
+import shutil
+
+from datasets import load_from_disk
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
@@ -23,6 +29,7 @@ class PromptDataset(Dataset):
         dataset: dataset for PPO model
         tokenizer: tokenizer for PPO model
         max_length: max length of input
+        num_processors: number of processes to pre-tokenize prompts with (--pretokenize_prompts)
     """
 
     def __init__(
@@ -31,6 +38,7 @@ class PromptDataset(Dataset):
         tokenizer,
         strategy,
         input_template=None,
+        num_processors=8,
     ) -> None:
         super().__init__()
         self.strategy = strategy
@@ -38,20 +46,96 @@ class PromptDataset(Dataset):
 
         # chat_template
         self.input_template = input_template
-        input_key = getattr(self.strategy.args, "input_key", None)
-        apply_chat_template = getattr(self.strategy.args, "apply_chat_template", False)
+        self.input_key = getattr(self.strategy.args, "input_key", None)
+        self.apply_chat_template = getattr(self.strategy.args, "apply_chat_template", False)
+
+        if self.apply_chat_template:
+            self.apply_chat_template = self.tokenizer.apply_chat_template
 
-        if apply_chat_template:
-            apply_chat_template = self.tokenizer.apply_chat_template
+        # token ids of the prompts, tokenized once instead of on every rollout
+        self.prompt_token_ids = None
+        if getattr(self.strategy.args, "pretokenize_prompts", False):
+            self.max_length = getattr(self.strategy.args, "prompt_max_len", None)
+            processed_dataset = self._tokenize_dataset(
+                dataset, getattr(self.strategy.args, "prompt_cache_dir", None), num_processors
+            )
+            self.prompts = processed_dataset["prompt"]
+            self.prompt_token_ids = processed_dataset.remove_columns("prompt")
+            return
 
         self.prompts = []
         for data in tqdm(dataset, desc="Preprocessing data", disable=not self.strategy.is_rank_0()):
-            prompt = preprocess_data(data, input_template, input_key, apply_chat_template)
+            prompt = preprocess_data(data, input_template, self.input_key, self.apply_chat_template)
             self.prompts.append(prompt)
 
+    def process_data(self, batch):
+        rows = [dict(zip(batch.keys(), values)) for values in zip(*batch.values())]
+        prompts = [
+            preprocess_data(data, self.input_template, self.input_key, self.apply_chat_template) for data in rows
+        ]
+        # same arguments as the experience maker's tokenize_fn
+        input_ids = self.tokenizer(
+            prompts,
+            add_special_tokens=False,
+            max_length=self.max_length,
+            truncation=True,
+        )["input_ids"]
+        return {"prompt": prompts, "input_ids": input_ids}
+
+    def _cache_key(self, dataset):
+        """Hash of everything the token ids depend on: the data, the tokenizer and the prompt template."""
+        key = hashlib.sha256()
+        key.update(str(getattr(dataset, "_fingerprint", None)).encode())
+        key.update(json.dumps(sorted(self.tokenizer.get_vocab().items())).encode())
+        meta = [
+            self.tokenizer.name_or_path,
+            self.tokenizer.chat_template if self.apply_chat_template else None,
+            self.input_template,
+            self.input_key,
+            self.max_length,
+        ]
+        key.update(json.dumps(meta, default=str).encode())
+        return key.hexdigest()[:16]
+
+    def _tokenize_dataset(self, dataset, cache_dir, num_processors):
+        cache_path = None
+        if cache_dir:
+            cache_path = os.path.join(cache_dir, f"prompts_{self._cache_key(dataset)}")
+            if os.path.exists(cache_path):
+                self.strategy.print(f"Loading pre-tokenized prompts from {cache_path}")
+                return load_from_disk(cache_path)
+
+        processed_dataset = dataset.map(
+            self.process_data,
+            batched=True,
+            remove_columns=dataset.column_names,
+            num_proc=num_processors,
+            desc="Tokenizing prompts",
+        )
+
+        if cache_path and self.strategy.is_rank_0():
+            # write to a temporary directory first so that no reader sees a partial cache
+            tmp_path = f"{cache_path}.tmp{os.getpid()}"
+            processed_dataset.save_to_disk(tmp_path)
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            self.strategy.print(f"Saved pre-tokenized prompts to {cache_path}")
+        return processed_dataset
+
     def __len__(self):
         length = len(self.prompts)
         return length
 
     def __getitem__(self, idx):
+        if self.prompt_token_ids is not None:
+            return self.prompts[idx], self.prompt_token_ids[idx]["input_ids"]
         return self.prompts[idx]
+
+    def collate_fn(self, item_list):
+        """Return the prompts and their token ids, or None when the prompts are not pre-tokenized."""
+        if self.prompt_token_ids is None:
+            return item_list, None
+        prompts, prompt_token_ids = zip(*item_list)
+        return list(prompts), list(prompt_token_ids)
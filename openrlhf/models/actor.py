@@ -9,7 +9,13 @@ from transformers import BitsAndBytesConfig, AutoConfig
 from transformers.integrations.deepspeed import HfDeepSpeedConfig
 
 from .ring_attn_utils import convert_ring_attn_params
-from .utils import log_probs_from_logits, reset_position_ids
+from .utils import (
+    PackedSeqInfo,
+    expand_shared_images,
+    log_probs_from_hidden_states,
+    log_probs_from_logits,
+    reset_position_ids,
+)
 from ..utils.utils import get_generation_cls
 
 
@@ -31,6 +37,10 @@ class Actor(nn.Module):
         ds_config (dict, optional): Configuration for DeepSpeed, enabling model partitioning across multiple GPUs. Defaults to None.
         device_map (dict, optional): Device mapping for loading the model onto specific devices. Defaults to None.
         packing_samples (bool, optional): Whether to pack samples during training. Defaults to False.
+        logprobs_chunk_size (int, optional): Compute action log probs from the decoder's final hidden states
+            over chunks of this many tokens instead of from the full logits. 0 disables chunking. Chunking
+            trades time for memory and only pays off once the float32 logits of a micro batch reach about a
+            gigabyte (e.g. 2k tokens with a 150k vocabulary); use chunks of 1024 tokens or more. Defaults to 0.
     """
 
     def __init__(
@@ -46,9 +56,11 @@ class Actor(nn.Module):
         ds_config=None,
         device_map=None,
         packing_samples=False,
+        logprobs_chunk_size=0,
         **kwargs,
     ) -> None:
         super().__init__()
+        self.logprobs_chunk_size = logprobs_chunk_size
 
         if isinstance(pretrain_or_model, str):
             attn_implementation = "flash_attention_2" if use_flash_attention_2 else "eager"
@@ -197,48 +209,106 @@ class Actor(nn.Module):
         """Returns action log probs"""
         if visual_inputs is None:
             visual_inputs = {}
+        visual_inputs = dict(expand_shared_images(visual_inputs))
+        chunked = num_actions is not None and self.logprobs_chunk_size > 0
+        image_embeds = visual_inputs.pop("image_embeds", None)
+        if chunked and image_embeds is None and visual_inputs.get("pixel_values") is not None:
+            # the decoder is called without the vision tower below, so the images are encoded here
+            image_embeds = self._encode_pixels(visual_inputs)
+        inputs_embeds = None
+        if image_embeds is not None:
+            # the vision tower is skipped, the model gets the embedded sequences with the images in place
+            visual_inputs.pop("pixel_values", None)
+            inputs_embeds = self._embed_with_images(sequences, image_embeds)
+        packed_seq_info = None
         if not self.packing_samples:
             # https://github.com/OpenRLHF/OpenRLHF/issues/217
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
         else:
+            if packed_seq_lens is not None:
+                packed_seq_info = PackedSeqInfo.build(
+                    packed_seq_lens, num_actions, total_len=sequences.numel(), device=sequences.device
+                )
             # convert attention_mask to position_ids
             if ring_attn_group is not None:
                 sequences, attention_mask, position_ids = convert_ring_attn_params(
-                    sequences, attention_mask, packed_seq_lens, ring_attn_group
+                    sequences, attention_mask, packed_seq_info, ring_attn_group
                 )
+                if inputs_embeds is not None:
+                    # embedded before slicing, so that every image lands in the slice of its tokens
+                    local_len = sequences.size(1)
+                    start = dist.get_rank(group=ring_attn_group) * local_len
+                    inputs_embeds = inputs_embeds[:, start : start + local_len]
+            elif packed_seq_info is not None:
+                position_ids = packed_seq_info.position_ids
             else:
                 position_ids = reset_position_ids(attention_mask)
             # explicitly ignore attention_mask for packing_samples
             attention_mask = None
 
-        output = self.model(sequences, attention_mask=attention_mask, position_ids=position_ids, **visual_inputs)
-        # https://github.com/OpenRLHF/OpenRLHF/pull/634
-        output["logits"] = output["logits"].to(torch.float32)
+        model_inputs = {"input_ids": sequences} if inputs_embeds is None else {"inputs_embeds": inputs_embeds}
+        if chunked:
+            # the decoder returns the final hidden states without the LM head, which is applied chunk by chunk
+            output = self.model.get_decoder()(attention_mask=attention_mask, position_ids=position_ids, **model_inputs)
+            hidden_states = output["last_hidden_state"]
+            log_probs = log_probs_from_hidden_states(
+                hidden_states[:, :-1, :], self.model.get_output_embeddings(), sequences[:, 1:], self.logprobs_chunk_size
+            )
+        else:
+            output = self.model(
+                attention_mask=attention_mask, position_ids=position_ids, **model_inputs, **visual_inputs
+            )
+            # https://github.com/OpenRLHF/OpenRLHF/pull/634
+            output["logits"] = output["logits"].to(torch.float32)
 
-        if num_actions is None:
-            assert return_output
-            return output
+            if num_actions is None:
+                assert return_output
+                return output
 
-        log_probs = log_probs_from_logits(output["logits"][:, :-1, :], sequences[:, 1:])
+            log_probs = log_probs_from_logits(output["logits"][:, :-1, :], sequences[:, 1:])
 
         if not self.packing_samples:
             action_log_probs = log_probs[:, -num_actions:]
         else:
             assert isinstance(num_actions, list) and len(num_actions) == len(packed_seq_lens)
-            action_log_probs = []
-            offset = 0
-            for num_action, seq_len in zip(num_actions, packed_seq_lens):
-                start, end = max(0, offset + seq_len - num_action - 1), offset + seq_len - 1
-                action_log_probs.append(log_probs[:, start:end])
-                offset += seq_len
-            action_log_probs = torch.cat(action_log_probs, dim=1)
+            action_log_probs = packed_seq_info.gather_actions(log_probs)
 
         if return_output:
             return (action_log_probs, output)
         else:
             return action_log_probs
 
+    def _embed_with_images(self, sequences: torch.LongTensor, image_embeds: torch.Tensor) -> torch.Tensor:
+        """Embed sequences and put the precomputed image_embeds in place of the image tokens, as the model does."""
+        inputs_embeds = self.model.get_input_embeddings()(sequences)
+        image_mask = sequences == self.model.config.image_token_id
+        num_image_tokens = image_mask.sum().item()
+        if num_image_tokens != image_embeds.size(0):
+            raise ValueError(
+                f"Image features and image tokens do not match: tokens: {num_image_tokens}, "
+                f"features {image_embeds.size(0)}"
+            )
+        image_mask = image_mask.unsqueeze(-1).expand_as(inputs_embeds)
+        image_embeds = image_embeds.to(inputs_embeds.device, inputs_embeds.dtype)
+        return inputs_embeds.masked_scatter(image_mask, image_embeds)
+
+    @torch.no_grad()
+    def encode_images(self, visual_inputs: dict) -> dict:
+        """
+        Run the vision tower once and add its output to visual_inputs as image_embeds, which forward
+        feeds to the language model instead of encoding pixel_values again. Only valid while the vision
+        tower is frozen (--freeze_prefix).
+        """
+        if not visual_inputs or visual_inputs.get("pixel_values") is None:
+            return visual_inputs
+        return {**visual_inputs, "image_embeds": self._encode_pixels(visual_inputs)}
+
+    def _encode_pixels(self, visual_inputs: dict) -> torch.Tensor:
+        visual = self.model.visual
+        pixel_values = visual_inputs["pixel_values"].type(visual.dtype)
+        return visual(pixel_values, grid_thw=visual_inputs["image_grid_thw"])
+
     def gradient_checkpointing_enable(self, gradient_checkpointing_kwargs={"use_reentrant": False}):
         self.model.gradient_checkpointing_enable(gradient_checkpointing_kwargs=gradient_checkpointing_kwargs)
 
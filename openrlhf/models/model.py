@@ -12,7 +12,7 @@ from transformers.integrations.deepspeed import HfDeepSpeedConfig
 from openrlhf.utils.logging_utils import init_logger
 
 from .ring_attn_utils import convert_ring_attn_params
-from .utils import reset_position_ids
+from .utils import PackedSeqInfo, expand_shared_images, reset_position_ids
 from ..utils.utils import get_generation_cls
 
 logger = init_logger(__name__)
@@ -194,16 +194,22 @@ def _get_reward_model(base_llm_model, value_head_prefix="score", packing_samples
                 position_ids = attention_mask.long().cumsum(-1) - 1
                 position_ids.masked_fill_(attention_mask == 0, 1)
             else:
+                packed_seq_info = PackedSeqInfo.build(
+                    packed_seq_lens, total_len=input_ids.numel(), device=input_ids.device
+                )
                 # convert attention_mask to position_ids
                 if ring_attn_group is not None:
                     input_ids, attention_mask, position_ids = convert_ring_attn_params(
-                        input_ids, attention_mask, packed_seq_lens, ring_attn_group
+                        input_ids, attention_mask, packed_seq_info, ring_attn_group
                     )
                 else:
-                    position_ids = reset_position_ids(attention_mask)
+                    position_ids = packed_seq_info.position_ids
                 # explicitly ignore attention_mask for packing_samples
                 attention_mask = None
 
+            visual_inputs = expand_shared_images(visual_inputs)
+            # image_embeds come from the actor's vision tower, this model encodes the images itself
+            visual_inputs = {k: v for k, v in visual_inputs.items() if k != "image_embeds"}
             outputs = super().forward(
                 input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,output_hidden_states=True, **visual_inputs
             )
@@ -220,10 +226,7 @@ def _get_reward_model(base_llm_model, value_head_prefix="score", packing_samples
                     reward = all_gather(values, ring_attn_group).reshape(1, -1)
                 else:
                     reward = values
-                # TODO: convert packed_seq_lens into torch tensor in advance
-                packed_seq_lens = torch.tensor(packed_seq_lens, device=values.device)
-                eos_indices = packed_seq_lens.cumsum(dim=0) - 1
-                reward = reward.squeeze(0).gather(dim=0, index=eos_indices)
+                reward = reward.squeeze(0).gather(dim=0, index=packed_seq_info.eos_indices)
             else:
                 eos_indices = attention_mask.size(1) - 1 - attention_mask.long().fliplr().argmax(dim=1, keepdim=True)
                 reward = values.gather(dim=1, index=eos_indices).squeeze(1)
@@ -273,10 +276,19 @@ def _get_critic_model(base_llm_model, value_head_prefix="score", packing_samples
                 position_ids.masked_fill_(attention_mask == 0, 1)
             else:
                 # convert attention_mask to position_ids
-                position_ids = reset_position_ids(attention_mask)
+                if packed_seq_lens is not None:
+                    packed_seq_info = PackedSeqInfo.build(
+                        packed_seq_lens, num_actions, total_len=input_ids.numel(), device=input_ids.device
+                    )
+                    position_ids = packed_seq_info.position_ids
+                else:
+                    position_ids = reset_position_ids(attention_mask)
                 # explicitly ignore attention_mask for packing_samples
                 attention_mask = None
 
+            visual_inputs = expand_shared_images(visual_inputs)
+            # image_embeds come from the actor's vision tower, this model encodes the images itself
+            visual_inputs = {k: v for k, v in visual_inputs.items() if k != "image_embeds"}
             outputs = super().forward(
                 input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,output_hidden_states=True, **visual_inputs
             )
@@ -300,13 +312,7 @@ def _get_critic_model(base_llm_model, value_head_prefix="score", packing_samples
                 action_values = values[:, -num_actions:]
             else:
                 assert isinstance(num_actions, list) and len(num_actions) == len(packed_seq_lens)
-                action_values = []
-                offset = 0
-                for num_action, seq_len in zip(num_actions, packed_seq_lens):
-                    start, end = max(0, offset + seq_len - num_action - 1), offset + seq_len - 1
-                    action_values.append(values[:, start:end])
-                    offset += seq_len
-                action_values = torch.cat(action_values, dim=1)
+                action_values = packed_seq_info.gather_actions(values)
 
             if return_output:
                 return (action_values, outputs)
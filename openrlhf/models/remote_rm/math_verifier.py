@@ -1,18 +1,31 @@
+import asyncio
 import json
 import os
+import pickle
+import queue
 import random
 import re
+import threading
+import time
 from argparse import ArgumentParser
-from multiprocessing import Process, Queue
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+from multiprocessing import Pipe, Pool, Process
+from multiprocessing.connection import wait
 
 import Levenshtein
-from flask import Flask, jsonify, request
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from latex2sympy2_extended import NormalizationConfig
 from math_verify import LatexExtractionConfig, parse, verify
 
-app = Flask(__name__)
+app = FastAPI()
 
 problem_to_answer = {}
+# gold answer -> parsed gold answer, filled once at startup and inherited by the forked workers
+answer_to_gold_parsed = {}
 
 
 def get_response_from_query(q: str):
@@ -39,91 +52,413 @@ def verify_format(content):
 
 
 
+def normalize_problem(problem):
+    return " ".join(problem.lower().split())
+
+
+class ProblemIndex:
+    """Nearest-problem lookup for prompts that are not exact keys of `problem_to_answer`.
+
+    Lookups go through two tiers: an exact match on the normalized problem, then a character
+    trigram inverted index whose best `shortlist_size` candidates are re-ranked by
+    `Levenshtein.ratio`. Only when no candidate shares a trigram do we fall back to a linear scan.
+
+    Args:
+        problems (list): Problems to index.
+        shortlist_size (int): Number of candidates re-ranked with Levenshtein.
+        max_df (float): Trigrams that occur in more than this fraction of problems are not indexed.
+    """
+
+    def __init__(self, problems, shortlist_size=32, max_df=0.1):
+        self.problems = list(problems)
+        self.shortlist_size = shortlist_size
+        self.stats = {"lookups": 0, "exact": 0, "index": 0, "fallback": 0}
+
+        self.normalized_to_id = {}
+        self.num_trigrams = array("I")
+        postings = {}
+        for i, problem in enumerate(self.problems):
+            normalized = normalize_problem(problem)
+            self.normalized_to_id.setdefault(normalized, i)
+            grams = self._trigrams(normalized)
+            self.num_trigrams.append(len(grams))
+            for gram in grams:
+                ids = postings.get(gram)
+                if ids is None:
+                    ids = postings[gram] = array("I")
+                ids.append(i)
+        max_postings = max(1, int(max_df * len(self.problems)))
+        self.postings = {gram: ids for gram, ids in postings.items() if len(ids) <= max_postings}
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i : i + 3] for i in range(max(1, len(text) - 2))}
+
+    def lookup(self, problem):
+        self.stats["lookups"] += 1
+        normalized = normalize_problem(problem)
+        i = self.normalized_to_id.get(normalized)
+        if i is not None:
+            self.stats["exact"] += 1
+            return self.problems[i]
+
+        grams = self._trigrams(normalized)
+        overlaps = Counter()
+        for gram in grams:
+            overlaps.update(self.postings.get(gram, ()))
+        if overlaps:
+            self.stats["index"] += 1
+            # rank by trigram jaccard, then re-rank the shortlist with the exact edit ratio
+            jaccard = {i: n / (len(grams) + self.num_trigrams[i] - n) for i, n in overlaps.items()}
+            shortlist = sorted(jaccard, key=jaccard.get, reverse=True)[: self.shortlist_size]
+            candidates = [self.problems[i] for i in shortlist]
+        else:
+            self.stats["fallback"] += 1
+            candidates = self.problems
+        return max(candidates, key=lambda p: Levenshtein.ratio(problem, p))
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["fallback_rate"] = stats["fallback"] / stats["lookups"] if stats["lookups"] > 0 else 0.0
+        return stats
+
+    def save(self, path):
+        state = {k: v for k, v in self.__dict__.items() if k != "stats"}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with open(path, "rb") as f:
+            index.__dict__.update(pickle.load(f))
+        index.stats = {"lookups": 0, "exact": 0, "index": 0, "fallback": 0}
+        return index
+
+
 def find_similar_problem(problem):
-    max_sim = -1
-    target_problem = None
-    for p in problem_to_answer.keys():
-        sim = Levenshtein.ratio(problem, p)
-        if sim > max_sim:
-            max_sim = sim
-            target_problem = p
-    return target_problem
+    return problem_index.lookup(problem)
 
 
-def verify_math(input_queue, output_queue):
-    while True:
-        content, sol = input_queue.get()
-        gold_parsed = parse(
-            sol,
+def parse_gold(sol):
+    return parse(
+        sol,
+        extraction_mode="first_match",
+        extraction_config=[LatexExtractionConfig()],
+    )
+
+
+def verify_math(content, sol):
+    gold_parsed = answer_to_gold_parsed.get(sol)
+    if gold_parsed is None:
+        gold_parsed = parse_gold(sol)
+    if len(gold_parsed) != 0:
+        # We require the answer to be provided in correct latex (no malformed operators)
+        answer_parsed = parse(
+            content,
+            extraction_config=[
+                LatexExtractionConfig(
+                    normalization_config=NormalizationConfig(
+                        nits=False,
+                        malformed_operators=False,
+                        basic_latex=True,
+                        equations=True,
+                        boxed=True,
+                        units=True,
+                    ),
+                    # Ensures that boxed is tried first
+                    boxed_match_priority=0,
+                    try_extract_without_anchor=False,
+                )
+            ],
             extraction_mode="first_match",
-            extraction_config=[LatexExtractionConfig()],
         )
-        if len(gold_parsed) != 0:
-            # We require the answer to be provided in correct latex (no malformed operators)
-            answer_parsed = parse(
-                content,
-                extraction_config=[
-                    LatexExtractionConfig(
-                        normalization_config=NormalizationConfig(
-                            nits=False,
-                            malformed_operators=False,
-                            basic_latex=True,
-                            equations=True,
-                            boxed=True,
-                            units=True,
-                        ),
-                        # Ensures that boxed is tried first
-                        boxed_match_priority=0,
-                        try_extract_without_anchor=False,
-                    )
-                ],
-                extraction_mode="first_match",
-            )
-            # Reward 1 if the content is the same as the ground truth, 0 otherwise
+        # Reward 1 if the content is the same as the ground truth, 0 otherwise
+        try:
+            reward = float(verify(answer_parsed, gold_parsed))
+        except Exception as e:
+            reward = 1.0
+            print("Failed to verify: ", e)
+    else:
+        # If the gold solution is not parseable, we reward 1 to skip this example
+        reward = 1.0
+        print("Failed to parse gold solution: ", sol)
+    return reward
+
+
+def verify_worker(conn, failure_reward):
+    # math_verify can only run in main thread, so every worker is a process
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        content, sol = task
+        try:
+            reward, verified = verify_math(content, sol), True
+        except Exception as e:
+            reward, verified = failure_reward, False
+            print("Failed to parse response: ", e)
+        conn.send((reward, verified))
+
+
+def normalize_response(response):
+    """
+    Whitespace-collapsed response, used in the cache key only, so responses that differ only in
+    whitespace are verified once. The original response is what gets graded.
+    """
+    return " ".join(response.split())
+
+
+class RewardCache:
+    """Memoizes accuracy rewards keyed by (normalized_response, problem).
+
+    Args:
+        max_size (int): Max number of entries, a number <= 0 means unlimited.
+        eviction (str): "lru" evicts the least recently used entry, "fifo" the oldest inserted one.
+    """
+
+    # bumped whenever the key changes, snapshots of another version are not loaded
+    VERSION = 3
+
+    def __init__(self, max_size, eviction="lru"):
+        assert eviction in ("lru", "fifo"), f"Unknown eviction policy: {eviction}"
+        self.max_size = max_size
+        self.eviction = eviction
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        reward = self._data.get(key)
+        if reward is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.eviction == "lru":
+            self._data.move_to_end(key)
+        return reward
+
+    def put(self, key, reward):
+        self._data[key] = reward
+        if self.max_size > 0 and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+    def snapshot(self):
+        entries = [[response, problem, reward] for (response, problem), reward in self._data.items()]
+        return {"version": self.VERSION, "entries": entries}
+
+    @staticmethod
+    def save(snapshot, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path, "r") as f:
+            snapshot = json.load(f)
+        if not isinstance(snapshot, dict) or snapshot.get("version") != self.VERSION:
+            print(f"{path} was saved with another cache key format, ignoring it")
+            return
+        for response, problem, reward in snapshot["entries"]:
+            self.put((response, problem), reward)
+
+
+class VerifierPool:
+    """Pool of `verify_math` worker processes.
+
+    Items are handed to idle workers by a dispatcher thread and resolved through futures, so a batch
+    can be fanned out over all workers and gathered back in order. A worker that spends more than
+    `timeout` seconds on one item (e.g. a pathological sympy parse) is killed and replaced, and that
+    item gets `failure_reward`.
+
+    Futures resolve to `(reward, verified)`, where `verified` is False when the reward is
+    `failure_reward` because of a timeout, a crash or an exception, so that it is not cached.
+    """
+
+    def __init__(self, num_workers, timeout, failure_reward=0.0):
+        self.timeout = timeout
+        self.failure_reward = failure_reward
+        self.stats = {"verified": 0, "timeouts": 0, "crashes": 0}
+        self._tasks = queue.Queue()
+        self._workers = [self._spawn() for _ in range(num_workers)]
+        self._thread = threading.Thread(target=self._dispatch, name="verifier-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _spawn(self):
+        parent_conn, child_conn = Pipe()
+        process = Process(target=verify_worker, args=(child_conn, self.failure_reward), daemon=True)
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "future": None, "start": None}
+
+    def _replace(self, index):
+        worker = self._workers[index]
+        worker["process"].kill()
+        worker["process"].join()
+        worker["conn"].close()
+        self._workers[index] = self._spawn()
+
+    def submit(self, content, sol) -> Future:
+        future = Future()
+        self._tasks.put((content, sol, future))
+        return future
+
+    def _dispatch(self):
+        backlog = deque()
+        while True:
             try:
-                reward = float(verify(answer_parsed, gold_parsed))
+                self._dispatch_step(backlog)
             except Exception as e:
-                reward = 1.0
-                print("Failed to verify: ", e)
-        else:
-            # If the gold solution is not parseable, we reward 1 to skip this example
-            reward = 1.0
-            print("Failed to parse gold solution: ", sol)
+                # keep serving, a dead dispatcher would leave every future pending forever
+                print("Verifier dispatcher error: ", e)
+                time.sleep(0.1)
+
+    def _dispatch_step(self, backlog):
+        # block for new items only when there is nothing else to do
+        idle = [i for i, w in enumerate(self._workers) if w["future"] is None]
+        block = not backlog and len(idle) == len(self._workers)
+        try:
+            while True:
+                backlog.append(self._tasks.get(block=block))
+                block = False
+        except queue.Empty:
+            pass
 
-        output_queue.put(reward)
+        for i in idle:
+            if not backlog:
+                break
+            content, sol, future = task = backlog.popleft()
+            worker = self._workers[i]
+            try:
+                worker["conn"].send((content, sol))
+            except (BrokenPipeError, OSError):
+                # the worker died while idle, e.g. killed by the OOM killer
+                self.stats["crashes"] += 1
+                self._replace(i)
+                backlog.appendleft(task)
+                continue
+            worker["future"], worker["start"] = future, time.monotonic()
+
+        busy = {w["conn"]: i for i, w in enumerate(self._workers) if w["future"] is not None}
+        for conn in wait(list(busy.keys()), timeout=0.05):
+            i = busy[conn]
+            future = self._workers[i]["future"]
+            try:
+                result = conn.recv()
+                self.stats["verified"] += 1
+            except (EOFError, OSError):
+                # the worker died, e.g. killed by the OOM killer
+                result = (self.failure_reward, False)
+                self.stats["crashes"] += 1
+                self._replace(i)
+            self._workers[i]["future"] = None
+            self._resolve(future, result)
 
+        now = time.monotonic()
+        for i, worker in enumerate(self._workers):
+            if worker["future"] is not None and now - worker["start"] > self.timeout:
+                future = worker["future"]
+                self.stats["timeouts"] += 1
+                self._replace(i)
+                self._resolve(future, (self.failure_reward, False))
 
-@app.route("/get_reward", methods=["POST"])
-def get_reward():
+    @staticmethod
+    def _resolve(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    def close(self):
+        for worker in self._workers:
+            worker["process"].kill()
+
+
+# in-flight verifications, so identical keys within and across requests are verified once
+inflight = {}
+
+
+async def get_acc_reward(response, problem, answer):
+    key = (normalize_response(response), problem)
+    reward = reward_cache.get(key)
+    if reward is not None:
+        return reward
+    if key not in inflight:
+        inflight[key] = asyncio.wrap_future(verifier_pool.submit(response, answer))
+    future = inflight[key]
+    try:
+        reward, verified = await asyncio.shield(future)
+    finally:
+        inflight.pop(key, None)
+    if verified:
+        # failures such as timeouts are transient, they are retried by later requests
+        reward_cache.put(key, reward)
+    return reward
+
+
+@app.get("/stats")
+async def get_stats():
+    return JSONResponse(
+        {"cache": reward_cache.stats(), "verifier": verifier_pool.stats, "problem_index": problem_index.get_stats()}
+    )
+
+
+async def save_cache_periodically(path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(RewardCache.save, reward_cache.snapshot(), path)
+
+
+@app.post("/get_reward")
+async def get_reward(request: Request):
     # 获取请求中的 JSON 数据
-    data = request.get_json()
+    data = await request.json()
     # 检查是否有 'query' 字段
     if "query" not in data:
-        return jsonify({"error": "queries field is required"}), 400
-    rewards = []
-    for q,problem in zip(data["query"],data["prompts"]):
+        return JSONResponse({"error": "queries field is required"}, status_code=400)
+    items = []
+    for q, problem in zip(data["query"], data["prompts"]):
         if problem is None:
-            return jsonify({"error": f"problem not found from {q}"}), 400
+            return JSONResponse({"error": f"problem not found from {q}"}, status_code=400)
         if problem not in problem_to_answer:
             # This should not happen
             print(f"problem not exists: {problem}")
-            problem = find_similar_problem(problem)
+            # the lookup is CPU bound, keep it off the event loop
+            problem = await asyncio.get_running_loop().run_in_executor(None, find_similar_problem, problem)
         answer = problem_to_answer[problem]
         response = get_response_from_query(q) or q
         if response is None:
-            return jsonify({"error": f"response not found from {q}"}), 400
+            return JSONResponse({"error": f"response not found from {q}"}, status_code=400)
+        items.append((q, problem, answer, response))
+
+    # fan out cache misses to the verifier pool and gather back in order
+    acc_rewards = await asyncio.gather(
+        *[get_acc_reward(response, problem, answer) for _, problem, answer, response in items]
+    )
+
+    rewards = []
+    for (q, problem, answer, response), acc_reward in zip(items, acc_rewards):
         format_reward = float(verify_format(response))
-        input_queue.put((response, answer))
-        acc_reward = float(output_queue.get())
+        acc_reward = float(acc_reward)
         do_print = random.randint(1, 20) == 1
         if do_print:
             info=f"Query: {q}\n\nProblem: {problem}\n\n Answer: {answer}\n\n Response: {response}\n\n Format Reward: {format_reward}\n\n Acc Reward: {acc_reward}\n\n"
             info = re.sub(r"<\|.*?\|>","",info)
             print(info)
-            
+
         rewards.append(0.5 * format_reward + acc_reward)
     # 返回包含 rewards 的响应
-    return jsonify({"rewards": rewards})
+    return JSONResponse({"rewards": rewards})
 
 
 if __name__ == "__main__":
@@ -137,6 +472,27 @@ if __name__ == "__main__":
     parser.add_argument(
         "--input_key", type=str, default="prompt", help="The key name of prompt."
     )
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of verifier processes")
+    parser.add_argument(
+        "--verify_timeout", type=float, default=30, help="Seconds a single response may take to verify"
+    )
+    parser.add_argument(
+        "--timeout_reward", type=float, default=0.0, help="Accuracy reward for responses that fail to verify in time"
+    )
+    parser.add_argument("--cache_size", type=int, default=1000000, help="Max reward cache entries, <= 0 for unlimited")
+    parser.add_argument("--cache_eviction", type=str, default="lru", choices=["lru", "fifo"])
+    parser.add_argument("--cache_path", type=str, default=None, help="Load/save the reward cache from/to this file")
+    parser.add_argument(
+        "--cache_save_interval", type=float, default=600, help="Seconds between reward cache snapshots"
+    )
+    parser.add_argument(
+        "--problem_index", type=str, default=None, help="Load the nearest-problem index from (or save it to) this file"
+    )
+    parser.add_argument(
+        "--build_index_only", action="store_true", default=False, help="Build and save --problem_index, then exit"
+    )
+    parser.add_argument("--port", type=int, default=5000, help="Port number for the server")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="IP for the server")
     args = parser.parse_args()
     
     # Split dataset paths and load all datasets
@@ -174,11 +530,40 @@ if __name__ == "__main__":
             answer = "$" + answer + "$"
         problem_to_answer[problem] = answer
 
-    # math_verify can only run in main thread
-    input_queue = Queue()
-    output_queue = Queue()
-    p = Process(target=verify_math, args=(input_queue, output_queue))
-    p.start()
+    problem_index = None
+    if args.problem_index is not None and os.path.exists(args.problem_index) and not args.build_index_only:
+        problem_index = ProblemIndex.load(args.problem_index)
+        if set(problem_index.problems) != problem_to_answer.keys():
+            print(f"{args.problem_index} does not match the dataset, rebuilding")
+            problem_index = None
+    if problem_index is None:
+        problem_index = ProblemIndex(problem_to_answer.keys())
+        if args.problem_index is not None:
+            problem_index.save(args.problem_index)
+    print(f"indexed {len(problem_index.problems)} problems")
+    if args.build_index_only:
+        exit(0)
+
+    # parse every gold answer once instead of once per verified response
+    answers = list(set(problem_to_answer.values()))
+    with Pool(args.num_workers) as pool:
+        answer_to_gold_parsed.update(zip(answers, pool.map(parse_gold, answers, chunksize=64)))
+    print(f"parsed {len(answers)} gold answers")
+
+    reward_cache = RewardCache(args.cache_size, args.cache_eviction)
+    if args.cache_path is not None and os.path.exists(args.cache_path):
+        reward_cache.load(args.cache_path)
+        print(f"loaded {reward_cache.stats()['size']} cached rewards from {args.cache_path}")
+
+    verifier_pool = VerifierPool(args.num_workers, args.verify_timeout, args.timeout_reward)
+
+    async def serve():
+        if args.cache_path is not None and args.cache_save_interval > 0:
+            asyncio.create_task(save_cache_periodically(args.cache_path, args.cache_save_interval))
+        server = uvicorn.Server(uvicorn.Config(app, host=args.host, port=args.port, log_level="warning"))
+        await server.serve()
 
-    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
-    p.kill()
+    asyncio.run(serve())
+    verifier_pool.close()
+    if args.cache_path is not None:
+        RewardCache.save(reward_cache.snapshot(), args.cache_path)
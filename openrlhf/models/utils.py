@@ -1,7 +1,10 @@
+from dataclasses import dataclass
 from typing import Optional, Tuple, Union
 
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def compute_approx_kl(
@@ -64,16 +67,114 @@ def compute_reward(
 
         reward = last_reward + kl_reward
     else:
-        # TODO: write a more efficient version
-        reward = []
-        for i, (kl_seg, action_len) in enumerate(zip(kl, num_actions)):
-            kl_reward = -kl_coef * kl_seg
-            kl_reward[action_len - 1] += r[i]
-            reward.append(kl_reward)
+        # add the reward to the last action of every packed sample
+        kl_reward = -kl_coef * torch.cat(kl)
+        eos_indices = torch.tensor(num_actions, device=kl_reward.device).cumsum(dim=0) - 1
+        kl_reward.index_add_(0, eos_indices, r.to(kl_reward.dtype))
+        reward = list(kl_reward.split(num_actions))
 
     return reward
 
 
+def reverse_discounted_cumsum(x: torch.Tensor, discount: float, chunk_size: int = 128) -> torch.Tensor:
+    """
+    Compute y[..., t] = x[..., t] + discount * y[..., t + 1] along the last dimension.
+
+    The sequence is split into chunks of `chunk_size`. Inside each chunk the discounted sum is a matmul
+    with a triangular discount matrix, and the carry between chunks is itself a reverse discounted cumsum
+    over the chunk heads (with discount ** chunk_size), so there is no per-timestep Python loop.
+    Unlike the log-space trick this never divides by discount ** t, so it is stable for any discount.
+    """
+    length = x.size(-1)
+    if length == 0:
+        return x.clone()
+    chunk_size = max(1, min(chunk_size, length))
+    num_chunks = (length + chunk_size - 1) // chunk_size
+    pad = num_chunks * chunk_size - length
+    # zeros appended at the end do not change a reverse cumsum
+    if pad > 0:
+        x = F.pad(x, (0, pad))
+
+    # discount_matrix[k, i] = discount ** (k - i) if k >= i else 0
+    index = torch.arange(chunk_size, device=x.device)
+    exponents = index.unsqueeze(1) - index.unsqueeze(0)
+    base = torch.tensor(discount, dtype=x.dtype, device=x.device)
+    discount_matrix = base.pow(exponents.clamp(min=0).to(x.dtype)).masked_fill(exponents < 0, 0.0)
+
+    chunks = x.reshape(*x.shape[:-1], num_chunks, chunk_size)
+    y = torch.matmul(chunks, discount_matrix)
+    if num_chunks > 1:
+        # y at the head of every chunk, including the contribution of all later chunks
+        heads = reverse_discounted_cumsum(y[..., 0], discount**chunk_size, chunk_size)
+        carry = F.pad(heads[..., 1:], (0, 1))
+        decay = base.pow((chunk_size - index).to(x.dtype))
+        y = y + carry.unsqueeze(-1) * decay
+    return y.reshape(*x.shape[:-1], num_chunks * chunk_size)[..., :length]
+
+
+def _pad_ragged(tensors: list[torch.Tensor]) -> Tuple[torch.Tensor, list[int]]:
+    lengths = [t.numel() for t in tensors]
+    return torch.nn.utils.rnn.pad_sequence([t.flatten() for t in tensors], batch_first=True), lengths
+
+
+def _unpad_ragged(padded: torch.Tensor, lengths: list[int]) -> list[torch.Tensor]:
+    lengths_tensor = torch.tensor(lengths, device=padded.device)
+    mask = torch.arange(padded.size(1), device=padded.device).unsqueeze(0) < lengths_tensor.unsqueeze(1)
+    return list(padded[mask].split(lengths))
+
+
+def compute_gae(
+    values: Union[torch.Tensor, list[torch.Tensor]],
+    rewards: Union[torch.Tensor, list[torch.Tensor]],
+    action_mask: Optional[torch.Tensor],
+    gamma: float,
+    lambd: float,
+    chunk_size: int = 128,
+) -> Tuple[Union[torch.Tensor, list[torch.Tensor]], Union[torch.Tensor, list[torch.Tensor]]]:
+    """
+    Batched GAE for padded (B, A) tensors or packed lists of ragged (A_i,) tensors.
+
+    Equivalent to the per-timestep recursion
+        delta_t = r_t + gamma * V_{t+1} - V_t
+        adv_t = delta_t + gamma * lambd * adv_{t+1}
+    with V_A = 0, evaluated with `reverse_discounted_cumsum`.
+    """
+    if isinstance(values, list):
+        # packed samples are right padded with zeros, which leaves every sample's recursion unchanged
+        values, lengths = _pad_ragged(values)
+        rewards, _ = _pad_ragged(rewards)
+        advantages, returns = compute_gae(values, rewards, None, gamma, lambd, chunk_size)
+        return _unpad_ragged(advantages, lengths), _unpad_ragged(returns, lengths)
+
+    if action_mask is not None:
+        values = action_mask * values
+        rewards = action_mask * rewards
+
+    next_values = F.pad(values[:, 1:], (0, 1))
+    deltas = rewards + gamma * next_values - values
+    advantages = reverse_discounted_cumsum(deltas, gamma * lambd, chunk_size)
+    returns = advantages + values
+    return advantages.detach(), returns
+
+
+def compute_cumulative_returns(
+    rewards: Union[torch.Tensor, list[torch.Tensor]],
+    action_mask: Optional[torch.Tensor],
+    gamma: float,
+    chunk_size: int = 128,
+) -> Union[torch.Tensor, list[torch.Tensor]]:
+    """
+    Batched discounted returns (REINFORCE) for padded (B, A) tensors or packed lists of ragged (A_i,) tensors.
+    """
+    if isinstance(rewards, list):
+        rewards, lengths = _pad_ragged(rewards)
+        return _unpad_ragged(compute_cumulative_returns(rewards, None, gamma, chunk_size), lengths)
+
+    if action_mask is not None:
+        rewards = action_mask * rewards
+    return reverse_discounted_cumsum(rewards, gamma, chunk_size)
+
+
 def log_probs_from_logits(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
     # https://github.com/OpenRLHF/OpenRLHF/pull/718#issuecomment-2641081881
     if logits.dtype in [torch.float32, torch.float64]:
@@ -92,6 +193,37 @@ def log_probs_from_logits(logits: torch.Tensor, labels: torch.Tensor) -> torch.T
     return log_probs_labels
 
 
+def _chunk_log_probs(hidden_states: torch.Tensor, labels: torch.Tensor, lm_head: nn.Module) -> torch.Tensor:
+    logits = lm_head(hidden_states.to(lm_head.weight.dtype)).to(torch.float32)
+    return log_probs_from_logits(logits, labels)
+
+
+def log_probs_from_hidden_states(
+    hidden_states: torch.Tensor, lm_head: nn.Module, labels: torch.Tensor, chunk_size: int = 1024
+) -> torch.Tensor:
+    """
+    Per-token log probs of labels from the final hidden states, applying lm_head to chunk_size tokens
+    at a time so that float32 logits are never materialized for more than one chunk. When gradients
+    are needed, each chunk is checkpointed: its logits are recomputed in backward instead of stored.
+
+    Args:
+        hidden_states: (B, S, H) hidden states before the LM head.
+        lm_head: The output embedding module.
+        labels: (B, S) token ids.
+        chunk_size: Number of tokens per chunk.
+    """
+    batch_size, seq_len = labels.shape
+    hidden_states = hidden_states.reshape(batch_size * seq_len, -1)
+    labels = labels.reshape(-1)
+    log_probs = []
+    for h, y in zip(hidden_states.split(chunk_size), labels.split(chunk_size)):
+        if torch.is_grad_enabled() and h.requires_grad:
+            log_probs.append(checkpoint(_chunk_log_probs, h, y, lm_head, use_reentrant=False))
+        else:
+            log_probs.append(_chunk_log_probs(h, y, lm_head))
+    return torch.cat(log_probs).view(batch_size, seq_len)
+
+
 def masked_mean(tensor: torch.Tensor, mask: Optional[torch.Tensor], dim: int = None) -> torch.Tensor:
     if mask is None:
         return tensor.mean(axis=dim)
@@ -111,22 +243,104 @@ def masked_normalize(tensor: torch.Tensor, mask: torch.Tensor, dim: int = 1, eps
 # Input: attention_mask = torch.tensor([[1, 1, 1, 2, 2, 2, 3, 3, 0]])
 # Output: position_ids  = torch.tensor([[0, 1, 2, 0, 1, 2, 0, 1, 0]])
 def reset_position_ids(attention_mask):
-    position_ids = torch.zeros_like(attention_mask, dtype=torch.long)
-    for i in range(attention_mask.size(0)):
-        mask = attention_mask[i]
-        seq_num = mask.max().item()
-        for index in range(1, seq_num + 1):
-            sample_mask = mask == index
-            sample_length = sample_mask.sum().item()
-            position_ids[i, sample_mask] = torch.arange(sample_length, device=mask.device)
-    return position_ids
+    # position within the run of equal ids, each packed sample being one contiguous run
+    positions = torch.arange(attention_mask.size(1), device=attention_mask.device).expand_as(attention_mask)
+    run_starts = F.pad(attention_mask[:, 1:] != attention_mask[:, :-1], (1, 0), value=True)
+    run_offsets = torch.where(run_starts, positions, 0).cummax(dim=1).values
+    return (positions - run_offsets).masked_fill_(attention_mask == 0, 0)
+
+
+def expand_shared_images(visual_inputs: dict) -> dict:
+    """
+    Turn visual inputs whose samples share images back into the per-image inputs the model expects.
+
+    Shared visual inputs hold every distinct image once in pixel_values / image_embeds / image_grid_thw, and
+    image_index maps the images of the batch, in the order of their image tokens, to the distinct images.
+    """
+    if visual_inputs.get("image_index") is None:
+        return visual_inputs
+    visual_inputs = dict(visual_inputs)
+    image_index = visual_inputs.pop("image_index").tolist()
+    image_grid_thw = visual_inputs["image_grid_thw"]
+    num_patches = image_grid_thw.prod(dim=-1)
+    for key in ["pixel_values", "image_embeds"]:
+        if visual_inputs.get(key) is None:
+            continue
+        # pixel_values have a row per patch, image_embeds a row per merged group of patches
+        rows = num_patches // (num_patches.sum() // visual_inputs[key].size(0))
+        images = visual_inputs[key].split(rows.tolist())
+        visual_inputs[key] = torch.cat([images[i] for i in image_index])
+    visual_inputs["image_grid_thw"] = image_grid_thw[image_index]
+    return visual_inputs
 
 
 def unpacking_samples(values: torch.Tensor, packed_seqlens: list[int]):
     values = values.squeeze(0)
-    unpacked_values = []
-    offset = 0
-    for seqlen in packed_seqlens:
-        unpacked_values.append(values[offset : offset + seqlen])
-        offset += seqlen
-    return unpacked_values
+    return list(values[: sum(packed_seqlens)].split(packed_seqlens))
+
+
+@dataclass
+class PackedSeqInfo:
+    """Metadata of a batch of packed samples, built once per forward from the host side lengths so
+    that consumers only run tensor ops on it, without host syncs.
+
+    Shapes of each tensor:
+    cu_seqlens: (B + 1), int32 cumulative sample lengths, as flash attention expects them.
+    position_ids: (1, T), the position of every token within its sample, 0 for trailing padding.
+    action_indices: (sum(A)), for every action, its index in the log probs / values of the
+        shifted sequence (T - 1), or None when num_actions is not given.
+
+    "T" is the packed length, which may exceed sum(packed_seq_lens) because of padding.
+    """
+
+    packed_seq_lens: list[int]
+    num_actions: Optional[list[int]]
+    cu_seqlens: torch.Tensor
+    position_ids: torch.Tensor
+    action_indices: Optional[torch.Tensor]
+
+    @classmethod
+    def build(
+        cls,
+        packed_seq_lens: Union[list[int], torch.Tensor],
+        num_actions: Optional[list[int]] = None,
+        total_len: Optional[int] = None,
+        device: Optional[torch.device] = None,
+    ) -> "PackedSeqInfo":
+        if isinstance(packed_seq_lens, torch.Tensor):
+            packed_seq_lens = packed_seq_lens.tolist()
+        # everything is computed on cpu from host lists, then copied once
+        seq_lens = torch.tensor(packed_seq_lens, dtype=torch.long)
+        cu_seqlens = F.pad(seq_lens.cumsum(dim=0), (1, 0))
+        num_tokens = int(cu_seqlens[-1])
+        total_len = num_tokens if total_len is None else total_len
+        position_ids = torch.arange(num_tokens) - cu_seqlens[:-1].repeat_interleave(seq_lens)
+        position_ids = F.pad(position_ids, (0, total_len - num_tokens)).unsqueeze(0)
+
+        action_indices = None
+        if num_actions is not None:
+            assert len(num_actions) == len(packed_seq_lens)
+            # the actions of a sample are its last num_actions tokens, predicted at the preceding positions
+            ends = cu_seqlens[1:] - 1
+            starts = (ends - torch.tensor(num_actions, dtype=torch.long)).clamp(min=0)
+            counts = ends - starts
+            out_offsets = counts.cumsum(dim=0) - counts
+            action_indices = torch.arange(int(counts.sum())) + (starts - out_offsets).repeat_interleave(counts)
+            action_indices = action_indices.to(device, non_blocking=True)
+
+        return cls(
+            packed_seq_lens=packed_seq_lens,
+            num_actions=num_actions,
+            cu_seqlens=cu_seqlens.to(device=device, dtype=torch.int32, non_blocking=True),
+            position_ids=position_ids.to(device, non_blocking=True),
+            action_indices=action_indices,
+        )
+
+    @property
+    def eos_indices(self) -> torch.Tensor:
+        """Index of the last token of every sample."""
+        return self.cu_seqlens[1:].long() - 1
+
+    def gather_actions(self, values: torch.Tensor) -> torch.Tensor:
+        """Select the action positions from (1, T - 1) log probs or values."""
+        return values[:, self.action_indices]
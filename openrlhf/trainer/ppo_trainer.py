@@ -12,8 +12,20 @@ from tqdm import tqdm
 from openrlhf.models import Actor, GPTLMLoss, PolicyLoss, ValueLoss
 from openrlhf.models.utils import masked_mean
 from openrlhf.utils.distributed_sampler import DistributedSampler
-
-from .ppo_utils import AdaptiveKLController, Experience, FixedKLController, NaiveExperienceMaker, NaiveReplayBuffer, DATA_PROCESSOR_MAP
+from openrlhf.utils.tracer import get_tracer, summarize_spans, trace_span, write_chrome_trace
+
+from .ppo_utils import (
+    AdaptiveKLController,
+    Experience,
+    FixedKLController,
+    LengthGroupedBatchSampler,
+    ExperiencePrefetcher,
+    MetricsAccumulator,
+    NaiveExperienceMaker,
+    NaiveReplayBuffer,
+    DATA_PROCESSOR_MAP,
+    VisionCache,
+)
 
 
 class PPOTrainer(ABC):
@@ -107,7 +119,12 @@ class PPOTrainer(ABC):
         self.data_processor = None
         # for vlm critic model, not provice processor.
         if self.args.train_vlm and processor is not None:
-            self.data_processor = DATA_PROCESSOR_MAP[type(processor)](processor)
+            vision_cache = None
+            if getattr(self.args, "vision_cache_size_mb", 0) > 0:
+                vision_cache = VisionCache(
+                    self.args.vision_cache_size_mb * 2**20, getattr(self.args, "vision_cache_dir", None)
+                )
+            self.data_processor = DATA_PROCESSOR_MAP[type(processor)](processor, vision_cache=vision_cache)
             self.tokenizer = self.data_processor.tokenizer
 
         self.generate_kwargs = generate_kwargs
@@ -165,6 +182,14 @@ class PPOTrainer(ABC):
             drop_maxlen=self.args.drop_maxlen, 
             maxlen=self.args.generate_max_len + prompt_max_len,
         )
+        # epochs trained on the replay buffer so far, seeds the shuffling of each epoch
+        self.replay_epochs = 0
+
+        # span tracer, Ray actors configure it with their role when they start
+        self.trace_dir = getattr(self.args, "trace_dir", None)
+        self.tracer = get_tracer()
+        if self.trace_dir and not self.tracer.enabled:
+            self.tracer.configure(type(self).__name__, strategy.get_rank(), enabled=True)
 
         # wandb/tensorboard setting
         self._wandb = None
@@ -238,19 +263,25 @@ class PPOTrainer(ABC):
                 disable=not self.strategy.is_rank_0(),
             )
 
-            for rand_prompts in self.prompts_dataloader:
-                for i, experience in enumerate(
-                    self.experience_maker.make_experience_list(rand_prompts, **self.generate_kwargs)
-                ):
-                    if i == 0:
-                        output = self.tokenizer.batch_decode(
-                            experience.sequences[0].unsqueeze(0), skip_special_tokens=True
-                        )
-                        self.strategy.print(output)
-                    self.replay_buffer.append(experience)
-
-                self.replay_buffer.normalize("advantages", self.strategy)
-                status = self.ppo_train(steps)
+            for rand_prompts, rand_prompt_token_ids in self.prompts_dataloader:
+                self.tracer.set_step(steps)
+                with trace_span("make_experience_list"):
+                    experiences = self.experience_maker.make_experience_list(
+                        rand_prompts, rand_prompt_token_ids, **self.generate_kwargs
+                    )
+                with trace_span("replay_buffer_append"):
+                    for i, experience in enumerate(experiences):
+                        if i == 0:
+                            output = self.tokenizer.batch_decode(
+                                experience.sequences[0].unsqueeze(0), skip_special_tokens=True
+                            )
+                            self.strategy.print(output)
+                        self.replay_buffer.append(experience)
+
+                with trace_span("normalize"):
+                    self.replay_buffer.normalize("advantages", self.strategy)
+                with trace_span("ppo_train"):
+                    status = self.ppo_train(steps)
                 self.replay_buffer.clear()
 
                 if "kl" in status:
@@ -260,6 +291,8 @@ class PPOTrainer(ABC):
                 # logs/checkpoints
                 client_states = {"consumed_samples": steps * args.rollout_batch_size}
                 self.save_logs_and_checkpoints(args, steps, pbar, status, client_states)
+                if self.tracer.enabled:
+                    self.save_trace(steps)
 
                 pbar.update()
                 steps = steps + 1
@@ -269,72 +302,99 @@ class PPOTrainer(ABC):
         if self._tensorboard is not None and self.strategy.is_rank_0():
             self._tensorboard.close()
 
-    def ppo_train(self, global_steps=0):
-        torch.cuda.empty_cache()
+    def setup_replay_dataloader(self):
         # replay buffer may be empty at first, we should rebuild at each training
+        sampler = LengthGroupedBatchSampler(
+            self.replay_buffer.sequence_lengths(),
+            self.replay_buffer.sample_batch_size,
+            group_by_length=getattr(self.args, "train_group_by_length", False),
+            max_tokens=getattr(self.args, "train_max_tokens_per_batch", None),
+            packing_samples=self.replay_buffer.packing_samples,
+            seed=self.strategy.seed,
+            strategy=self.strategy,
+        )
+        prefetch = not getattr(self.args, "disable_replay_prefetch", False)
         dataloader = DataLoader(
-            self.replay_buffer,
-            batch_size=self.replay_buffer.sample_batch_size,
-            shuffle=True,
-            drop_last=True,
-            pin_memory=self.dataloader_pin_memory,
+            # the buffer collates batches of sample indices
+            range(len(self.replay_buffer)),
+            batch_sampler=sampler,
+            # the prefetcher pins in its background thread
+            pin_memory=self.dataloader_pin_memory and not prefetch,
             collate_fn=self.replay_buffer.collate_fn,
         )
+        if prefetch:
+            # batches are collated, pinned and copied to the device one step ahead of the training step
+            dataloader = ExperiencePrefetcher(
+                dataloader, self.replay_buffer.target_device, pin_memory=self.dataloader_pin_memory
+            )
+        return dataloader, sampler
+
+    def ppo_train(self, global_steps=0):
+        torch.cuda.empty_cache()
+        dataloader, sampler = self.setup_replay_dataloader()
         device = torch.cuda.current_device()
 
-        status_list = []
+        # metrics stay on device until the end of ppo_train, then one all-reduce for all of them
+        metrics = MetricsAccumulator(self.strategy)
         status_mean = {}
+        sampler_stats = []
         for epoch in range(self.max_epochs):
+            sampler.set_epoch(self.replay_epochs)
+            self.replay_epochs += 1
+            sampler_stats.append(sampler.stats)
             pbar = tqdm(
                 dataloader,
                 desc=f"Train epoch [{epoch + 1}/{self.max_epochs}]",
                 disable=not self.strategy.is_rank_0(),
             )
             for experience in pbar:
-                experience.to_device(device)
-                status = self.training_step(experience, global_steps)
+                with trace_span("training_step", epoch=epoch):
+                    # no-op when the batch was prefetched
+                    experience.to_device(device)
+                    status = self.training_step(experience, global_steps)
 
                 # for DP
                 # weighted mean for kl
-                if "kl" in status:
-                    status["kl"] *= status["response_length"]
-                    status = self.strategy.all_reduce(status)
-                    status["kl"] /= status["response_length"]
-
-                short_status = {}
-
-                if "policy_loss" in status:
-                    short_status = {
-                        "pg": status["policy_loss"],
-                        "rm": status["reward"],
-                        "ret": status["return"],
-                        "glen": status["response_length"],
-                        "tlen": status["total_length"],
-                        "kl": status["kl"],
-                        "act_lr": status["actor_lr"],
-                    }
-
-                if "critic_loss" in status:
-                    short_status["cri"] = status["critic_loss"]
-                    short_status["vals"] = status["values"]
-                    short_status["cri_lr"] = status["critic_lr"]
-
-                if "ptx_loss" in status:
-                    short_status["ptx"] = status["ptx_loss"]
-
-                status_list.append(status)
-                pbar.set_postfix(short_status)
-
-        if status_list:
-            status_mean = status_list[0]
-            for m in status_list[1:]:
-                for k, v in m.items():
-                    status_mean[k] += v
-            for k in status_mean.keys():
-                status_mean[k] /= len(status_list)
+                for k, v in status.items():
+                    if k == "kl":
+                        metrics.add(k, v, "weighted_mean", weight=status["response_length"])
+                    else:
+                        metrics.add(k, v)
+
+            # host sync once per epoch, without collectives
+            pbar.set_postfix(self._short_status(metrics.local()))
+
+        if metrics.ops:
+            status_mean = metrics.reduce()
+            for k in sampler_stats[0].keys():
+                status_mean[k] = sum(stats[k] for stats in sampler_stats) / len(sampler_stats)
         torch.cuda.empty_cache()
         return status_mean
 
+    @staticmethod
+    def _short_status(status: Dict[str, float]) -> Dict[str, float]:
+        short_status = {}
+
+        if "policy_loss" in status:
+            short_status = {
+                "pg": status["policy_loss"],
+                "rm": status["reward"],
+                "ret": status["return"],
+                "glen": status["response_length"],
+                "tlen": status["total_length"],
+                "kl": status["kl"],
+                "act_lr": status["actor_lr"],
+            }
+
+        if "critic_loss" in status:
+            short_status["cri"] = status["critic_loss"]
+            short_status["vals"] = status["values"]
+            short_status["cri_lr"] = status["critic_lr"]
+
+        if "ptx_loss" in status:
+            short_status["ptx"] = status["ptx_loss"]
+        return short_status
+
     def training_step(self, experience: Experience, global_steps) -> Dict[str, float]:
         status = {}
         if global_steps > self.freezing_actor_steps:
@@ -356,6 +416,7 @@ class PPOTrainer(ABC):
             attention_mask = torch.cat(
                 [torch.full_like(s, i + 1) for i, s in enumerate(experience.sequences)], dim=0
             ).unsqueeze(0)
+            visual_inputs = None
         else:
             sequences = experience.sequences
             old_action_log_probs = experience.action_log_probs
@@ -363,6 +424,7 @@ class PPOTrainer(ABC):
             num_actions = experience.action_mask.size(1)
             packed_seq_lens = None
             attention_mask = experience.attention_mask
+            visual_inputs = experience.visual_inputs
 
         # actor loss
         action_log_probs, output = self.actor(
@@ -371,6 +433,7 @@ class PPOTrainer(ABC):
             attention_mask=attention_mask,
             return_output=True,
             packed_seq_lens=packed_seq_lens,
+            visual_inputs=visual_inputs,
         )
 
         # loss function
@@ -416,17 +479,15 @@ class PPOTrainer(ABC):
         if self.ema_model:
             self.strategy.moving_average(self.actor, self.ema_model, self.ema_beta, "cuda")
 
-        # status
-        status = {"policy_loss": actor_loss.item(), "actor_lr": self.actor_scheduler.get_last_lr()[0]}
+        # status, kept on device to avoid a host sync per metric
+        status = {"policy_loss": actor_loss.detach(), "actor_lr": self.actor_scheduler.get_last_lr()[0]}
         if self.pretrain_dataloader is not None:
-            status["ptx_loss"] = ptx_loss.item()
+            status["ptx_loss"] = ptx_loss.detach()
         for k, v in experience.info.items():
             if k == "kl":
-                status[k] = (
-                    (v * experience.info["response_length"]).sum() / experience.info["response_length"].sum()
-                ).item()
+                status[k] = (v * experience.info["response_length"]).sum() / experience.info["response_length"].sum()
             else:
-                status[k] = v.mean().item()
+                status[k] = v.float().mean()
         return status
 
     def training_step_critic(self, experience: Experience) -> Dict[str, float]:
@@ -442,6 +503,7 @@ class PPOTrainer(ABC):
             attention_mask = torch.cat(
                 [torch.full_like(s, i + 1) for i, s in enumerate(experience.sequences)], dim=0
             ).unsqueeze(0)
+            visual_inputs = None
         else:
             sequences = experience.sequences
             old_values = experience.values
@@ -478,8 +540,8 @@ class PPOTrainer(ABC):
 
         # status
         status = {
-            "critic_loss": critic_loss.item(),
-            "values": masked_mean(values, experience.action_mask).item(),
+            "critic_loss": critic_loss.detach(),
+            "values": masked_mean(values.detach(), experience.action_mask),
             "critic_lr": self.critic_scheduler.get_last_lr()[0],
         }
         return status
@@ -514,7 +576,29 @@ class PPOTrainer(ABC):
         # TODO: save best model on dev, use loss/perplexity/others on whole dev dataset as metric
         if global_step % args.save_steps == 0:
             tag = f"global_step{global_step}"
-            self._save_checkpoint(args, tag, client_states)
+            with trace_span("save_checkpoint"):
+                self._save_checkpoint(args, tag, client_states)
+
+    def collect_trace_events(self) -> List[dict]:
+        """Spans recorded by this rank and by the remote models it drives since the last step."""
+        return self.tracer.collect()
+
+    def save_trace(self, global_step):
+        """Merge the spans of all ranks into one Chrome trace for the step and log their aggregates."""
+        events = self.collect_trace_events()
+        all_events = [None] * torch.distributed.get_world_size()
+        torch.distributed.all_gather_object(all_events, events)
+        if not self.strategy.is_rank_0():
+            return
+        events = [event for rank_events in all_events for event in rank_events]
+        write_chrome_trace(events, os.path.join(self.trace_dir, f"step_{global_step}.json"), step=global_step)
+
+        stats = summarize_spans(events)
+        if self._wandb is not None:
+            self._wandb.log({**{f"perf/trace/{k}": v for k, v in stats.items()}, "train/global_step": global_step})
+        elif self._tensorboard is not None:
+            for k, v in stats.items():
+                self._tensorboard.add_scalar(f"perf/trace/{k}", v, global_step)
 
     def _save_checkpoint(self, args, tag, client_states):
         if not self.disable_ds_ckpt:
@@ -1,7 +1,12 @@
 from .experience_maker import Experience, NaiveExperienceMaker, RemoteExperienceMaker
 from .kl_controller import AdaptiveKLController, FixedKLController
-from .replay_buffer import NaiveReplayBuffer
+from .metrics import MetricsAccumulator
+from .prefetcher import ExperiencePrefetcher
+from .replay_buffer import LengthGroupedBatchSampler, NaiveReplayBuffer
 from .data_processor import BaseDataProcessor, DATA_PROCESSOR_MAP
+from .vllm_router import PrefixAffinityRouter
+from .vision_cache import VisionCache
+from .wire import WireBatch
 
 __all__ = [
     "Experience",
@@ -9,5 +14,11 @@ __all__ = [
     "RemoteExperienceMaker",
     "AdaptiveKLController",
     "FixedKLController",
+    "MetricsAccumulator",
+    "ExperiencePrefetcher",
     "NaiveReplayBuffer",
+    "LengthGroupedBatchSampler",
+    "PrefixAffinityRouter",
+    "VisionCache",
+    "WireBatch",
 ]
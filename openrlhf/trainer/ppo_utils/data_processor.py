@@ -1,10 +1,11 @@
+import itertools
 import json
 import os
 from abc import ABC, abstractmethod
 from typing import List, Optional, Union, Dict
 
 import torch
-from qwen_vl_utils import process_vision_info
+from qwen_vl_utils import extract_vision_info, process_vision_info
 from transformers import Qwen2VLProcessor
 from transformers.processing_utils import ProcessorMixin
 try:
@@ -12,10 +13,17 @@ try:
 except Exception as e:
     print("Qocal Qwen2_5_VLProcessor not found")
 
+from .vision_cache import VisionCache
+
+# per-image tensors of visual inputs, concatenated over the images of a batch
+IMAGE_KEYS = ["pixel_values", "image_embeds"]
+
+
 class BaseDataProcessor(ABC):
-    def __init__(self, processor: ProcessorMixin):
+    def __init__(self, processor: ProcessorMixin, vision_cache: Optional[VisionCache] = None):
         super().__init__()
         self.processor = processor
+        self.vision_cache = vision_cache
 
     @abstractmethod
     def __call__(
@@ -38,6 +46,21 @@ class BaseDataProcessor(ABC):
     def split_input_batch(self, batch: Dict) -> List[Dict]:
         raise NotImplementedError
 
+    def make_shared_visual_inputs(
+        self,
+        messages: List[str],
+        max_length: int,
+        device: Optional[Union[str, torch.device]] = None,
+    ) -> Dict:
+        """
+        Visual inputs of a batch of samples, in which the samples of the same prompt may share their images
+        (see openrlhf.models.utils.expand_shared_images). By default every sample gets its own copy.
+        """
+        batch = self(messages, max_length, device=device)
+        batch.pop("input_ids")
+        batch.pop("attention_mask")
+        return batch
+
     def _format_messages(self, messages: Union[Dict, List[str], str]) -> List[Dict]:
         if isinstance(messages, list) and isinstance(messages[0], str):
             return [json.loads(m) for m in messages]
@@ -105,6 +128,11 @@ def add_pixel_bounds(messages):
 
 
 class Qwen2VLDataProcessor(BaseDataProcessor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # identities of the images of split samples, unique over all batches split by this processor
+        self._image_ids = itertools.count()
+
     def __call__(
         self,
         messages,
@@ -121,33 +149,139 @@ class Qwen2VLDataProcessor(BaseDataProcessor):
             messages, tokenize=False, add_generation_prompt=True
         )
         messages = add_pixel_bounds(messages)
-        image_inputs, video_inputs = process_vision_info(messages)
-
-        batch = processor(
-            text=texts,
-            images=image_inputs,
-            videos=video_inputs,
-            padding=padding,
-            max_length=max_length,
-            add_special_tokens=add_special_tokens,
-            truncation=truncation,
-            return_tensors=return_tensors,
-        )
+        vision_infos = extract_vision_info(messages)
+
+        if self.vision_cache is None or any("video" in info for info in vision_infos):
+            image_inputs, video_inputs = process_vision_info(messages)
+            batch = processor(
+                text=texts,
+                images=image_inputs,
+                videos=video_inputs,
+                padding=padding,
+                max_length=max_length,
+                add_special_tokens=add_special_tokens,
+                truncation=truncation,
+                return_tensors=return_tensors,
+            )
+        else:
+            # same outputs as the processor call above, with the image features served from the cache
+            features = [
+                self.vision_cache.image_features(info, processor.image_processor)
+                for info in vision_infos
+                if "image" in info or "image_url" in info
+            ]
+            image_inputs = {}
+            if features:
+                image_inputs = {k: torch.cat([f[k] for f in features]) for k in ["pixel_values", "image_grid_thw"]}
+                texts = self._expand_image_tokens(texts, image_inputs["image_grid_thw"])
+            batch = processor.tokenizer(
+                texts,
+                padding=padding,
+                max_length=max_length,
+                add_special_tokens=add_special_tokens,
+                truncation=truncation,
+                return_tensors=return_tensors,
+            )
+            batch = {**batch, **image_inputs}
         if device:
             return {k: v.to(device) for k, v in batch.items()}
         return {k: v for k, v in batch.items()}
 
+    def _expand_image_tokens(self, texts: List[str], image_grid_thw: torch.Tensor) -> List[str]:
+        # repeat every image token once per merged patch of its image, as Qwen2VLProcessor does
+        image_token = getattr(self.processor, "image_token", "<|image_pad|>")
+        merge_length = self.processor.image_processor.merge_size**2
+        index = 0
+        expanded = []
+        for text in texts:
+            parts = text.split(image_token)
+            pieces = [parts[0]]
+            for part in parts[1:]:
+                pieces.append(image_token * (image_grid_thw[index].prod().item() // merge_length))
+                pieces.append(part)
+                index += 1
+            expanded.append("".join(pieces))
+        return expanded
+
+    def make_shared_visual_inputs(self, messages, max_length, device=None) -> Dict:
+        # process every distinct prompt once, the samples of a prompt index its images
+        keys = [m if isinstance(m, str) else json.dumps(m) for m in messages]
+        unique_messages = {}
+        for key, m in zip(keys, messages):
+            unique_messages.setdefault(key, m)
+        unique = {key: i for i, key in enumerate(unique_messages)}
+        batch = self(list(unique_messages.values()), max_length, device=device)
+        input_ids = batch.pop("input_ids")
+        batch.pop("attention_mask")
+        if "pixel_values" not in batch or len(unique) == len(messages):
+            return batch
+
+        num_images = self._num_images(input_ids).tolist()
+        first_image = [sum(num_images[:i]) for i in range(len(num_images))]
+        image_index = [
+            first_image[unique[key]] + j for key in keys for j in range(num_images[unique[key]])
+        ]
+        batch["image_index"] = torch.tensor(image_index, dtype=torch.long, device=input_ids.device)
+        return batch
+
+    def _num_images(self, input_ids: torch.Tensor) -> torch.Tensor:
+        vision_start_id = self.processor.tokenizer("<|vision_start|>")["input_ids"][0]
+        return (input_ids == vision_start_id).sum(dim=-1)
+
     def make_input_batch(self, inputs: List[Dict]) -> Dict:
         # each element has no batch dimension
         batch = {k: None for k in inputs[0].keys()}
         for k in batch.keys():
             if k in ["input_ids", "attention_mask"]:
                 batch[k] = torch.stack([inp[k] for inp in inputs], dim=0)
-            elif k in ["pixel_values", "image_grid_thw"]:
+            elif k in ["pixel_values", "image_embeds", "image_grid_thw", "image_index"]:
                 # qwen2vl concat all patches of all images in a batch in the first dimension
-                batch[k] = torch.cat([inp[k] for inp in inputs], dim=0)
+                continue
             else:
                 raise ValueError(f"Unknown key {k} for Qwen2VLDataProcessor")
+        if "image_grid_thw" in batch:
+            batch.update(self._concat_images(inputs))
+        return batch
+
+    def _image_rows(self, image_grid_thw: torch.Tensor, key: str) -> List[int]:
+        # rows of every image in pixel_values (one per patch) or image_embeds (one per merged group of patches)
+        rows = image_grid_thw.prod(dim=-1)
+        if key == "image_embeds":
+            rows = rows // self.processor.image_processor.merge_size**2
+        return rows.tolist()
+
+    def _concat_images(self, inputs: List[Dict]) -> Dict:
+        image_keys = [k for k in IMAGE_KEYS if k in inputs[0]]
+        inputs = [inp for inp in inputs if inp["image_grid_thw"] is not None]
+        if not inputs:
+            return {k: None for k in image_keys + ["image_grid_thw"]}
+
+        # samples split from the same shared visual inputs carry the same image_index, keep each image once
+        images = {k: [] for k in image_keys}
+        image_grid_thw, image_ids = [], []
+        for inp in inputs:
+            image_grid_thw.extend(inp["image_grid_thw"])
+            for k in image_keys:
+                images[k].extend(inp[k].split(self._image_rows(inp["image_grid_thw"], k)))
+            if inp.get("image_index") is not None:
+                image_ids.extend(inp["image_index"].tolist())
+            else:
+                image_ids.extend(itertools.islice(self._image_ids, len(inp["image_grid_thw"])))
+        unique = {}
+        image_index, first_image = [], []
+        for i, image_id in enumerate(image_ids):
+            if image_id not in unique:
+                unique[image_id] = len(unique)
+                first_image.append(i)
+            image_index.append(unique[image_id])
+
+        if len(unique) == len(image_grid_thw):
+            batch = {k: torch.cat([inp[k] for inp in inputs], dim=0) for k in image_keys}
+            batch["image_grid_thw"] = torch.cat([inp["image_grid_thw"] for inp in inputs], dim=0)
+            return batch
+        batch = {k: torch.cat([images[k][i] for i in first_image], dim=0) for k in image_keys}
+        batch["image_grid_thw"] = torch.stack([image_grid_thw[i] for i in first_image])
+        batch["image_index"] = torch.tensor(image_index, dtype=torch.long)
         return batch
 
     def split_input_batch(self, batch: Dict) -> List[Dict]:
@@ -162,11 +296,10 @@ class Qwen2VLDataProcessor(BaseDataProcessor):
                 for i in range(batch_size):
                     batch_kwargs[i][k] = None
 
-        if "pixel_values" in keys and (
-            "input_ids" not in keys or "image_grid_thw" not in keys
-        ):
+        image_keys = [k for k in IMAGE_KEYS if k in keys]
+        if image_keys and ("input_ids" not in keys or "image_grid_thw" not in keys):
             raise ValueError(
-                "Cannot split batch with pixel_values without input_ids and image_grid_thw"
+                f"Cannot split batch with {image_keys} without input_ids and image_grid_thw"
             )
         if "image_grid_thw" in keys and ("input_ids" not in keys):
             raise ValueError("Cannot split batch with image_grid_thw without input_ids")
@@ -178,9 +311,16 @@ class Qwen2VLDataProcessor(BaseDataProcessor):
                 assert batch_size == len(vals)
                 for i, v in enumerate(vals):
                     batch_kwargs[i][k] = v
-        if "pixel_values" in keys:
+        if image_keys:
             thws = batch["image_grid_thw"]  # (total_img_num, (t,h,w))
-            pixel_values = batch["pixel_values"]
+            if not isinstance(thws, torch.Tensor):
+                thws = torch.stack(thws)
+            # with shared images, thws and the image keys hold every distinct image once
+            image_index = batch.get("image_index")
+            image_ids = image_index.tolist() if image_index is not None else list(range(len(thws)))
+            # every split sample keeps the identities of its images, make_input_batch merges equal ones
+            identities = list(itertools.islice(self._image_ids, len(thws)))
+            offsets = {k: [0] + list(itertools.accumulate(self._image_rows(thws, k))) for k in image_keys}
             vision_start_id = self.processor.tokenizer("<|vision_start|>")["input_ids"][0]
             vision_end_id = self.processor.tokenizer("<|vision_end|>")["input_ids"][0]
             for i in range(batch_size):
@@ -192,26 +332,35 @@ class Qwen2VLDataProcessor(BaseDataProcessor):
                 assert vision_start_num == vision_end_num
                 img_num = vision_start_num
                 if img_num == 0:
-                    batch_kwargs[i]["pixel_values"] = None
-                    batch_kwargs[i]["image_grid_thw"] = None
+                    for k in image_keys + ["image_grid_thw", "image_index"]:
+                        batch_kwargs[i][k] = None
                     continue
-                thws_i = thws[:img_num]
-                assert len(thws_i) == img_num
-                thws = thws[img_num:]
-                if not isinstance(thws_i, torch.Tensor):
-                    thws_i = torch.stack(thws_i)
-                batch_kwargs[i]["image_grid_thw"] = thws_i
-                patchs_num = thws_i.prod(dim=1).sum().item()
-                pixel_values_i = pixel_values[:patchs_num]
-                assert len(pixel_values_i) == patchs_num
-                pixel_values = pixel_values[patchs_num:]
-                batch_kwargs[i]["pixel_values"] = pixel_values_i
-            assert len(thws) == 0
-            assert len(pixel_values) == 0
+                ids, image_ids = image_ids[:img_num], image_ids[img_num:]
+                assert len(ids) == img_num
+                batch_kwargs[i]["image_index"] = torch.tensor([identities[j] for j in ids], dtype=torch.long)
+                if ids == list(range(ids[0], ids[0] + img_num)):
+                    # consecutive images are kept as views of the batch
+                    batch_kwargs[i]["image_grid_thw"] = thws[ids[0] : ids[-1] + 1]
+                    for k in image_keys:
+                        batch_kwargs[i][k] = batch[k][offsets[k][ids[0]] : offsets[k][ids[-1] + 1]]
+                else:
+                    batch_kwargs[i]["image_grid_thw"] = thws[ids]
+                    for k in image_keys:
+                        batch_kwargs[i][k] = torch.cat([batch[k][offsets[k][j] : offsets[k][j + 1]] for j in ids])
+            assert len(image_ids) == 0
         return batch_kwargs
 
     def _get_images_from_messages(self, messages: List[Dict]) -> List[Dict]:
         messages = add_pixel_bounds(messages)
+        if self.vision_cache is not None:
+            vision_infos = extract_vision_info(messages)
+            if not any("video" in info for info in vision_infos):
+                images = [
+                    self.vision_cache.fetch_image(info)
+                    for info in vision_infos
+                    if "image" in info or "image_url" in info
+                ]
+                return images or None
         image_inputs, _ = process_vision_info(messages)
         return image_inputs
 
@@ -1,9 +1,10 @@
 import os
 import time
 from abc import ABC
-from copy import deepcopy
-from dataclasses import dataclass, field
-from typing import List, Optional, Tuple, Union, Dict
+from collections import deque
+from copy import copy, deepcopy
+from dataclasses import dataclass, field, fields
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import ray
 import torch
@@ -11,23 +12,43 @@ import torch.nn as nn
 from tqdm import tqdm
 
 from openrlhf.models.actor import Actor
-from openrlhf.models.utils import compute_approx_kl, compute_reward, masked_mean, unpacking_samples
+from openrlhf.models.utils import (
+    compute_approx_kl,
+    compute_cumulative_returns,
+    compute_gae,
+    compute_reward,
+    masked_mean,
+    unpacking_samples,
+)
 from openrlhf.utils.logging_utils import init_logger
-from openrlhf.utils.remote_rm_utils import remote_rm_fn, remote_rm_fn_ray
+from openrlhf.utils.remote_rm_utils import RemoteRewardClient, remote_rm_fn
+from openrlhf.utils.tracer import trace_span, traced
+
+from .vllm_router import PrefixAffinityRouter
+from .wire import CRITIC_LOSSY_KEYS, WireBatch, decode_batch, encode_batch, encode_model_inputs, nbytes
 
 logger = init_logger(__name__)
 
 
-def to(tensor: Union[torch.Tensor, list[torch.Tensor]], device):
+def to(tensor: Union[torch.Tensor, list[torch.Tensor]], device, non_blocking: bool = False):
     if isinstance(tensor, list):
-        return [to(t, device) for t in tensor]
-    return tensor.to(device) if isinstance(tensor, torch.Tensor) else tensor
+        return [to(t, device, non_blocking) for t in tensor]
+    return tensor.to(device, non_blocking=non_blocking) if isinstance(tensor, torch.Tensor) else tensor
 
 
 def pin_memory(tensor: Union[torch.Tensor, list[torch.Tensor]]):
     if isinstance(tensor, list):
         return [pin_memory(t) for t in tensor]
-    return tensor.pin_memory() if isinstance(tensor, torch.Tensor) else tensor
+    # only host tensors can be pinned, e.g. not those of a replay buffer kept on GPU
+    return tensor.pin_memory() if isinstance(tensor, torch.Tensor) and tensor.device.type == "cpu" else tensor
+
+
+def record_stream(tensor: Union[torch.Tensor, list[torch.Tensor]], stream):
+    if isinstance(tensor, list):
+        for t in tensor:
+            record_stream(t, stream)
+    elif isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+        tensor.record_stream(stream)
 
 
 @dataclass
@@ -61,18 +82,18 @@ class Experience:
     visual_inputs: Optional[dict] = field(default_factory=dict)
 
     @torch.no_grad()
-    def to_device(self, device: torch.device):
-        self.sequences = to(self.sequences, device)
-        self.action_log_probs = to(self.action_log_probs, device)
-        self.returns = to(self.returns, device)
-        self.advantages = to(self.advantages, device)
-        self.values = to(self.values, device)
-        self.attention_mask = to(self.attention_mask, device)
-        self.action_mask = to(self.action_mask, device)
-        self.kl = to(self.kl, device)
-        self.info = {key: to(value, device) for key, value in self.info.items()}
+    def to_device(self, device: torch.device, non_blocking: bool = False):
+        self.sequences = to(self.sequences, device, non_blocking)
+        self.action_log_probs = to(self.action_log_probs, device, non_blocking)
+        self.returns = to(self.returns, device, non_blocking)
+        self.advantages = to(self.advantages, device, non_blocking)
+        self.values = to(self.values, device, non_blocking)
+        self.attention_mask = to(self.attention_mask, device, non_blocking)
+        self.action_mask = to(self.action_mask, device, non_blocking)
+        self.kl = to(self.kl, device, non_blocking)
+        self.info = {key: to(value, device, non_blocking) for key, value in self.info.items()}
         if self.visual_inputs is not None:
-            self.visual_inputs = {key: to(value, device) for key, value in self.visual_inputs.items()}
+            self.visual_inputs = {key: to(value, device, non_blocking) for key, value in self.visual_inputs.items()}
         return self
 
     def pin_memory(self):
@@ -89,6 +110,27 @@ class Experience:
             self.visual_inputs = {key: pin_memory(value) for key, value in self.visual_inputs.items()}
         return self
 
+    def to_wire(self, lossy_keys=()) -> WireBatch:
+        """Encode the experience into a single buffer for Ray transfers, see ppo_utils.wire."""
+        return encode_batch({f.name: getattr(self, f.name) for f in fields(self)}, lossy_keys)
+
+    @classmethod
+    def from_wire(cls, batch: WireBatch) -> "Experience":
+        return cls(**decode_batch(batch))
+
+    def record_stream(self, stream):
+        """Mark the device tensors as used by stream, when they were copied on another stream."""
+        for value in (self.sequences, self.action_log_probs, self.returns, self.advantages, self.values):
+            record_stream(value, stream)
+        for value in (self.attention_mask, self.action_mask, self.kl):
+            record_stream(value, stream)
+        for value in self.info.values():
+            record_stream(value, stream)
+        if self.visual_inputs is not None:
+            for value in self.visual_inputs.values():
+                record_stream(value, stream)
+        return self
+
 
 @dataclass
 class Samples:
@@ -112,6 +154,7 @@ class Samples:
     total_length: (B,), the total number of tokens in the sequences.
     prompts: the prompts used to generate responses
     visual_inputs: the visual input for vlm training
+    reward_futures: futures of the remote RM scores, one per url, submitted right after generation
     """
 
     sequences: torch.Tensor
@@ -123,6 +166,7 @@ class Samples:
     total_length: torch.Tensor
     prompts: list[str]
     visual_inputs: Optional[Dict]
+    reward_futures: Optional[list] = None
 
 
 class NaiveExperienceMaker(ABC):
@@ -159,6 +203,10 @@ class NaiveExperienceMaker(ABC):
         self.perf_stats = None
         self.advantage_estimator = strategy.args.advantage_estimator
 
+        # encode the images once with the actor's frozen vision tower and reuse the embeddings
+        self.cache_vision_embeds = data_processor is not None and getattr(strategy.args, "cache_vision_embeds", False)
+        self.vision_stats = {"encoded_patches": 0, "skipped_patches": 0}
+
         # custom reward func for reinforced finetuning
         self.custom_reward_func = None
         if remote_rm_url and remote_rm_url[0].endswith(".py"):
@@ -190,34 +238,90 @@ class NaiveExperienceMaker(ABC):
         )
         return {k: v.to(device) for k, v in batch.items()}
 
+    def pad_token_ids(self, token_ids: List[List[int]], device=None):
+        """Pad pre-tokenized prompts into the batch tokenize_fn would return for their texts."""
+        max_len = max(len(ids) for ids in token_ids)
+        input_ids = torch.full((len(token_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(token_ids), max_len), dtype=torch.long)
+        for i, ids in enumerate(token_ids):
+            if not ids:
+                continue
+            span = slice(max_len - len(ids), None) if self.tokenizer.padding_side == "left" else slice(0, len(ids))
+            input_ids[i, span] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, span] = 1
+        return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+    def _encode_images(self, visual_inputs: Optional[dict]) -> Optional[dict]:
+        """
+        With --cache_vision_embeds, add the actor's image_embeds to the visual inputs of a micro-batch.
+        The actor and reference model use them in place of their vision towers, in make_experience
+        and in every training epoch.
+        """
+        if not self.cache_vision_embeds or not visual_inputs or visual_inputs.get("pixel_values") is None:
+            return visual_inputs
+        visual_inputs = self.actor.encode_images(visual_inputs)
+
+        # patches the vision towers would have encoded otherwise: actor, reference and every epoch
+        encoded = visual_inputs["image_grid_thw"].prod(dim=-1)
+        image_index = visual_inputs.get("image_index")
+        used = encoded if image_index is None else encoded[image_index]
+        num_passes = 1 + (self.initial_model is not None) + self.strategy.args.max_epochs
+        self.vision_stats["encoded_patches"] += encoded.sum().item()
+        self.vision_stats["skipped_patches"] += num_passes * used.sum().item() - encoded.sum().item()
+        return visual_inputs
+
+    @staticmethod
+    def _drop_visual_input(visual_inputs: Optional[dict], key: str) -> Optional[dict]:
+        if not visual_inputs or key not in visual_inputs:
+            return visual_inputs
+        return {k: v for k, v in visual_inputs.items() if k != key}
+
+    def _experience_visual_inputs(self, visual_inputs: Optional[dict]) -> Optional[dict]:
+        # training only needs pixel_values if the critic encodes them, the actor has image_embeds
+        if self.critic is None and visual_inputs and "image_embeds" in visual_inputs:
+            return self._drop_visual_input(visual_inputs, "pixel_values")
+        return visual_inputs
+
     @torch.no_grad()
-    def make_experience_list(self, all_prompts: Union[str, List[str]], **generate_kwargs) -> List[Experience]:
+    def make_experience_list(
+        self, all_prompts: Union[str, List[str]], all_prompt_token_ids: List[List[int]] = None, **generate_kwargs
+    ) -> List[Experience]:
         """
         Make a list of experience with the micro_rollout_batch_size.
 
         This method will first calculate the response sequences and rewards for the given prompts.
         Then, if we need certain processing for the rewards or do certain filtering, we can process the rollout as a whole.
         After that, we will calculate the advantages and returns for each experience.
+
+        all_prompt_token_ids are the token ids of all_prompts when the dataset pre-tokenized them,
+        in which case the prompts are not tokenized again.
         """
-        args = self.strategy.args
         # generate responses
-        samples_list = self.generate_samples(all_prompts, **generate_kwargs)
-        torch.distributed.barrier()
+        with trace_span("generate_samples"):
+            samples_list = self.generate_samples(all_prompts, all_prompt_token_ids, **generate_kwargs)
+            torch.distributed.barrier()
 
-        experiences = []
-        for samples in tqdm(
-            samples_list,
-            desc="make_experience",
-            disable=not self.strategy.is_rank_0(),
-        ):
-            experiences.append(self.make_experience(samples).to_device("cpu"))
+        with trace_span("make_experiences"):
+            experiences = self.make_experiences(samples_list)
+
+        with trace_span("process_experiences"):
+            experiences, rewards = self.process_experiences(experiences)
 
-        experiences, rewards = self.process_experiences(experiences)
+        with trace_span("compute_advantages"):
+            return self.compute_advantages_and_returns(experiences, rewards, **generate_kwargs)
 
-        # calculate return and advantages
+    @torch.no_grad()
+    def compute_advantages_and_returns(
+        self, experiences: List[Experience], rewards: List[torch.Tensor], device="cuda", **generate_kwargs
+    ) -> List[Experience]:
+        """
+        Shape the rewards with the KL penalty and fill in the advantages and returns of every experience,
+        computed on device. The experiences are moved back to CPU.
+        """
+        args = self.strategy.args
         for experience, reward in zip(experiences, rewards):
-            experience = experience.to_device("cuda")
-            reward = reward.to(device="cuda")
+            experience = experience.to_device(device)
+            reward = reward.to(device=device)
             num_actions = experience.info["num_actions"]
             reward = compute_reward(
                 reward,
@@ -250,9 +354,7 @@ class NaiveExperienceMaker(ABC):
             if not getattr(self, "packing_samples", False):
                 return_sums = reward.sum(dim=-1)
             else:
-                return_sums = torch.tensor(
-                    [each_reward.sum() for each_reward in reward], device=torch.cuda.current_device()
-                )
+                return_sums = torch.tensor([each_reward.sum() for each_reward in reward], device=device)
             experience.info["return"] = return_sums
             # remove unnecessary info
             experience.kl = None
@@ -261,7 +363,24 @@ class NaiveExperienceMaker(ABC):
         return experiences
 
     @torch.no_grad()
-    def generate_samples(self, all_prompts: List[str], **generate_kwargs) -> List[Samples]:
+    def make_experiences(self, samples_list: List[Samples]) -> List[Experience]:
+        """
+        Turn every micro-batch of samples into an experience on CPU, in order.
+        """
+        experiences = []
+        for samples in tqdm(
+            samples_list,
+            desc="make_experience",
+            disable=not self.strategy.is_rank_0(),
+        ):
+            with trace_span("make_experience"):
+                experiences.append(self.make_experience(samples).to_device("cpu"))
+        return experiences
+
+    @torch.no_grad()
+    def generate_samples(
+        self, all_prompts: List[str], all_prompt_token_ids: List[List[int]] = None, **generate_kwargs
+    ) -> List[Samples]:
         """
         Generate samples and return in batches.
         """
@@ -269,7 +388,9 @@ class NaiveExperienceMaker(ABC):
         args = self.strategy.args
         self.actor.eval()
         # sample multiple response
-        all_prompts = sum([[prompt] * args.n_samples_per_prompt for prompt in all_prompts], [])
+        all_prompts = [prompt for prompt in all_prompts for _ in range(args.n_samples_per_prompt)]
+        if all_prompt_token_ids is not None:
+            all_prompt_token_ids = [ids for ids in all_prompt_token_ids for _ in range(args.n_samples_per_prompt)]
         samples_list = []
         for i in range(0, len(all_prompts), args.micro_rollout_batch_size):
             prompts = all_prompts[i : i + args.micro_rollout_batch_size]
@@ -279,6 +400,9 @@ class NaiveExperienceMaker(ABC):
                 for k,v in inputs.items():
                     if k not in ["input_ids", "attention_mask"]:
                         visual_inputs[k] = v
+            elif all_prompt_token_ids is not None:
+                inputs = self.pad_token_ids(all_prompt_token_ids[i : i + args.micro_rollout_batch_size], device="cuda")
+                visual_inputs = None
             else:
                 inputs = self.tokenize_fn(prompts, self.prompt_max_len, device="cuda")
                 visual_inputs = None
@@ -316,20 +440,23 @@ class NaiveExperienceMaker(ABC):
         attention_mask = samples.attention_mask
         action_mask = samples.action_mask
         num_actions = samples.num_actions
-        visual_inputs = samples.visual_inputs
+        visual_inputs = self._encode_images(samples.visual_inputs)
 
         # log probs
-        action_log_probs = self.actor(sequences, num_actions, attention_mask, visual_inputs)
+        action_log_probs = self.actor(sequences, num_actions, attention_mask, visual_inputs=visual_inputs)
 
         # init log probs
         if self.initial_model is not None:
-            base_action_log_probs = self.initial_model(sequences, num_actions, attention_mask, visual_inputs)
+            base_action_log_probs = self.initial_model(
+                sequences, num_actions, attention_mask, visual_inputs=visual_inputs
+            )
         else:
             base_action_log_probs = None
 
         # values
         if self.critic is not None:
-            value = self.critic(sequences, num_actions, attention_mask, visual_inputs)
+            critic_visual_inputs = self._drop_visual_input(visual_inputs, "image_embeds")
+            value = self.critic(sequences, num_actions, attention_mask, visual_inputs=critic_visual_inputs)
         else:
             value = None
 
@@ -379,6 +506,7 @@ class NaiveExperienceMaker(ABC):
             action_mask,
             info,
             kl,
+            visual_inputs=self._experience_visual_inputs(visual_inputs),
         )
 
     @torch.no_grad()
@@ -394,18 +522,18 @@ class NaiveExperienceMaker(ABC):
         # reward shaping for rloo and reinforce_baseline
         if args.advantage_estimator == "rloo":
             rewards = torch.cat([experience.info["reward"] for experience in experiences])
-            rewards = rewards.reshape(-1, args.n_samples_per_prompt).to(device="cuda")
+            rewards = rewards.reshape(-1, args.n_samples_per_prompt)
             baseline = (rewards.sum(-1, keepdim=True) - rewards) / (args.n_samples_per_prompt - 1)
             rewards = rewards - baseline
-            rewards = rewards.flatten().to(device="cpu").chunk(len(experiences))
+            rewards = rewards.flatten().chunk(len(experiences))
             return experiences, rewards
         elif args.advantage_estimator == "reinforce_baseline":
             # REINFORCE++-baseline removed the / std and K3 kl loss in GRPO.
             # `/ std` is not needed in RL variance reduction theory, and `k3 KL` has a larger variance than `k1 KL` under a categorical distribution.
             rewards = torch.cat([experience.info["reward"] for experience in experiences])
-            rewards = rewards.reshape(-1, args.n_samples_per_prompt).to(device="cuda")
+            rewards = rewards.reshape(-1, args.n_samples_per_prompt)
             rewards = rewards - rewards.mean(-1, keepdim=True)
-            rewards = rewards.reshape(-1).to(device="cpu").chunk(len(experiences))
+            rewards = rewards.reshape(-1).chunk(len(experiences))
             return experiences, rewards
 
         # default rewards
@@ -433,41 +561,14 @@ class NaiveExperienceMaker(ABC):
                    + γ * (1 - λ) V2 + γ^2 * λ * (1 - λ) V3 + ...
 
         Input:
-        - values: Tensor of shape (batch_size, response_size)
-        - rewards: Tensor of shape (batch_size, response_size)
+        - values: Tensor of shape (batch_size, response_size), or a list of (response_size_i,) when packing samples
+        - rewards: Tensor of shape (batch_size, response_size), or a list of (response_size_i,) when packing samples
 
         Output:
         - advantages: Tensor of shape (batch_size, response_size)
         - returns: Tensor of shape (batch_size, response_size)
         """
-        if isinstance(values, list):
-            # packing samples
-            # TODO: this is slow...
-            advantages = []
-            returns = []
-            for v, r in zip(values, rewards):
-                adv, ret = self.get_advantages_and_returns(v.unsqueeze(0), r.unsqueeze(0), action_mask, gamma, lambd)
-                advantages.append(adv.squeeze(0))
-                returns.append(ret.squeeze(0))
-            return advantages, returns
-
-        lastgaelam = 0
-        advantages_reversed = []
-        response_length = rewards.size(1)
-
-        # Mask invalid responses
-        if action_mask is not None:
-            values = action_mask * values
-            rewards = action_mask * rewards
-
-        for t in reversed(range(response_length)):
-            nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
-            delta = rewards[:, t] + gamma * nextvalues - values[:, t]
-            lastgaelam = delta + gamma * lambd * lastgaelam
-            advantages_reversed.append(lastgaelam)
-        advantages = torch.stack(advantages_reversed[::-1], dim=1)
-        returns = advantages + values
-        return advantages.detach(), returns
+        return compute_gae(values, rewards, action_mask, gamma, lambd)
 
     @torch.no_grad()
     def get_cumulative_returns(
@@ -481,37 +582,14 @@ class NaiveExperienceMaker(ABC):
         REINFORCE uses cumulative returns without the GAE (Generalized Advantage Estimation).
 
         Input:
-        - rewards: Tensor of shape (batch_size, response_size)
+        - rewards: Tensor of shape (batch_size, response_size), or a list of (response_size_i,) when packing samples
         - action_mask: Tensor of shape (batch_size, response_size), binary mask
         - gamma: discount factor
 
         Output:
         - returns: Tensor of shape (batch_size, response_size)
         """
-
-        if isinstance(rewards, list):
-            # packing samples
-            # TODO: this is slow...
-            returns = []
-            for r in rewards:
-                ret = self.get_cumulative_returns(r.unsqueeze(0), action_mask, gamma)
-                returns.append(ret.squeeze(0))
-            return returns
-
-        response_length = rewards.size(1)
-        returns = torch.zeros_like(rewards)
-        cumulative_return = torch.zeros(rewards.size(0), device=rewards.device)
-
-        # Mask invalid responses if action_mask is provided
-        if action_mask is not None:
-            rewards = action_mask * rewards
-
-        # Calculate returns by accumulating discounted rewards
-        for t in reversed(range(response_length)):
-            cumulative_return = rewards[:, t] + gamma * cumulative_return
-            returns[:, t] = cumulative_return
-
-        return returns
+        return compute_cumulative_returns(rewards, action_mask, gamma)
 
 
 class RemoteExperienceMaker(NaiveExperienceMaker):
@@ -519,29 +597,97 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
         super().__init__(*args, **kwargs)
         self.vllm_engines = vllm_engines
         self.packing_samples = packing_samples
+        # experiences and model inputs are sent to the other Ray actors as compact WireBatches
+        self.compact_wire = not getattr(self.strategy.args, "disable_compact_wire", False)
+        self.wire_stats = {"raw_bytes": 0, "sent_bytes": 0}
+
+        self.vllm_router = None
+        if vllm_engines is not None and getattr(self.strategy.args, "vllm_prefix_routing", False):
+            self.vllm_router = PrefixAffinityRouter(
+                len(vllm_engines), prefix_len=getattr(self.strategy.args, "vllm_routing_prefix_len", 128)
+            )
 
         if self.custom_reward_func:
             self.custom_reward_func = ray.remote(self.custom_reward_func)
 
+        self.remote_rm_client = None
+        if self.remote_rm_url and not self.custom_reward_func:
+            args = self.strategy.args
+            self.remote_rm_client = RemoteRewardClient(
+                self.remote_rm_url,
+                batch_size=getattr(args, "remote_rm_batch_size", 0),
+                max_concurrency=getattr(args, "remote_rm_max_concurrency", 8),
+                timeout=getattr(args, "remote_rm_timeout", 180),
+                max_retries=getattr(args, "remote_rm_max_retries", 5),
+                hedge_delay=getattr(args, "remote_rm_hedge_delay", None),
+            )
+
     @torch.no_grad()
-    def make_experience_list(self, all_prompts: Union[str, List[str]], **generate_kwargs) -> List[Experience]:
+    def make_experience_list(
+        self, all_prompts: Union[str, List[str]], all_prompt_token_ids: List[List[int]] = None, **generate_kwargs
+    ) -> List[Experience]:
         if self.strategy.args.perf:
             self.perf_stats = {
                 "generate_time": 0,
                 "actor_value_rm_time": 0,
                 "wait_time": 0,
             }
-        experiences = super().make_experience_list(all_prompts, **generate_kwargs)
+        experiences = super().make_experience_list(all_prompts, all_prompt_token_ids, **generate_kwargs)
+        if self.perf_stats is not None and self.remote_rm_client is not None:
+            self.perf_stats.update(self.remote_rm_client.get_stats())
+        if self.perf_stats is not None and self.vllm_router is not None:
+            self.perf_stats.update({f"vllm_router/{k}": v for k, v in self.vllm_router.stats().items()})
+            if self.strategy.args.enable_prefix_caching:
+                hit_rates = ray.get([engine.get_prefix_cache_hit_rate.remote() for engine in self.vllm_engines])
+                self.perf_stats.update({f"vllm_router/engine_{e}_cache_hit": r for e, r in enumerate(hit_rates)})
+        if self.perf_stats is not None and self.data_processor is not None and self.data_processor.vision_cache:
+            vision_cache_stats = self.data_processor.vision_cache.stats()
+            self.perf_stats.update({f"vision_cache/{k}": v for k, v in vision_cache_stats.items()})
+        if self.perf_stats is not None and self.cache_vision_embeds:
+            encoded, skipped = self.vision_stats["encoded_patches"], self.vision_stats["skipped_patches"]
+            self.perf_stats["vision_embeds/encoded_patches"] = encoded
+            self.perf_stats["vision_embeds/skipped_patches"] = skipped
+            self.perf_stats["vision_embeds/saved_ratio"] = skipped / max(encoded + skipped, 1)
+            self.vision_stats = {"encoded_patches": 0, "skipped_patches": 0}
         if self.critic is not None:
             for experience in experiences:
                 # send experience to critic
-                experience_cpu = deepcopy(experience)
-                experience_cpu.to_device("cpu")
-                self._ref = self.critic.append.remote(experience_cpu)
+                # the critic encodes pixel_values with its own vision tower
+                critic_visual_inputs = self._drop_visual_input(experience.visual_inputs, "image_embeds")
+                if self.compact_wire:
+                    # the experiences are already on the CPU, the fields the critic does not read are sent as bf16
+                    experience_wire = copy(experience)
+                    experience_wire.visual_inputs = critic_visual_inputs
+                    experience_wire = experience_wire.to_wire(lossy_keys=CRITIC_LOSSY_KEYS)
+                    self._count_wire(experience_wire.raw_nbytes, experience_wire.nbytes)
+                    self._ref = self.critic.append.remote(experience_wire)
+                else:
+                    experience_cpu = deepcopy(experience)
+                    experience_cpu.visual_inputs = critic_visual_inputs
+                    experience_cpu.to_device("cpu")
+                    if self.perf_stats is not None:
+                        experience_bytes = nbytes(experience_cpu.__dict__)
+                        self._count_wire(experience_bytes, experience_bytes)
+                    self._ref = self.critic.append.remote(experience_cpu)
+        if self.perf_stats is not None:
+            raw_bytes, sent_bytes = self.wire_stats["raw_bytes"], self.wire_stats["sent_bytes"]
+            self.perf_stats["wire/raw_mb"] = raw_bytes / 2**20
+            self.perf_stats["wire/sent_mb"] = sent_bytes / 2**20
+            self.perf_stats["wire/saved_ratio"] = 1 - sent_bytes / max(raw_bytes, 1)
+        self.wire_stats = {"raw_bytes": 0, "sent_bytes": 0}
         return experiences
 
+    def _count_wire(self, raw_bytes: int, sent_bytes: int):
+        # tensor bytes sent to the other actors, and what they would be without the compact encoding
+        if self.perf_stats is None:
+            return
+        self.wire_stats["raw_bytes"] += raw_bytes
+        self.wire_stats["sent_bytes"] += sent_bytes
+
     @torch.no_grad()
-    def generate_samples(self, all_prompts: List[str], **generate_kwargs) -> List[Samples]:
+    def generate_samples(
+        self, all_prompts: List[str], all_prompt_token_ids: List[List[int]] = None, **generate_kwargs
+    ) -> List[Samples]:
         """
         Generate samples and return in batches.
 
@@ -549,10 +695,21 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
         in which actor will be used to generate samples.
         """
         if self.vllm_engines is None:
-            return super().generate_samples(all_prompts, **generate_kwargs)
+            return super().generate_samples(all_prompts, all_prompt_token_ids, **generate_kwargs)
+
+        if getattr(self.strategy.args, "vllm_async_engine", False):
+            return self._stream_samples(all_prompts, all_prompt_token_ids, **generate_kwargs)
 
         # vLLM generation
-        samples = self._generate_vllm(all_prompts, **generate_kwargs)
+        start = time.time()
+        samples = self._generate_vllm(all_prompts, all_prompt_token_ids, **generate_kwargs)
+        if self.perf_stats is not None:
+            self.perf_stats["generate_time"] += time.time() - start
+
+        # score all micro-batches in the background while experiences are being made
+        if self.remote_rm_client is not None:
+            for s in samples:
+                s.reward_futures = self.remote_rm_client.submit(self._decode_queries(s), s.prompts)
 
         # vLLM offload when colocate_all_models
         if self.strategy.args.vllm_enable_sleep:
@@ -563,35 +720,100 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
                 ray.get(refs)
         return samples
 
+    @torch.no_grad()
+    def _stream_samples(
+        self, all_prompts: List[str], all_prompt_token_ids: List[List[int]] = None, **generate_kwargs
+    ) -> Iterator[Samples]:
+        """
+        Yield micro-batches while the vLLM engines are still generating the rest, so that make_experience
+        overlaps the reference, critic and reward work with the long tail of decoding.
+        """
+        for samples in self._stream_vllm(all_prompts, all_prompt_token_ids, **generate_kwargs):
+            if self.remote_rm_client is not None:
+                samples.reward_futures = self.remote_rm_client.submit(self._decode_queries(samples), samples.prompts)
+            yield samples
+
+    @torch.no_grad()
+    def make_experiences(self, samples_list: List[Samples]) -> List[Experience]:
+        """
+        Pipelined make_experience: the reference, critic and reward requests of up to
+        experience_pipeline_depth micro-batches are in flight while the actor computes log probs
+        of the oldest one. Experiences are collected in order. Colocated models share GPUs and are
+        serialized by make_experience, so they fall back to the serial loop.
+        """
+        args = self.strategy.args
+        depth = getattr(args, "experience_pipeline_depth", 1)
+        colocated = args.colocate_actor_ref or args.colocate_critic_reward or args.colocate_all_models
+        if depth <= 1 or colocated:
+            return super().make_experiences(samples_list)
+
+        start = time.time()
+        experiences = []
+        in_flight = deque()
+        for samples in tqdm(
+            samples_list,
+            desc="make_experience",
+            disable=not self.strategy.is_rank_0(),
+        ):
+            in_flight.append((samples, self._submit_experience(samples)))
+            if len(in_flight) == depth:
+                experiences.append(self._collect_experience(*in_flight.popleft()).to_device("cpu"))
+        while in_flight:
+            experiences.append(self._collect_experience(*in_flight.popleft()).to_device("cpu"))
+
+        if self.perf_stats is not None:
+            make_experience_time = time.time() - start
+            self.perf_stats["pipeline_depth"] = depth
+            self.perf_stats["make_experience_time"] = make_experience_time
+            # share of the loop not spent blocked on remote results
+            self.perf_stats["overlap_ratio"] = 1 - self.perf_stats["wait_time"] / max(make_experience_time, 1e-6)
+        return experiences
+
     @torch.no_grad()
     def make_experience(self, samples: Samples) -> Experience:
         """
         Turn samples into experience by calculating logprobs, values, rewards, and kl divergence.
         """
+        return self._collect_experience(samples, self._submit_experience(samples))
+
+    @traced("submit_experience")
+    def _submit_experience(self, samples: Samples) -> dict:
+        """
+        Send samples to the reference, critic and reward models, returns the pending refs.
+        """
         args = self.strategy.args
-        self.actor.eval()
-        device = torch.cuda.current_device()
 
         # extract values from samples
         sequences = samples.sequences
         attention_mask = samples.attention_mask
-        action_mask = samples.action_mask
         num_actions = samples.num_actions
         packed_seq_lens = samples.packed_seq_lens
-        visual_inputs = samples.visual_inputs
 
         start = time.time()
-        sequences_cpu, attention_mask_cpu = (
-            sequences.to("cpu"),
-            attention_mask.to("cpu"),
-        )
+        visual_inputs = samples.visual_inputs = self._encode_images(samples.visual_inputs)
         visual_inputs_cpu = None
         if visual_inputs is not None:
-            visual_inputs_cpu = {k: v.to("cpu") for k, v in visual_inputs.items()}        
+            visual_inputs_cpu = {k: v.to("cpu") for k, v in visual_inputs.items()}
+        # the reference model shares the actor's frozen vision tower, critic and reward models have their own
+        ref_visual_inputs = visual_inputs_cpu
+        if visual_inputs_cpu and "image_embeds" in visual_inputs_cpu:
+            ref_visual_inputs = self._drop_visual_input(visual_inputs_cpu, "pixel_values")
+        visual_inputs_cpu = self._drop_visual_input(visual_inputs_cpu, "image_embeds")
+        if not self.compact_wire:
+            sequences, attention_mask = sequences.to("cpu"), attention_mask.to("cpu")
+        num_ref_models = int(self.initial_model is not None)
+        num_models = int(self.critic is not None) + (0 if self.remote_rm_url else len(self.reward_model))
+        if ref_visual_inputs is visual_inputs_cpu:
+            ref_inputs = model_inputs = self._model_inputs(
+                sequences, attention_mask, visual_inputs_cpu, num_ref_models + num_models
+            )
+        else:
+            ref_inputs = self._model_inputs(sequences, attention_mask, ref_visual_inputs, num_ref_models)
+            model_inputs = self._model_inputs(sequences, attention_mask, visual_inputs_cpu, num_models)
         # init log probs
         if self.initial_model is not None:
             base_action_log_probs_ref = self.initial_model.forward.remote(
-                sequences_cpu, num_actions, attention_mask_cpu, packed_seq_lens=packed_seq_lens,visual_inputs=visual_inputs_cpu
+                num_actions=num_actions, packed_seq_lens=packed_seq_lens, **ref_inputs
             )
 
             if args.colocate_actor_ref or args.colocate_all_models:
@@ -603,7 +825,7 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
         # values
         if self.critic is not None:
             value_ref = self.critic.forward.remote(
-                sequences_cpu, num_actions, attention_mask_cpu, packed_seq_lens=packed_seq_lens, visual_inputs=visual_inputs_cpu
+                num_actions=num_actions, packed_seq_lens=packed_seq_lens, **model_inputs
             )
             # avoid CUDA OOM when colocate models
             if args.colocate_critic_reward or args.colocate_all_models:
@@ -617,39 +839,75 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
         # support remote RM API with ray
         if not self.remote_rm_url:
             for rm in self.reward_model:
-                r_refs.append(rm.forward.remote(sequences_cpu, attention_mask_cpu, packed_seq_lens=packed_seq_lens, visual_inputs=visual_inputs_cpu))
-        else:
+                r_refs.append(rm.forward.remote(packed_seq_lens=packed_seq_lens, **model_inputs))
+        elif self.custom_reward_func:
+            queries = self._decode_queries(samples)
+            r_refs.append(self.custom_reward_func.remote(queries, samples.prompts))
+        elif samples.reward_futures is None:
             # remote RM
-            if not self.packing_samples:
-                queries = self.tokenizer.batch_decode(sequences_cpu, skip_special_tokens=False)
-            else:
-                sequences_list = []
-                offset = 0
-                tokens_list = sequences_cpu.tolist()[0]
-                for length in packed_seq_lens:
-                    sequences_list.append(tokens_list[offset : offset + length])
-                    offset += length
-                queries = self.tokenizer.batch_decode(sequences_list, skip_special_tokens=False)
-
-            if self.custom_reward_func:
-                r = self.custom_reward_func.remote(queries, samples.prompts)
-                r_refs.append(r)
-            else:
-                for rm in self.remote_rm_url:
-                    r = remote_rm_fn_ray.remote(rm, queries=queries, prompts=samples.prompts)
-                    r_refs.append(r)
+            samples.reward_futures = self.remote_rm_client.submit(self._decode_queries(samples), samples.prompts)
 
         if args.colocate_all_models and not self.remote_rm_url:
             ray.get(r_refs)
             ray.get([self.reward_model[0].empty_cache.remote()])
 
+        return {
+            "base_action_log_probs_ref": base_action_log_probs_ref,
+            "value_ref": value_ref,
+            "r_refs": r_refs,
+            "submit_time": time.time() - start,
+        }
+
+    def _model_inputs(self, sequences, attention_mask, visual_inputs, num_models: int) -> Optional[dict]:
+        """
+        Keyword arguments for the forward of num_models remote models. With the compact wire format, the
+        inputs are encoded into one WireBatch put once in the object store, and decoded by the models.
+        """
+        if num_models == 0:
+            return None
+        if not self.compact_wire:
+            inputs = {"sequences": sequences, "attention_mask": attention_mask, "visual_inputs": visual_inputs}
+            if self.perf_stats is not None:
+                # every remote call serializes its own copy of the tensors
+                self._count_wire(nbytes(inputs) * num_models, nbytes(inputs) * num_models)
+            return inputs
+        batch = encode_model_inputs(sequences, attention_mask, visual_inputs)
+        self._count_wire(batch.raw_nbytes * num_models, batch.nbytes)
+        return {"sequences": ray.put(batch), "attention_mask": None, "visual_inputs": None}
+
+    def _collect_experience(self, samples: Samples, refs: dict) -> Experience:
+        """
+        Compute the actor log probs of samples and combine them with the results of _submit_experience.
+        """
+        args = self.strategy.args
+        self.actor.eval()
+        device = torch.cuda.current_device()
+
+        sequences = samples.sequences
+        attention_mask = samples.attention_mask
+        action_mask = samples.action_mask
+        num_actions = samples.num_actions
+        packed_seq_lens = samples.packed_seq_lens
+        base_action_log_probs_ref, value_ref, r_refs = refs["base_action_log_probs_ref"], refs["value_ref"], refs["r_refs"]
+
         # log probs
-        action_log_probs = self.actor(sequences, num_actions, attention_mask, packed_seq_lens=packed_seq_lens)
-        actor_value_rm_time = time.time() - start
+        start = time.time()
+        with trace_span("actor_forward"):
+            action_log_probs = self.actor(
+                sequences,
+                num_actions,
+                attention_mask,
+                packed_seq_lens=packed_seq_lens,
+                visual_inputs=samples.visual_inputs,
+            )
+        actor_value_rm_time = refs["submit_time"] + time.time() - start
 
         # wait initial/critic/reward model done
         start = time.time()
-        ref_values = ray.get([base_action_log_probs_ref, value_ref] + r_refs)
+        with trace_span("wait_remote_models"):
+            ref_values = ray.get([base_action_log_probs_ref, value_ref] + r_refs)
+            if samples.reward_futures is not None:
+                ref_values.extend(future.result() for future in samples.reward_futures)
         wait_time = time.time() - start
 
         base_action_log_probs, value, rewards = ref_values[0], ref_values[1], ref_values[2:]
@@ -713,26 +971,145 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             action_mask,
             info,
             kl,
+            visual_inputs=self._experience_visual_inputs(samples.visual_inputs),
         )
 
         self.actor.train()  # reset model state
         return experience
 
-    def _generate_vllm(self, all_prompts: List[str], **kwargs) -> List[Samples]:
+    def _decode_queries(self, samples: Samples) -> List[str]:
+        sequences_cpu = samples.sequences.to("cpu")
+        if not self.packing_samples:
+            return self.tokenizer.batch_decode(sequences_cpu, skip_special_tokens=False)
+
+        sequences_list = []
+        offset = 0
+        tokens_list = sequences_cpu.tolist()[0]
+        for length in samples.packed_seq_lens:
+            sequences_list.append(tokens_list[offset : offset + length])
+            offset += length
+        return self.tokenizer.batch_decode(sequences_list, skip_special_tokens=False)
+
+    def _generate_vllm(
+        self, all_prompts: List[str], all_prompt_token_ids: List[List[int]] = None, **kwargs
+    ) -> List[Samples]:
+        rank = torch.distributed.get_rank()
+        args = self.strategy.args
+
+        # every prompt is sent once and sampled n_samples_per_prompt times by vLLM
+        llms, assignments = self._send_vllm_requests(all_prompts, all_prompt_token_ids, **kwargs)
+
+        # Make sure all requests are sent.
+        torch.distributed.barrier()
+
+        # Retrieve and combine results from all outputs
+        all_output_refs = []
+        for i, llm in enumerate(llms):
+            all_output_refs.append(llm.get_responses.remote(rank))
+        prompt_outputs = [None] * len(all_prompts)
+        for indices, outputs in zip(assignments, ray.get(all_output_refs)):
+            for j, output in zip(indices, outputs):
+                prompt_outputs[j] = output
+        all_outputs = [sample for output in prompt_outputs for sample in self._split_n_outputs(output)]
+        if self.vllm_router is not None:
+            self._observe_response_lengths(prompt_outputs)
+
+        # Expand prompt list based on the number of samples per prompt
+        all_prompts = [prompt for prompt in all_prompts for _ in range(args.n_samples_per_prompt)]
+        samples_list = []
+        for i in range(0, len(all_outputs), args.micro_rollout_batch_size):
+            outputs = all_outputs[i : i + self.strategy.args.micro_rollout_batch_size]
+            prompts = all_prompts[i : i + self.strategy.args.micro_rollout_batch_size]
+            samples_list.append(self._outputs_to_samples(outputs, prompts))
+        return samples_list
+
+    def _stream_vllm(
+        self, all_prompts: List[str], all_prompt_token_ids: List[List[int]] = None, **kwargs
+    ) -> Iterator[Samples]:
+        """
+        Streaming counterpart of _generate_vllm for LLMRayActorAsync engines.
+
+        Outputs are pulled as they finish and a micro-batch is yielded as soon as enough of them are available.
+        A request carries all n_samples_per_prompt responses of its prompt, so the samples of a prompt stay
+        contiguous for the group-wise reward shaping in process_experiences.
+        """
+        rank = torch.distributed.get_rank()
+        micro_batch_size = self.strategy.args.micro_rollout_batch_size
+        start = time.time()
+        llms, assignments = self._send_vllm_requests(all_prompts, all_prompt_token_ids, **kwargs)
+
+        remaining = [len(indices) for indices in assignments]
+        pending = {llms[i].pull_responses.remote(rank): i for i in range(len(llms)) if remaining[i] > 0}
+        prompt_outputs = []
+        ready = []
+        while pending:
+            [ref], _ = ray.wait(list(pending), num_returns=1)
+            i = pending.pop(ref)
+            responses = ray.get(ref)
+            if self.perf_stats is not None:
+                # time spent submitting and waiting on the engines, not on the yielded micro-batches
+                self.perf_stats["generate_time"] += time.time() - start
+            remaining[i] -= len(responses)
+            if remaining[i] > 0:
+                pending[llms[i].pull_responses.remote(rank)] = i
+
+            for index, output in responses:
+                prompt = all_prompts[assignments[i][index]]
+                ready.extend((sample, prompt) for sample in self._split_n_outputs(output))
+                prompt_outputs.append(output)
+
+            while len(ready) >= micro_batch_size:
+                batch, ready = ready[:micro_batch_size], ready[micro_batch_size:]
+                yield self._outputs_to_samples([sample for sample, _ in batch], [prompt for _, prompt in batch])
+            start = time.time()
+
+        if ready:
+            yield self._outputs_to_samples([sample for sample, _ in ready], [prompt for _, prompt in ready])
+        if self.vllm_router is not None:
+            self._observe_response_lengths(prompt_outputs)
+
+    def _observe_response_lengths(self, prompt_outputs):
+        """Feed the mean response length of every prompt back to the router's decode length estimates."""
+        if self.data_processor is None:
+            prompts = [list(output.prompt_token_ids) for output in prompt_outputs]
+        else:
+            prompts = [output.prompt for output in prompt_outputs]
+        response_lengths = [
+            sum(len(c.token_ids) for c in output.outputs) / len(output.outputs) for output in prompt_outputs
+        ]
+        self.vllm_router.observe(prompts, response_lengths)
+
+    @staticmethod
+    def _split_n_outputs(output):
+        """Split a vLLM RequestOutput with n completions into n outputs of one completion each."""
+        samples = []
+        for completion in output.outputs:
+            sample = copy(output)
+            sample.outputs = [completion]
+            samples.append(sample)
+        return samples
+
+    def _send_vllm_requests(self, all_prompts: List[str], all_prompt_token_ids: List[List[int]] = None, **kwargs):
+        """
+        Split the prompts of this rank over vLLM engines and send each of them once,
+        to be sampled n_samples_per_prompt times.
+
+        Returns the engines and, for every engine, the indices of the prompts sent to it.
+        """
         from vllm import SamplingParams
 
-        # round-robin load balance
         rank = torch.distributed.get_rank()
         world_size = torch.distributed.get_world_size()
 
+        if self.vllm_router is not None:
+            # every rank sends to every engine, which create_vllm_engines expects with prefix routing
+            llms = self.vllm_engines
         # Select LLM engines: assign each rank an engine, or cycle through engines if world_size < engine_count
-        if len(self.vllm_engines) <= world_size:
+        elif len(self.vllm_engines) <= world_size:
             llms = [self.vllm_engines[rank % len(self.vllm_engines)]]
         else:
             llms = self.vllm_engines[rank::world_size]
 
-        args = self.strategy.args
-
         sampling_params = SamplingParams(
             temperature=kwargs.get("temperature", 1.0),
             top_p=kwargs.get("top_p", 1.0),
@@ -741,149 +1118,156 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             min_tokens=kwargs.get("min_new_tokens", 1),
             skip_special_tokens=kwargs.get("skip_special_tokens", False),
             include_stop_str_in_output=True,
+            n=self.strategy.args.n_samples_per_prompt,
         )
 
-        # Expand prompt list based on the number of samples per prompt
-        all_prompts = sum([[prompt] * args.n_samples_per_prompt for prompt in all_prompts], [])
-        batch_size = (len(all_prompts) + len(llms) - 1) // len(llms)
+        if self.data_processor is None:
+            # For LLM, unless the dataset already tokenized the prompts
+            if all_prompt_token_ids is None:
+                all_prompt_token_ids = self.tokenize_fn(all_prompts, self.prompt_max_len, padding=False)["input_ids"]
+            route_keys, prompt_lens = all_prompt_token_ids, [len(ids) for ids in all_prompt_token_ids]
+        else:
+            # For VLM
+            all_prompt_texts = self.data_processor.apply_chat_template(
+                all_prompts, tokenize=False, add_generation_prompt=True
+            )
+            route_keys = all_prompt_texts
+            if self.vllm_router is not None:
+                prompt_token_ids = self.tokenize_fn(all_prompt_texts, None, padding=False)["input_ids"]
+                prompt_lens = [len(ids) for ids in prompt_token_ids]
+
+        if self.vllm_router is not None:
+            assignments = self.vllm_router.route(
+                route_keys,
+                prompt_lens,
+                num_samples=self.strategy.args.n_samples_per_prompt,
+                decode_len=kwargs.get("max_new_tokens", 1024),
+            )
+        else:
+            # round-robin load balance
+            batch_size = (len(all_prompts) + len(llms) - 1) // len(llms)
+            assignments = [
+                list(range(i * batch_size, min((i + 1) * batch_size, len(all_prompts)))) for i in range(len(llms))
+            ]
+
         # Distribute requests to engines and collect responses to outputs
         refs = []
         if self.data_processor is None:
             # For LLM
-            all_prompt_token_ids = self.tokenize_fn(all_prompts, self.prompt_max_len, padding=False)["input_ids"]
-            for i, llm in enumerate(llms):
-                prompt_token_ids = all_prompt_token_ids[i * batch_size : (i + 1) * batch_size]
+            for llm, indices in zip(llms, assignments):
+                prompt_token_ids = [all_prompt_token_ids[j] for j in indices]
                 refs.append(
                     llm.add_requests.remote(rank, sampling_params=sampling_params, prompt_token_ids=prompt_token_ids)
                 )
         else:
             # For VLM
-            for i, llm in enumerate(llms):
-                messages = all_prompts[i * batch_size : (i + 1) * batch_size]
-                if messages:
-                    prompts = self.data_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-                    images = [self.data_processor.get_images_from_messages(m) for m in messages]
-                    vllm_inputs = [{
-                            "prompt": p,
-                            "multi_modal_data":{"image": imgs} if imgs else None,
-                            "mm_processor_kwargs": {
-                                "min_pixels": int(os.getenv("MIN_PIXELS", 4 * 28 * 28)),
-                                "max_pixels": int(os.getenv("MAX_PIXELS", 640 * 28 * 28)),
-                            },
-                        } for p, imgs in zip(prompts,images)]
-                    refs.append(
-                        llm.add_requests_vlm.remote(rank, sampling_params=sampling_params, vllm_vision_input=vllm_inputs)
-                    )
-
+            for llm, indices in zip(llms, assignments):
+                vllm_inputs = []
+                for j in indices:
+                    images = self.data_processor.get_images_from_messages(all_prompts[j])
+                    vllm_inputs.append({
+                        "prompt": all_prompt_texts[j],
+                        "multi_modal_data": {"image": images} if images else None,
+                        "mm_processor_kwargs": {
+                            "min_pixels": int(os.getenv("MIN_PIXELS", 4 * 28 * 28)),
+                            "max_pixels": int(os.getenv("MAX_PIXELS", 640 * 28 * 28)),
+                        },
+                    })
+                refs.append(
+                    llm.add_requests_vlm.remote(rank, sampling_params=sampling_params, vllm_vision_input=vllm_inputs)
+                )
 
         ray.get(refs)
+        return llms, assignments
 
-        # Make sure all requests are sent.
-        torch.distributed.barrier()
+    def _outputs_to_samples(self, outputs, prompts: List[str]) -> Samples:
+        if not self.packing_samples:
+            # NOTE: concat all outputs to following format:
+            #
+            # | [PAD] [PAD] token token token | token token [EOS] [PAD] |
+            # | token token token token token | token token [EOS] [PAD] |
+            # | [PAD] [PAD] [PAD] token token | token token token [EOS] |
+            # |<---------- prompt ----------->|<-------- answer ------->|
+            max_input_len, max_output_len = 0, 0
+            for output in outputs:
+                max_input_len = max(max_input_len, len(output.prompt_token_ids))
+                max_output_len = max(max_output_len, len(output.outputs[0].token_ids))
+
+            pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
+            sequences = []
+            for output in outputs:
+                # left padding input
+                input_len = len(output.prompt_token_ids)
+                input_ids = [pad_token_id] * (max_input_len - input_len) + list(output.prompt_token_ids)
+
+                # right padding output
+                output_len = len(output.outputs[0].token_ids)
+                output_ids = list(output.outputs[0].token_ids) + [pad_token_id] * (max_output_len - output_len)
+
+                # concat input and output
+                sequences.append(input_ids + output_ids)
+
+            sequences = torch.tensor(sequences)
+            sequences, attention_mask, action_mask = self.actor.process_sequences(
+                sequences, max_input_len, eos_token_id, pad_token_id
+            )
+            sequences = sequences.to("cuda")
+            attention_mask = attention_mask.to("cuda")
+            action_mask = action_mask.to("cuda")
+            # Collect for visual input
+            visual_inputs = None
+            if self.data_processor is not None:
+                # the samples of a prompt share one copy of its images
+                visual_inputs = self.data_processor.make_shared_visual_inputs(
+                    prompts, self.prompt_max_len, device="cuda"
+                )
 
-        # Retrieve and combine results from all outputs
-        all_output_refs = []
-        for i, llm in enumerate(llms):
-            all_output_refs.append(llm.get_responses.remote(rank))
-        all_outputs = sum(ray.get(all_output_refs), [])
+            return Samples(
+                sequences=sequences,
+                attention_mask=attention_mask,
+                action_mask=action_mask,
+                num_actions=action_mask.size(1),
+                packed_seq_lens=None,
+                response_length=action_mask.float().sum(dim=-1),
+                total_length=attention_mask.float().sum(dim=-1),
+                prompts=prompts,
+                visual_inputs=visual_inputs,
+            )
 
-        samples_list = []
-        for i in range(0, len(all_outputs), args.micro_rollout_batch_size):
-            outputs = all_outputs[i : i + self.strategy.args.micro_rollout_batch_size]
-            prompts = all_prompts[i : i + self.strategy.args.micro_rollout_batch_size]
-            if not self.packing_samples:
-                # NOTE: concat all outputs to following format:
-                #
-                # | [PAD] [PAD] token token token | token token [EOS] [PAD] |
-                # | token token token token token | token token [EOS] [PAD] |
-                # | [PAD] [PAD] [PAD] token token | token token token [EOS] |
-                # |<---------- prompt ----------->|<-------- answer ------->|
-                max_input_len, max_output_len = 0, 0
-                for output in outputs:
-                    max_input_len = max(max_input_len, len(output.prompt_token_ids))
-                    max_output_len = max(max_output_len, len(output.outputs[0].token_ids))
-
-                pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
-                sequences = []
-                for output in outputs:
-                    # left padding input
-                    input_len = len(output.prompt_token_ids)
-                    input_ids = [pad_token_id] * (max_input_len - input_len) + list(output.prompt_token_ids)
-
-                    # right padding output
-                    output_len = len(output.outputs[0].token_ids)
-                    output_ids = list(output.outputs[0].token_ids) + [pad_token_id] * (max_output_len - output_len)
-
-                    # concat input and output
-                    sequences.append(input_ids + output_ids)
-
-                sequences = torch.tensor(sequences)
-                sequences, attention_mask, action_mask = self.actor.process_sequences(
-                    sequences, max_input_len, eos_token_id, pad_token_id
-                )
-                sequences = sequences.to("cuda")
-                attention_mask = attention_mask.to("cuda")
-                action_mask = action_mask.to("cuda")
-                # Collect for visual input
-                visual_inputs = None
-                if self.data_processor is not None:
-                    visual_inputs = self.data_processor(prompts, self.prompt_max_len, device="cuda")
-                    visual_inputs.pop("input_ids")
-                    visual_inputs.pop("attention_mask")
-                    visual_inputs = {k: v.to("cuda") for k, v in visual_inputs.items()}
-
-                samples_list.append(
-                    Samples(
-                        sequences=sequences,
-                        attention_mask=attention_mask,
-                        action_mask=action_mask,
-                        num_actions=action_mask.size(1),
-                        packed_seq_lens=None,
-                        response_length=action_mask.float().sum(dim=-1),
-                        total_length=attention_mask.float().sum(dim=-1),
-                        prompts=prompts,
-                        visual_inputs=visual_inputs,
-                    )
-                )
-            else:
-                # NOTE: concat all outputs to following format:
-                #
-                # | token token token | token token [EOS] | token token token token token | token token [EOS] | token token | token token token [EOS] |
-                # |<---  prompt ----->|<---- answer ----->|<---------- prompt ----------->|<----- answer ---->|<- prompt -->|<-------- answer ------->|
-                pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
-                sequences = []
-                packed_seq_lens = []
-                attention_mask = []
-                num_actions = []
-                for i, output in enumerate(outputs):
-                    input_len = len(output.prompt_token_ids)
-                    output_len = len(output.outputs[0].token_ids)
-                    packed_seq_lens.append(input_len + output_len)
-                    sequences.extend(output.prompt_token_ids + list(output.outputs[0].token_ids))
-                    attention_mask.extend([i + 1] * (input_len + output_len))
-
-                    # current_action_mask = [0] * (input_len - 1) + [1] * output_len + [0]
-                    # num_actions.append(max(1, sum(current_action_mask)))
-                    num_actions.append(max(1, output_len))
-
-                sequences = torch.tensor(sequences, device="cuda").unsqueeze(0)
-                attention_mask = torch.tensor(attention_mask, device="cuda").unsqueeze(0)
-                action_mask = None
-                response_length = torch.tensor(num_actions, device="cuda", dtype=torch.float)
-                total_length = torch.tensor(packed_seq_lens, device="cuda", dtype=torch.float)
-                samples_list.append(
-                    Samples(
-                        sequences=sequences,
-                        attention_mask=attention_mask,
-                        action_mask=None,
-                        num_actions=num_actions,
-                        packed_seq_lens=packed_seq_lens,
-                        response_length=response_length,
-                        total_length=total_length,
-                        prompts=prompts,
-                    )
-                )
-        return samples_list
+        # NOTE: concat all outputs to following format:
+        #
+        # | token token token | token token [EOS] | token token token token token | token token [EOS] | token token | token token token [EOS] |
+        # |<---  prompt ----->|<---- answer ----->|<---------- prompt ----------->|<----- answer ---->|<- prompt -->|<-------- answer ------->|
+        sequences = []
+        packed_seq_lens = []
+        attention_mask = []
+        num_actions = []
+        for i, output in enumerate(outputs):
+            input_len = len(output.prompt_token_ids)
+            output_len = len(output.outputs[0].token_ids)
+            packed_seq_lens.append(input_len + output_len)
+            sequences.extend(output.prompt_token_ids + list(output.outputs[0].token_ids))
+            attention_mask.extend([i + 1] * (input_len + output_len))
+
+            # current_action_mask = [0] * (input_len - 1) + [1] * output_len + [0]
+            # num_actions.append(max(1, sum(current_action_mask)))
+            num_actions.append(max(1, output_len))
+
+        sequences = torch.tensor(sequences, device="cuda").unsqueeze(0)
+        attention_mask = torch.tensor(attention_mask, device="cuda").unsqueeze(0)
+        response_length = torch.tensor(num_actions, device="cuda", dtype=torch.float)
+        total_length = torch.tensor(packed_seq_lens, device="cuda", dtype=torch.float)
+        return Samples(
+            sequences=sequences,
+            attention_mask=attention_mask,
+            action_mask=None,
+            num_actions=num_actions,
+            packed_seq_lens=packed_seq_lens,
+            response_length=response_length,
+            total_length=total_length,
+            prompts=prompts,
+            visual_inputs=None,
+        )
 
     def flush(self):
         "Ensure all experience has been send to critic"
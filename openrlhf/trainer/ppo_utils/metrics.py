@@ -0,0 +1,103 @@
+from collections import defaultdict
+from typing import Dict, Optional, Union
+
+import torch
+
+Number = Union[float, int, torch.Tensor]
+
+
+class MetricsAccumulator:
+    """
+    Accumulates training metrics on device and reduces them across ranks only when they are logged.
+
+    Values may be device tensors, they are kept as they are until `reduce`, so a training step does not
+    wait for the GPU. `reduce` stacks every key into one flat tensor, which is all-reduced with a single
+    collective (plus one more if there are "max" metrics), then copied to the host once.
+
+    Supported ops:
+        mean: mean over all added values of all ranks.
+        sum: sum over all added values of all ranks.
+        max: max over all added values of all ranks.
+        weighted_mean: sum(value * weight) / sum(weight) over all ranks, e.g. token-weighted KL.
+
+    All ranks must add the same keys in the same order, as they share the layout of the flat tensor.
+
+    Args:
+        strategy: Reduces across ranks with strategy.all_reduce, None for a single process.
+        device: Device the flat tensor is reduced on, must suit the collective backend.
+    """
+
+    def __init__(self, strategy=None, device: Optional[Union[str, torch.device]] = None):
+        self.strategy = strategy
+        self.device = device if device is not None else torch.cuda.current_device()
+        self.reset()
+
+    def reset(self):
+        self.ops = {}
+        self.values = defaultdict(list)
+        self.weights = defaultdict(list)
+
+    def add(self, key: str, value: Number, op: str = "mean", weight: Number = 1.0):
+        assert op in ("mean", "sum", "max", "weighted_mean")
+        assert self.ops.setdefault(key, op) == op, f"metric {key} is reduced with {self.ops[key]}, not {op}"
+        self.values[key].append(value)
+        if op == "weighted_mean":
+            self.weights[key].append(weight)
+
+    def update(self, metrics: Dict[str, Number], op: str = "mean"):
+        for key, value in metrics.items():
+            self.add(key, value, op)
+
+    def reduce(self, reset: bool = True) -> Dict[str, float]:
+        """Reduce every metric across ranks, returns python floats."""
+        sum_keys = [key for key, op in self.ops.items() if op != "max"]
+        max_keys = [key for key, op in self.ops.items() if op == "max"]
+
+        # one row per key: sum of values (times weights) and their count (or sum of weights)
+        results = {}
+        if sum_keys:
+            rows = []
+            for key in sum_keys:
+                values = self._stack(self.values[key])
+                if self.ops[key] == "weighted_mean":
+                    weights = self._stack(self.weights[key])
+                    rows.append(torch.stack([(values * weights).sum(), weights.sum()]))
+                else:
+                    rows.append(torch.stack([values.sum(), values.new_tensor(float(values.numel()))]))
+            totals = torch.stack(rows)
+            if self.strategy is not None:
+                totals = self.strategy.all_reduce(totals, op="sum")
+            for key, (total, count) in zip(sum_keys, totals.tolist()):
+                results[key] = total if self.ops[key] == "sum" else total / max(count, 1e-8)
+
+        if max_keys:
+            maxima = torch.stack([self._stack(self.values[key]).max() for key in max_keys])
+            if self.strategy is not None:
+                maxima = self.strategy.all_reduce(maxima, op="max")
+            results.update(zip(max_keys, maxima.tolist()))
+
+        results = {key: results[key] for key in self.ops.keys()}
+        if reset:
+            self.reset()
+        return results
+
+    def local(self) -> Dict[str, float]:
+        """Metrics of this rank only, without any collective, e.g. for a progress bar."""
+        results = {}
+        for key, op in self.ops.items():
+            values = self._stack(self.values[key])
+            if op == "weighted_mean":
+                weights = self._stack(self.weights[key])
+                results[key] = (values * weights).sum() / weights.sum().clamp(min=1e-8)
+            else:
+                results[key] = {"mean": values.mean, "sum": values.sum, "max": values.max}[op]()
+        if not results:
+            return {}
+        return dict(zip(results.keys(), torch.stack(list(results.values())).tolist()))
+
+    def _stack(self, values):
+        # float64 keeps small python numbers such as learning rates exact
+        if not any(isinstance(v, torch.Tensor) for v in values):
+            # python numbers are copied to the device at once
+            return torch.tensor(values, dtype=torch.float64, device=self.device)
+        return torch.stack([torch.as_tensor(v, device=self.device).double().reshape(()) for v in values])
@@ -0,0 +1,112 @@
+import queue
+import threading
+from typing import Iterable, Iterator, Union
+
+import torch
+
+from openrlhf.utils.tracer import trace_span
+
+from .experience_maker import Experience
+
+_END = object()
+
+
+class _Error:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class ExperiencePrefetcher:
+    """
+    Iterates replay buffer micro-batches with their host to device copies issued one step ahead.
+
+    A background thread collates the batches of `loader` and pins them, at most `depth` batches ahead.
+    The copy of the next batch is issued on a side CUDA stream with non-blocking copies before the
+    current batch is returned, so it overlaps with the training step of the current batch instead of
+    sitting at its start. Batches are returned on `device`, ready to use on the current stream.
+
+    Without CUDA, or when `device` is the CPU, batches are collated and copied synchronously.
+
+    Args:
+        loader: Iterable of Experience, e.g. the replay buffer DataLoader, it should not pin itself.
+        device: Device the batches are copied to.
+        pin_memory: Whether batches are pinned in the background thread, required for asynchronous copies.
+        depth: Number of collated batches queued ahead of the training step.
+    """
+
+    def __init__(
+        self,
+        loader: Iterable[Experience],
+        device: Union[int, str, torch.device],
+        pin_memory: bool = True,
+        depth: int = 2,
+    ):
+        self.loader = loader
+        self.device = torch.device("cuda", device) if isinstance(device, int) else torch.device(device)
+        self.pin_memory = pin_memory
+        self.depth = depth
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[Experience]:
+        if self.device.type != "cuda" or not torch.cuda.is_available():
+            for experience in self.loader:
+                yield experience.to_device(self.device)
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        worker.start()
+
+        copy_stream = torch.cuda.Stream(self.device)
+        try:
+            next_experience = self._copy(self._get(batches), copy_stream)
+            while next_experience is not None:
+                experience = next_experience
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(copy_stream)
+                # the copies were allocated on copy_stream, keep their memory until current_stream is done
+                experience.record_stream(current_stream)
+                # issue the copy of the next batch before the current one is trained on
+                next_experience = self._copy(self._get(batches), copy_stream)
+                yield experience
+        finally:
+            stop.set()
+            worker.join()
+
+    def _copy(self, experience, stream):
+        if experience is None:
+            return None
+        with torch.cuda.stream(stream):
+            return experience.to_device(self.device, non_blocking=self.pin_memory)
+
+    def _get(self, batches):
+        with trace_span("replay_batch_wait"):
+            item = batches.get()
+        if isinstance(item, _Error):
+            raise item.exception
+        return None if item is _END else item
+
+    def _produce(self, batches, stop):
+        def put(item):
+            # stop waiting for room when the consumer is gone
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for experience in self.loader:
+                if self.pin_memory:
+                    experience.pin_memory()
+                if not put(experience):
+                    return
+        except BaseException as e:
+            put(_Error(e))
+            return
+        put(_END)
@@ -1,170 +1,48 @@
+import heapq
+import math
 import random
 from abc import ABC
-from dataclasses import dataclass
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Union
 
 import torch
-import torch.nn.functional as F
+from torch.utils.data.sampler import Sampler
 
 
 from .experience_maker import Experience
 from .data_processor import BaseDataProcessor
 
-@dataclass
-class BufferItem:
-    """BufferItem is an item of experience data.
+# per-token fields over the whole sequence and over the actions (response) only
+SEQUENCE_KEYS = ("sequences", "attention_mask")
+ACTION_KEYS = ("action_log_probs", "values", "returns", "advantages", "action_mask")
 
-    Shapes of each tensor:
-    sequences: (S)
-    action_log_probs: (A)
-    values: (1)
-    returns: (1)
-    advantages: (1)
-    attention_mask: (S)
-    action_mask: (A)
 
-    "A" is the number of actions.
+def left_pad_index(starts: torch.Tensor, ends: torch.Tensor) -> torch.Tensor:
     """
+    Gather index of the segments `flat[start:end]` into a left padded (B, max_len) tensor, shared by all
+    columns with the same offsets. Padding positions gather `flat[0]`, which must be zero.
+    """
+    lens = ends - starts
+    max_len = int(lens.max())
+    pad = (max_len - lens).unsqueeze(1)
+    positions = torch.arange(max_len)
+    return (starts.unsqueeze(1) - pad + positions).masked_fill_(positions < pad, 0)
 
-    sequences: torch.Tensor
-    action_log_probs: torch.Tensor
-    values: torch.Tensor
-    returns: torch.Tensor
-    advantages: torch.Tensor
-    attention_mask: Optional[torch.LongTensor]
-    action_mask: Optional[torch.BoolTensor]
-    info: Optional[dict]
-    visual_inputs: Optional[dict]
-
-
-def split_experience_batch(experience: Experience, data_processor: Optional[BaseDataProcessor]) -> List[BufferItem]:
-    batch_size = len(experience.sequences)
-    batch_kwargs = [{} for _ in range(batch_size)]
-    keys = (
-        "sequences",
-        "action_log_probs",
-        "values",
-        "returns",
-        "advantages",
-        "attention_mask",
-        "action_mask",
-    )
-    for key in keys:
-        value = getattr(experience, key)
-        if value is None:
-            for i in range(batch_size):
-                batch_kwargs[i][key] = None
-            continue
-        vals = value
-        if isinstance(vals, torch.Tensor):
-            vals = torch.unbind(vals)
-        assert batch_size == len(vals)
-        for i, v in enumerate(vals):
-            batch_kwargs[i][key] = v
-    if data_processor is not None:
-        visual_inputs_batch = experience.visual_inputs
-        visual_inputs_batch['input_ids'] = experience.sequences
-        visual_inputs_chunks = data_processor.split_input_batch(visual_inputs_batch)
-        for i, visual_inputs in enumerate(visual_inputs_chunks):
-            visual_inputs.pop('input_ids')
-            batch_kwargs[i]["visual_inputs"] = visual_inputs
-    else:
-        for i in range(batch_size):
-            batch_kwargs[i]["visual_inputs"] = None
-
-    for i in range(batch_size):
-        batch_kwargs[i]["info"] = {}
-    for k, v in experience.info.items():
-        vals = torch.unbind(v)
-        assert batch_size == len(vals)
-        for i, vv in enumerate(vals):
-            if isinstance(vv, torch.Tensor):
-                assert vv.numel() == 1, f"info[{k}] must be a scalar tensor, but got {vv.shape}"
-                vv = vv.item()
-            batch_kwargs[i]["info"][k] = vv
-
-    items = [BufferItem(**kwargs) for kwargs in batch_kwargs]
-    return items
-
-
-def zero_pad_sequences(sequences: List[torch.Tensor], side: str = "left") -> torch.Tensor:
-    assert side in ("left", "right")
-    max_len = max(seq.size(0) for seq in sequences)
-    padded_sequences = []
-    for seq in sequences:
-        pad_len = max_len - seq.size(0)
-        padding = (pad_len, 0) if side == "left" else (0, pad_len)
-        padded_sequences.append(F.pad(seq, padding))
-    return torch.stack(padded_sequences, dim=0)
-
-
-def make_experience_batch(items: List[BufferItem], data_processor: Optional[BaseDataProcessor], packing_samples=False) -> Experience:
-    kwargs = {}
-    keys = (
-        "sequences",
-        "action_log_probs",
-        "values",
-        "returns",
-        "advantages",
-        "attention_mask",
-        "action_mask",
-    )
-    for key in keys:
-        vals = [getattr(item, key) for item in items]
-        if not packing_samples:
-            batch_data = zero_pad_sequences(vals, "left") if vals[0] is not None else None
-        else:
-            batch_data = vals if vals[0] is not None else None
-        kwargs[key] = batch_data
-
-    kwargs["info"] = {}
-    for key in items[0].info.keys():
-        vals = torch.tensor([item.info[key] for item in items])
-        kwargs["info"][key] = vals
-    if data_processor is not None:
-        kwargs["visual_inputs"] = data_processor.make_input_batch([item.visual_inputs for item in items])
-    return Experience(**kwargs)
-
-
-def remove_padding_in_sequences(items):
-    for item in items:
-        seq, act_log_prob, value, ret, adv, att_mask, act_mask = (
-            item.sequences,
-            item.action_log_probs,
-            item.values,
-            item.returns,
-            item.advantages,
-            item.attention_mask,
-            item.action_mask,
-        )
-        right_pad = (1 - act_mask.long()).sum()
-        right_pad = None if right_pad == 0 else -right_pad
-
-        # left_pad for seq and att_mask
-        left_pad = att_mask.long().argmax()
-        (
-            item.sequences,
-            item.action_log_probs,
-            item.values,
-            item.returns,
-            item.advantages,
-            item.attention_mask,
-            item.action_mask,
-        ) = (
-            seq[left_pad:right_pad],
-            act_log_prob[:right_pad],
-            value[:right_pad] if item.values is not None else None,
-            ret[:right_pad],
-            adv[:right_pad],
-            att_mask[left_pad:right_pad],
-            act_mask[:right_pad],
-        )
-    return items
+
+def left_pad_segments(flat: torch.Tensor, index: torch.Tensor) -> torch.Tensor:
+    """Gather the segments of a `left_pad_index` from `flat` into a left padded (B, max_len) tensor."""
+    return flat.index_select(0, index.view(-1)).view(index.shape)
 
 
 class NaiveReplayBuffer(ABC):
     """Naive replay buffer class. It stores experience.
 
+    Experiences are stored column-wise without padding: every per-token field is one flat tensor,
+    indexed by `seq_offsets` (sequence fields) or `act_offsets` (action fields), and every info
+    field is a (N,) tensor. Flat columns start with a zero, the value of padding positions.
+    Packed samples come without padding, their per-token fields are kept as lists of the appended
+    tensors instead, so they are never copied. `collate_fn` gathers a batch of sample indices back
+    into an `Experience`, the DataLoader iterates `range(len(buffer))`.
+
     Args:
         sample_batch_size (int): Batch size when sampling.
         limit (int, optional): Limit of number of experience samples. A number <= 0 means unlimited. Defaults to 0.
@@ -172,11 +50,11 @@ class NaiveReplayBuffer(ABC):
     """
 
     def __init__(
-        self, 
-        sample_batch_size: int, 
-        data_processor: Optional[BaseDataProcessor] = None, 
-        limit: int = 0, 
-        cpu_offload: bool = True, 
+        self,
+        sample_batch_size: int,
+        data_processor: Optional[BaseDataProcessor] = None,
+        limit: int = 0,
+        cpu_offload: bool = True,
         packing_samples: bool = False,
         drop_maxlen: bool = False,
         maxlen: int = 10**8,
@@ -188,68 +66,203 @@ class NaiveReplayBuffer(ABC):
         self.limit = limit
         self.cpu_offload = cpu_offload
         self.packing_samples = packing_samples
-        self.target_device = torch.device(f"cuda:{torch.cuda.current_device()}")
-        self.items: List[BufferItem] = []
+        if torch.cuda.is_available():
+            self.target_device = torch.device(f"cuda:{torch.cuda.current_device()}")
+        else:
+            self.target_device = torch.device("cpu")
         self.maxlen = maxlen
         self.drop_maxlen = drop_maxlen
+        self.clear()
+
+    def clear(self) -> None:
+        # flat tensors, or lists of per-sample tensors when packing samples
+        self.columns: Dict[str, Optional[Union[torch.Tensor, List[torch.Tensor]]]] = {}
+        self.info: Dict[str, torch.Tensor] = {}
+        # samples start after the leading zero of the flat columns
+        self.seq_offsets = torch.ones(1, dtype=torch.long)
+        self.act_offsets = torch.ones(1, dtype=torch.long)
+        self.visual_inputs: List[Optional[dict]] = []
+        # appended samples are concatenated into the columns lazily, on the first read after an append
+        self._pending: List[dict] = []
 
     @torch.no_grad()
     def append(self, experience: Experience) -> None:
         if self.cpu_offload:
             experience.to_device(torch.device("cpu"))
-        items = split_experience_batch(experience, self.data_processor)
+        batch_size = len(experience.sequences)
+        keep = list(range(batch_size))
         # NOTE: No tested
         if self.drop_maxlen:
-            original_len = len(items)
-            items = list(filter(lambda x: x.sequences.shape[-1] <= self.maxlen, items))
-            if original_len - len(items) > 0:
-                print(f"drop {original_len - len(items)} samples")
-        # the packed samples comes with no padding
-        if not self.packing_samples:
-            items = remove_padding_in_sequences(items)
-        self.items.extend(items)
+            keep = [i for i in keep if self._sequence_len(experience, i) <= self.maxlen]
+            if batch_size - len(keep) > 0:
+                print(f"drop {batch_size - len(keep)} samples")
+            if len(keep) == 0:
+                return
+
+        # indexing with a slice returns views instead of copies when every sample is kept
+        rows = keep if len(keep) < batch_size else slice(None)
+        # the kept tokens of every per-token field, copied into the columns on consolidation
+        chunk = {}
+        if self.packing_samples:
+            # the packed samples comes with no padding
+            for key in SEQUENCE_KEYS + ACTION_KEYS:
+                value = getattr(experience, key)
+                chunk[key] = None if value is None else [value[i] for i in keep]
+            lens = [[experience.sequences[i].numel(), experience.action_log_probs[i].numel()] for i in keep]
+            chunk["seq_lens"], chunk["act_lens"] = torch.tensor(lens, dtype=torch.long).unbind(1)
+        else:
+            # strip the left padding of sequences and the right padding of both sequences and actions
+            seq_len, act_len = experience.attention_mask.size(1), experience.action_mask.size(1)
+            left_pad = experience.attention_mask.long().argmax(dim=-1, keepdim=True)
+            right_pad = act_len - experience.action_mask.long().sum(dim=-1, keepdim=True)
+            seq_positions, act_positions = torch.arange(seq_len), torch.arange(act_len)
+            seq_mask = (seq_positions >= left_pad) & (seq_positions < seq_len - right_pad)
+            act_mask = act_positions < act_len - right_pad
+            if len(keep) < batch_size:
+                kept = torch.zeros(batch_size, 1, dtype=torch.bool)
+                kept[keep] = True
+                seq_mask &= kept
+                act_mask &= kept
+            # flat positions of the kept tokens, row by row, gathered straight into the columns
+            seq_index = seq_mask.view(-1).nonzero().squeeze(1)
+            act_index = act_mask.view(-1).nonzero().squeeze(1)
+            for key in SEQUENCE_KEYS + ACTION_KEYS:
+                value = getattr(experience, key)
+                index = seq_index if key in SEQUENCE_KEYS else act_index
+                chunk[key] = None if value is None else (value.reshape(-1), index)
+            chunk["seq_lens"], chunk["act_lens"] = seq_mask.sum(dim=-1)[rows], act_mask.sum(dim=-1)[rows]
+
+        info = {}
+        for k, v in experience.info.items():
+            v = torch.as_tensor(v)
+            assert v.numel() == batch_size, f"info[{k}] must be a scalar per sample, but got {v.shape}"
+            info[k] = v.reshape(batch_size)[rows].cpu()
+        chunk["info"] = info
+
+        if self.data_processor is not None:
+            visual_inputs_batch = experience.visual_inputs
+            visual_inputs_batch['input_ids'] = experience.sequences
+            visual_inputs_chunks = self.data_processor.split_input_batch(visual_inputs_batch)
+            for visual_inputs in visual_inputs_chunks:
+                visual_inputs.pop('input_ids')
+            chunk["visual_inputs"] = [visual_inputs_chunks[i] for i in keep]
+        else:
+            chunk["visual_inputs"] = [None] * len(keep)
+
+        self._pending.append(chunk)
         if self.limit > 0:
-            samples_to_remove = len(self.items) - self.limit
+            samples_to_remove = len(self) - self.limit
             if samples_to_remove > 0:
-                self.items = self.items[samples_to_remove:]
-
-    def clear(self) -> None:
-        self.items.clear()
+                self._truncate_front(samples_to_remove)
+
+    def _sequence_len(self, experience: Experience, i: int) -> int:
+        if self.packing_samples:
+            return experience.sequences[i].shape[-1]
+        return experience.sequences.shape[-1]
+
+    def _consolidate(self) -> None:
+        if not self._pending:
+            return
+        chunks = self._pending
+        self._pending = []
+        for key in SEQUENCE_KEYS + ACTION_KEYS:
+            if chunks[0][key] is None:
+                self.columns[key] = None
+                continue
+            if self.packing_samples:
+                self.columns[key] = (self.columns.get(key) or []) + [v for chunk in chunks for v in chunk[key]]
+                continue
+            # a single copy of every kept token, from the appended experiences into the new column
+            previous = self.columns.get(key)
+            start = 1 if previous is None else previous.numel()
+            column = chunks[0][key][0].new_empty(start + sum(chunk[key][1].numel() for chunk in chunks))
+            if previous is None:
+                column[0] = 0
+            else:
+                column[:start] = previous
+            for chunk in chunks:
+                value, index = chunk[key]
+                torch.index_select(value, 0, index, out=column[start : start + index.numel()])
+                start += index.numel()
+            self.columns[key] = column
+        for key in chunks[0]["info"].keys():
+            values = [chunk["info"][key] for chunk in chunks]
+            if key in self.info:
+                values.insert(0, self.info[key])
+            self.info[key] = torch.cat(values)
+        for name, lens_key in (("seq_offsets", "seq_lens"), ("act_offsets", "act_lens")):
+            offsets = getattr(self, name)
+            lens = torch.cat([chunk[lens_key] for chunk in chunks])
+            setattr(self, name, torch.cat([offsets, offsets[-1] + lens.cumsum(0)]))
+        for chunk in chunks:
+            self.visual_inputs.extend(chunk["visual_inputs"])
+
+    def _truncate_front(self, num_samples: int) -> None:
+        self._consolidate()
+        seq_start, act_start = self.seq_offsets[num_samples], self.act_offsets[num_samples]
+        for key, value in self.columns.items():
+            if value is None:
+                continue
+            if self.packing_samples:
+                self.columns[key] = value[num_samples:]
+            else:
+                self.columns[key] = torch.cat([value[:1], value[seq_start if key in SEQUENCE_KEYS else act_start :]])
+        self.info = {key: value[num_samples:].clone() for key, value in self.info.items()}
+        self.seq_offsets = self.seq_offsets[num_samples:] - seq_start + 1
+        self.act_offsets = self.act_offsets[num_samples:] - act_start + 1
+        self.visual_inputs = self.visual_inputs[num_samples:]
 
     @torch.no_grad()
     def sample(self) -> Experience:
-        items = random.sample(self.items, self.sample_batch_size)
-        experience = make_experience_batch(items, self.data_processor, self.packing_samples)
+        indices = random.sample(range(len(self)), self.sample_batch_size)
+        experience = self.collate_fn(indices)
         if self.cpu_offload:
             experience.to_device(self.target_device)
         return experience
 
     def __len__(self) -> int:
-        return len(self.items)
+        return len(self.seq_offsets) - 1 + sum(len(chunk["seq_lens"]) for chunk in self._pending)
 
-    def __getitem__(self, idx: int) -> BufferItem:
-        return self.items[idx]
+    def sequence_lengths(self) -> torch.Tensor:
+        """Unpadded total (prompt + response) length of every sample."""
+        self._consolidate()
+        return self.seq_offsets.diff()
 
-    def collate_fn(self, batch) -> Experience:
-        experience = make_experience_batch(batch, self.data_processor, self.packing_samples)
-        return experience
+    @torch.no_grad()
+    def collate_fn(self, batch: List[int]) -> Experience:
+        self._consolidate()
+        indices = torch.tensor(batch, dtype=torch.long)
+        kwargs = {}
+        for keys, offsets in ((SEQUENCE_KEYS, self.seq_offsets), (ACTION_KEYS, self.act_offsets)):
+            if self.packing_samples:
+                for key in keys:
+                    column = self.columns[key]
+                    kwargs[key] = None if column is None else [column[i] for i in batch]
+                continue
+            # one gather index for all columns with these offsets
+            index = left_pad_index(offsets[indices], offsets[indices + 1])
+            for key in keys:
+                column = self.columns[key]
+                kwargs[key] = None if column is None else left_pad_segments(column, index)
+
+        kwargs["info"] = {key: value[indices] for key, value in self.info.items()}
+        if self.data_processor is not None:
+            kwargs["visual_inputs"] = self.data_processor.make_input_batch([self.visual_inputs[i] for i in batch])
+        return Experience(**kwargs)
 
     def normalize(self, attribute: str, strategy) -> None:
         assert attribute == "advantages"
-        items = []
-        action_masks = []
-        for item in self:
-            items.append(getattr(item, attribute))
-            action_masks.append(item.action_mask)
+        self._consolidate()
+        # the flat columns without their leading zero
+        items = torch.cat(self.columns[attribute]) if self.packing_samples else self.columns[attribute][1:]
+        items_vector = items.float()
 
-        items_vector = torch.cat(items).float().flatten()
-
-        if action_masks[0] is None:
+        if self.columns["action_mask"] is None:
             # packing samples has no action mask
             action_masks_vector = 1
             num_actions = items_vector.numel()
         else:
-            action_masks_vector = torch.cat(action_masks).flatten()
+            action_masks_vector = self.columns["action_mask"][1:]
             num_actions = action_masks_vector.sum()
 
         # for DP
@@ -262,5 +275,187 @@ class NaiveReplayBuffer(ABC):
         all_std = strategy.all_reduce(std, "sum")
         rstd = (all_std / all_count).clamp(min=1e-8).rsqrt()
 
-        for i, item in enumerate(self):
-            setattr(item, attribute, (items[i] - mean) * rstd + 1e-8)
+        if self.packing_samples:
+            self.columns[attribute] = list(((items - mean) * rstd + 1e-8).split(self.act_offsets.diff().tolist()))
+        else:
+            items.copy_((items - mean) * rstd + 1e-8)
+
+
+class LengthGroupedBatchSampler(Sampler[List[int]]):
+    """Batch sampler over a replay buffer that groups samples of similar total length.
+
+    The buffer is shuffled and cut into buckets of `bucket_size` micro-batches; within a bucket,
+    samples are sorted by length and cut into micro-batches, and the micro-batches of all buckets
+    are shuffled again. Without `group_by_length` this is plain shuffled batching.
+
+    With `max_tokens`, micro-batches are filled up to a token budget (padded tokens, or real tokens
+    when samples are packed) instead of `batch_size` samples. The number of micro-batches is then
+    all-reduced across DP ranks and rounded up to a multiple of the gradient accumulation steps, by
+    splitting the largest micro-batches, so that every rank runs the same number of steps.
+    Packed samples are planned as a bin packing instead: first-fit-decreasing gives the number of
+    micro-batches each rank needs, and once the ranks agree on a count, the samples are spread
+    longest first onto the least loaded micro-batch so that all micro-batches carry similar loads,
+    unless that would exceed the budget, in which case the first-fit-decreasing bins are kept.
+    A rank with fewer samples than the agreed number of micro-batches repeats its smallest ones.
+    The resulting per-step token counts and their imbalance across ranks are reported by `stats`.
+
+    Call `set_epoch` before iterating each epoch.
+
+    Args:
+        lengths (torch.Tensor): Total length of each sample in the buffer.
+        batch_size (int): Samples per micro-batch, ignored when `max_tokens` is set.
+        group_by_length (bool): Whether to group samples of similar length.
+        max_tokens (int, optional): Token budget per micro-batch.
+        packing_samples (bool): Whether the micro-batches are packed rather than padded.
+        bucket_size (int): Number of micro-batches per sorting bucket.
+        seed (int): Shuffling seed, shared by all ranks.
+        strategy (optional): Used to agree on the number of micro-batches in token budget mode.
+    """
+
+    def __init__(
+        self,
+        lengths: torch.Tensor,
+        batch_size: int,
+        group_by_length: bool = False,
+        max_tokens: Optional[int] = None,
+        packing_samples: bool = False,
+        bucket_size: int = 16,
+        seed: int = 42,
+        strategy=None,
+    ) -> None:
+        self.lengths = lengths.tolist()
+        self.batch_size = batch_size
+        self.group_by_length = group_by_length
+        self.max_tokens = max_tokens
+        self.packing_samples = packing_samples
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.strategy = strategy
+        self.batches: List[List[int]] = []
+
+    def _num_tokens(self, batch: List[int]) -> int:
+        lengths = [self.lengths[i] for i in batch]
+        return sum(lengths) if self.packing_samples else max(lengths) * len(batch)
+
+    def _split_by_budget(self, indices: List[int]) -> List[List[int]]:
+        batches, batch = [], []
+        for i in indices:
+            if batch and self._num_tokens(batch + [i]) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _agree_num_batches(self, num_batches: int) -> int:
+        if self.strategy is not None:
+            num_batches = int(self.strategy.all_reduce(num_batches, "max"))
+            accumulated_gradient = getattr(self.strategy, "accumulated_gradient", 1)
+            num_batches = math.ceil(num_batches / accumulated_gradient) * accumulated_gradient
+        return num_batches
+
+    def _pad_num_batches(self, batches: List[List[int]], num_batches: Optional[int] = None) -> List[List[int]]:
+        if num_batches is None:
+            num_batches = self._agree_num_batches(len(batches))
+        batches = [batch for batch in batches if batch]
+        # split the largest micro-batches, halves never exceed the budget of the whole
+        while len(batches) < num_batches and any(len(b) > 1 for b in batches):
+            largest = max((b for b in batches if len(b) > 1), key=self._num_tokens)
+            batches.remove(largest)
+            batches.extend([largest[: len(largest) // 2], largest[len(largest) // 2 :]])
+        # a rank with fewer samples than steps repeats its smallest micro-batches, as DistributedSampler
+        # repeats samples, so that every rank still runs the same number of steps
+        if len(batches) < num_batches:
+            if not batches:
+                raise ValueError(f"no samples to fill {num_batches} micro-batches on this rank")
+            smallest = sorted(batches, key=self._num_tokens)
+            batches += [list(smallest[k % len(smallest)]) for k in range(num_batches - len(batches))]
+        return batches
+
+    def _pack_balanced(self, indices: List[int]) -> List[List[int]]:
+        indices = sorted(indices, key=lambda i: self.lengths[i], reverse=True)
+        # first-fit-decreasing, the micro-batches this rank needs within the budget
+        bins, loads = [], []
+        for i in indices:
+            for j, load in enumerate(loads):
+                if load + self.lengths[i] <= self.max_tokens:
+                    bins[j].append(i)
+                    loads[j] += self.lengths[i]
+                    break
+            else:
+                bins.append([i])
+                loads.append(self.lengths[i])
+        num_batches = self._agree_num_batches(len(bins))
+
+        # longest first onto the least loaded micro-batch, as long as it stays within the budget
+        batches = [[] for _ in range(num_batches)]
+        heap = [(0, j) for j in range(num_batches)]
+        for i in indices:
+            load, j = heapq.heappop(heap)
+            if load > 0 and load + self.lengths[i] > self.max_tokens:
+                # not even the least loaded micro-batch has room, keep the first-fit-decreasing bins
+                batches = bins
+                break
+            batches[j].append(i)
+            heapq.heappush(heap, (load + self.lengths[i], j))
+        return self._pad_num_batches(batches, num_batches)
+
+    def set_epoch(self, epoch: int) -> None:
+        g = torch.Generator()
+        g.manual_seed(self.seed + epoch)
+        indices = torch.randperm(len(self.lengths), generator=g).tolist()
+        if self.max_tokens is None:
+            # drop the tail, as DataLoader(drop_last=True) does
+            indices = indices[: len(indices) // self.batch_size * self.batch_size]
+
+        batches = []
+        bucket_size = self.bucket_size * self.batch_size if self.group_by_length else len(indices)
+        for start in range(0, len(indices), max(bucket_size, 1)):
+            bucket = indices[start : start + bucket_size]
+            if self.group_by_length:
+                bucket = sorted(bucket, key=lambda i: self.lengths[i], reverse=True)
+            if self.max_tokens is None:
+                batches.extend(bucket[i : i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+            elif not self.packing_samples:
+                batches.extend(self._split_by_budget(bucket))
+        if self.max_tokens is not None and self.packing_samples:
+            batches = self._pack_balanced(indices)
+        elif self.max_tokens is not None:
+            batches = self._pad_num_batches(batches)
+        if self.group_by_length or self.max_tokens is not None:
+            # shuffle across buckets so that micro-batch lengths are not ordered
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        self.batches = batches
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Padding efficiency and per-step token counts of the current epoch.
+
+        In token budget mode every rank runs the same number of steps, so the token counts of each
+        step are gathered from all ranks and `token_imbalance` is the mean over steps of the max to
+        mean ratio across ranks.
+        """
+        step_tokens = torch.tensor([self._num_tokens(batch) for batch in self.batches], dtype=torch.float)
+        stats = {"padding_efficiency": self.padding_efficiency}
+        if self.max_tokens is not None and self.strategy is not None:
+            step_tokens = self.strategy.all_gather(step_tokens).view(-1, len(self.batches))
+            stats["token_imbalance"] = (step_tokens.max(dim=0).values / step_tokens.mean(dim=0)).mean().item()
+        stats["tokens_per_step"] = step_tokens.mean().item()
+        stats["max_tokens_per_step"] = step_tokens.max().item()
+        return stats
+
+    @property
+    def padding_efficiency(self) -> float:
+        """Real tokens over tokens computed on (including padding) for the current epoch."""
+        if self.packing_samples:
+            return 1.0
+        real_tokens = sum(self.lengths[i] for batch in self.batches for i in batch)
+        total_tokens = sum(self._num_tokens(batch) for batch in self.batches)
+        return real_tokens / max(total_tokens, 1)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import torch
+from PIL import Image
+from qwen_vl_utils import fetch_image
+
+
+class VisionCache:
+    """
+    Content-addressed LRU cache of decoded images and image processor outputs for VLM rollouts.
+
+    Without it every image of a rollout is loaded, decoded and resized once for vLLM and once more for
+    every sample of its prompt when the training inputs are built. Entries are keyed by the image source
+    (local path with its mtime and size, URL, or a hash of in-memory image data) and by the pixel bounds
+    it is resized to, so repeated prompts skip decoding, resizing and the image processor entirely.
+
+    Args:
+        max_bytes: Memory budget of the in-memory LRU.
+        cache_dir: Optional directory that also stores resized images and processor outputs on disk,
+            where they are shared by all actors and reused across runs.
+    """
+
+    def __init__(self, max_bytes: int = 2**30, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.processor_hashes = {}
+        self.hits = {"image": 0, "features": 0}
+        self.disk_hits = {"image": 0, "features": 0}
+        self.misses = {"image": 0, "features": 0}
+
+    def image_key(self, ele: Dict) -> str:
+        """Key of an image message element, as extracted by qwen_vl_utils.extract_vision_info."""
+        source = ele.get("image") or ele.get("image_url")
+        if isinstance(source, str):
+            path = source[len("file://") :] if source.startswith("file://") else source
+            if not source.startswith(("http://", "https://", "data:")) and os.path.isfile(path):
+                stat = os.stat(path)
+                source = f"{source}:{stat.st_mtime_ns}:{stat.st_size}"
+        else:
+            # PIL image
+            source = f"{hashlib.sha1(source.tobytes()).hexdigest()}:{source.mode}:{source.size}"
+        bounds = [ele.get(k) for k in ("min_pixels", "max_pixels", "resized_height", "resized_width")]
+        return hashlib.sha1(json.dumps([source, bounds]).encode()).hexdigest()
+
+    def fetch_image(self, ele: Dict, key: Optional[str] = None):
+        """qwen_vl_utils.fetch_image(ele), served from the cache when possible."""
+        key = key or self.image_key(ele)
+        image = self._get("image", key)
+        if image is None:
+            image = self._load("image", key)
+            if image is None:
+                self.misses["image"] += 1
+                image = fetch_image(ele)
+                self._save("image", key, image)
+            self._put("image", key, image, image.width * image.height * len(image.getbands()))
+        return image
+
+    def image_features(self, ele: Dict, image_processor) -> Dict[str, torch.Tensor]:
+        """pixel_values and image_grid_thw of a single image, as image_processor computes them."""
+        image_key = self.image_key(ele)
+        key = hashlib.sha1((image_key + self._processor_hash(image_processor)).encode()).hexdigest()
+        features = self._get("features", key)
+        if features is None:
+            features = self._load("features", key)
+            if features is None:
+                self.misses["features"] += 1
+                outputs = image_processor(images=[self.fetch_image(ele, image_key)], return_tensors="pt")
+                features = {"pixel_values": outputs["pixel_values"], "image_grid_thw": outputs["image_grid_thw"]}
+                self._save("features", key, features)
+            self._put("features", key, features, sum(v.nelement() * v.element_size() for v in features.values()))
+        return features
+
+    def stats(self, reset: bool = True) -> dict:
+        """Hit rates of the in-memory and on-disk caches per kind of entry, and the memory in use."""
+        stats = {}
+        for kind in self.hits:
+            total = self.hits[kind] + self.disk_hits[kind] + self.misses[kind]
+            stats[f"{kind}_hit_rate"] = self.hits[kind] / max(total, 1)
+            stats[f"{kind}_disk_hit_rate"] = self.disk_hits[kind] / max(total, 1)
+        stats["memory_mb"] = self.nbytes / 2**20
+        if reset:
+            for counter in (self.hits, self.disk_hits, self.misses):
+                for kind in counter:
+                    counter[kind] = 0
+        return stats
+
+    def _processor_hash(self, image_processor) -> str:
+        # processor outputs depend on its config, e.g. patch and merge sizes
+        if id(image_processor) not in self.processor_hashes:
+            config = image_processor.to_json_string()
+            self.processor_hashes[id(image_processor)] = hashlib.sha1(config.encode()).hexdigest()
+        return self.processor_hashes[id(image_processor)]
+
+    def _get(self, kind, key):
+        entry = self.entries.get((kind, key))
+        if entry is None:
+            return None
+        self.entries.move_to_end((kind, key))
+        self.hits[kind] += 1
+        return entry[0]
+
+    def _put(self, kind, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        self.entries[(kind, key)] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_bytes
+
+    def _path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key[:2], f"{key}.png" if kind == "image" else f"{key}.pt")
+
+    def _load(self, kind, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(kind, key)
+        if not os.path.exists(path):
+            return None
+        try:
+            if kind == "image":
+                with Image.open(path) as image:
+                    value = image.convert("RGB")
+            else:
+                value = torch.load(path, map_location="cpu", weights_only=True)
+        except Exception as e:
+            print(f"[Warning] failed to load vision cache entry {path}: {e}")
+            return None
+        self.disk_hits[kind] += 1
+        return value
+
+    def _save(self, kind, key, value):
+        if not self.cache_dir:
+            return
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that concurrent readers never see a partial entry
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        if kind == "image":
+            # PNG is lossless, so a reloaded image gives the same pixel values
+            value.save(tmp_path, format="PNG")
+        else:
+            torch.save(value, tmp_path)
+        os.replace(tmp_path, path)
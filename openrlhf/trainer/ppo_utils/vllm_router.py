@@ -0,0 +1,129 @@
+import hashlib
+from array import array
+from collections import OrderedDict
+from typing import List, Sequence, Union
+
+
+class PrefixAffinityRouter:
+    """
+    Route prompts to vLLM engines by prompt prefix, so that prompts sharing a prefix hit the same
+    engine's prefix cache, while keeping the estimated token load of the engines balanced.
+
+    Every prefix gets a stable preference order over the engines (rendezvous hashing), which is the
+    same on every actor rank. A prompt goes to the first engine in its order whose load stays under
+    (1 + balance_slack) times the average load of the batch, or to the least loaded engine if none does.
+    The load of a prompt is its prompt tokens plus the expected decode tokens of its samples, estimated
+    from the responses previously observed for the same prefix, or for all prompts if the prefix is new.
+
+    Args:
+        num_engines: Number of vLLM engines.
+        prefix_len: Number of leading tokens (or characters for text prompts) that decide the affinity.
+        balance_slack: How far above the average load an engine may go to keep affinity.
+        decode_len_momentum: Momentum of the running means of response lengths used as expected decode length.
+        max_tracked_prefixes: Number of prefixes whose response length is tracked, least recently seen are dropped.
+    """
+
+    def __init__(
+        self,
+        num_engines: int,
+        prefix_len: int = 128,
+        balance_slack: float = 0.25,
+        decode_len_momentum: float = 0.9,
+        max_tracked_prefixes: int = 65536,
+    ):
+        self.num_engines = num_engines
+        self.prefix_len = prefix_len
+        self.balance_slack = balance_slack
+        self.decode_len_momentum = decode_len_momentum
+        self.max_tracked_prefixes = max_tracked_prefixes
+        self.decode_len = None
+        self.prefix_decode_len = OrderedDict()
+        self.loads = [0] * num_engines
+        self.num_requests = [0] * num_engines
+        self.num_affine = 0
+
+    def prefix_key(self, prompt: Union[str, Sequence[int]]) -> bytes:
+        prefix = prompt[: self.prefix_len]
+        return prefix.encode() if isinstance(prefix, str) else array("q", prefix).tobytes()
+
+    def engine_order(self, prompt: Union[str, Sequence[int]]) -> List[int]:
+        """Engines ordered by preference for the prefix of prompt."""
+        key = self.prefix_key(prompt)
+        scores = [
+            hashlib.blake2b(key + engine.to_bytes(4, "little"), digest_size=8).digest()
+            for engine in range(self.num_engines)
+        ]
+        return sorted(range(self.num_engines), key=scores.__getitem__, reverse=True)
+
+    def route(
+        self,
+        prompts: List[Union[str, Sequence[int]]],
+        prompt_lens: List[int],
+        num_samples: int = 1,
+        decode_len: int = 1024,
+    ) -> List[List[int]]:
+        """
+        Assign a batch of prompts to engines.
+
+        Args:
+            prompts: Token ids (or text) of every prompt, only the prefix is used.
+            prompt_lens: Number of prompt tokens of every prompt.
+            num_samples: Responses sampled per prompt.
+            decode_len: Expected response length until a rollout has been observed.
+
+        Returns:
+            For every engine, the indices of the prompts assigned to it, in input order.
+        """
+        if self.decode_len is not None:
+            decode_len = self.decode_len
+        costs = [
+            prompt_len + num_samples * self.prefix_decode_len.get(self.prefix_key(prompt), decode_len)
+            for prompt, prompt_len in zip(prompts, prompt_lens)
+        ]
+        capacity = (1 + self.balance_slack) * sum(costs) / self.num_engines
+
+        loads = [0] * self.num_engines
+        assignments = [[] for _ in range(self.num_engines)]
+        for i, (prompt, cost) in enumerate(zip(prompts, costs)):
+            order = self.engine_order(prompt)
+            engine = next((e for e in order if loads[e] + cost <= capacity), None)
+            if engine is None:
+                engine = min(range(self.num_engines), key=loads.__getitem__)
+            self.num_affine += engine == order[0]
+            loads[engine] += cost
+            assignments[engine].append(i)
+
+        for engine in range(self.num_engines):
+            self.loads[engine] += loads[engine]
+            self.num_requests[engine] += len(assignments[engine])
+        return assignments
+
+    def observe(self, prompts: List[Union[str, Sequence[int]]], response_lengths: List[float]):
+        """Update the expected decode lengths with the mean response length of every prompt of a finished rollout."""
+        if not response_lengths:
+            return
+        self.decode_len = self._update_mean(self.decode_len, sum(response_lengths) / len(response_lengths))
+        for prompt, response_length in zip(prompts, response_lengths):
+            key = self.prefix_key(prompt)
+            self.prefix_decode_len[key] = self._update_mean(self.prefix_decode_len.pop(key, None), response_length)
+            if len(self.prefix_decode_len) > self.max_tracked_prefixes:
+                self.prefix_decode_len.popitem(last=False)
+
+    def _update_mean(self, mean, value):
+        if mean is None:
+            return value
+        return self.decode_len_momentum * mean + (1 - self.decode_len_momentum) * value
+
+    def stats(self, reset: bool = True) -> dict:
+        """Per-engine routed tokens and requests and the share of prompts routed to their preferred engine."""
+        total = sum(self.num_requests)
+        stats = {f"engine_{e}_load": load for e, load in enumerate(self.loads)}
+        stats.update({f"engine_{e}_requests": n for e, n in enumerate(self.num_requests)})
+        stats["affinity_rate"] = self.num_affine / max(total, 1)
+        max_load = max(self.loads)
+        stats["load_imbalance"] = max_load / (sum(self.loads) / self.num_engines) if max_load > 0 else 1.0
+        if reset:
+            self.loads = [0] * self.num_engines
+            self.num_requests = [0] * self.num_engines
+            self.num_affine = 0
+        return stats
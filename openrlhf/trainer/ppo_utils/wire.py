@@ -0,0 +1,175 @@
+import warnings
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+# token ids, sent as int32
+ID_KEYS = ("sequences", "input_ids")
+# 0/1 or segment id masks, sent run-length encoded when that is smaller
+MASK_KEYS = ("attention_mask", "action_mask")
+# experience fields the critic does not read, only their shapes, sent as bf16
+CRITIC_LOSSY_KEYS = ("action_log_probs", "advantages", "kl")
+
+_ALIGN = 8
+_INT32 = torch.iinfo(torch.int32)
+
+
+@dataclass
+class WireBatch:
+    """
+    Tensors of a batch packed into a single contiguous buffer, a compact encoding for Ray transfers.
+
+    The buffer is a numpy array, so Ray stores it out-of-band and the receiver maps it from the object
+    store without copying it. `specs` describes every tensor in the buffer, `objects` holds the values
+    that are not tensors. Tensors decoded without conversion are views of the buffer, which may be
+    read-only on the receiving side, so they must not be written in place.
+    """
+
+    specs: List[dict]
+    objects: Dict[Tuple[str, ...], Any]
+    buffer: np.ndarray
+    raw_nbytes: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes
+
+
+def nbytes(value) -> int:
+    """Bytes of all tensors of a (nested) value, as they would be sent without encoding."""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+def encode_batch(tensors: Dict[str, Any], lossy_keys: Sequence[str] = ()) -> WireBatch:
+    """
+    Encode a (nested) dict of tensors, lists of tensors and plain values into a WireBatch.
+
+    Tensors may be on any device, they are copied to the host buffer once, after encoding:
+        - int64 token ids (ID_KEYS) are sent as int32,
+        - integer and bool masks (MASK_KEYS) are sent as int32 runs of equal values if that is smaller,
+          e.g. two or three runs per row for left and right padding, one per sample for packed segment ids,
+        - floating tensors in lossy_keys, dotted paths such as "info.kl" for nested ones, are sent as bf16,
+        - every other tensor is sent as it is.
+    All encodings except bf16 are lossless, and decoding restores the original dtypes and shapes.
+    """
+    segments = []
+    objects = {}
+    raw_nbytes = 0
+    for path, value in _flatten(tensors):
+        shapes = None
+        if isinstance(value, list) and value and all(isinstance(v, torch.Tensor) for v in value):
+            # e.g. packed samples, one segment for the whole list
+            shapes = [tuple(v.shape) for v in value]
+            value = torch.cat([v.reshape(-1) for v in value])
+        if not isinstance(value, torch.Tensor):
+            objects[path] = value
+            continue
+        raw_nbytes += nbytes(value)
+        codec, data, runs = _encode_tensor(path, value, lossy_keys)
+        spec = {"path": path, "codec": codec, "dtype": value.dtype, "shape": tuple(value.shape)}
+        spec.update(shapes=shapes, runs=runs)
+        segments.append((spec, data.contiguous().reshape(-1).view(torch.uint8)))
+
+    offset = 0
+    for spec, data in segments:
+        spec["offset"], spec["nbytes"] = offset, data.numel()
+        # aligned, so that every segment can be viewed as its dtype
+        offset += -(-data.numel() // _ALIGN) * _ALIGN
+    buffer = np.empty(offset, dtype=np.uint8)
+    host = torch.from_numpy(buffer)
+    for spec, data in segments:
+        host[spec["offset"] : spec["offset"] + spec["nbytes"]].copy_(data)
+    return WireBatch([spec for spec, _ in segments], objects, buffer, raw_nbytes)
+
+
+def decode_batch(batch: WireBatch) -> Dict[str, Any]:
+    """Decode a WireBatch back into the nested dict it was encoded from, tensors are on the CPU."""
+    with warnings.catch_warnings():
+        # buffers received from the object store are read-only, decoded tensors are only read
+        warnings.simplefilter("ignore", UserWarning)
+        host = torch.from_numpy(batch.buffer)
+
+    result = {}
+    for path, value in batch.objects.items():
+        _set(result, path, value)
+    for spec in batch.specs:
+        data = host[spec["offset"] : spec["offset"] + spec["nbytes"]]
+        value = _decode_tensor(spec, data)
+        if spec["shapes"] is not None:
+            sizes = [int(np.prod(shape)) for shape in spec["shapes"]]
+            value = [v.view(shape) for v, shape in zip(value.split(sizes), spec["shapes"])]
+        _set(result, spec["path"], value)
+    return result
+
+
+def encode_model_inputs(
+    sequences: torch.Tensor, attention_mask: Optional[torch.Tensor], visual_inputs: Optional[dict] = None
+) -> WireBatch:
+    """Encode the inputs of a forward of the reference, critic or reward model."""
+    return encode_batch({"sequences": sequences, "attention_mask": attention_mask, "visual_inputs": visual_inputs})
+
+
+def decode_model_inputs(sequences, attention_mask=None, visual_inputs=None):
+    """
+    Inputs of a model forward, decoded if sequences is a WireBatch of encode_model_inputs, as they are
+    otherwise. Returns (sequences, attention_mask, visual_inputs).
+    """
+    if not isinstance(sequences, WireBatch):
+        return sequences, attention_mask, visual_inputs
+    inputs = decode_batch(sequences)
+    return inputs["sequences"], inputs["attention_mask"], inputs["visual_inputs"]
+
+
+def _flatten(value: Dict[str, Any], prefix: Tuple[str, ...] = ()):
+    for key, v in value.items():
+        if isinstance(v, dict) and v:
+            yield from _flatten(v, prefix + (key,))
+        else:
+            yield prefix + (key,), v
+
+
+def _set(result: dict, path: Tuple[str, ...], value):
+    for key in path[:-1]:
+        result = result.setdefault(key, {})
+    result[path[-1]] = value
+
+
+def _encode_tensor(path: Tuple[str, ...], value: torch.Tensor, lossy_keys: Sequence[str]):
+    key = path[-1]
+    if ".".join(path) in lossy_keys and value.is_floating_point():
+        return "bf16", value.to(torch.bfloat16), None
+    if key in ID_KEYS and value.dtype == torch.int64 and value.numel() > 0:
+        if _INT32.min <= value.min().item() and value.max().item() <= _INT32.max:
+            return "int32", value.to(torch.int32), None
+    if key in MASK_KEYS and not value.is_floating_point() and value.numel() > 0:
+        flat = value.reshape(-1)
+        starts = torch.ones_like(flat, dtype=torch.bool)
+        starts[1:] = flat[1:] != flat[:-1]
+        starts = starts.nonzero().squeeze(1)
+        # a run is its value and its length
+        if 2 * starts.numel() * 4 < nbytes(value):
+            lengths = torch.diff(starts, append=starts.new_tensor([flat.numel()]))
+            return "rle", torch.cat([flat[starts].to(torch.int32), lengths.to(torch.int32)]), starts.numel()
+    return "raw", value, None
+
+
+def _decode_tensor(spec: dict, data: torch.Tensor) -> torch.Tensor:
+    dtype, codec = spec["dtype"], spec["codec"]
+    if codec == "bf16":
+        value = data.view(torch.bfloat16).to(dtype)
+    elif codec == "int32":
+        value = data.view(torch.int32).to(dtype)
+    elif codec == "rle":
+        runs = data.view(torch.int32)
+        value = torch.repeat_interleave(runs[: spec["runs"]], runs[spec["runs"] :]).to(dtype)
+    else:
+        value = data.view(dtype)
+    return value.view(spec["shape"])
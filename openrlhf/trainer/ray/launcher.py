@@ -9,8 +9,10 @@ from ray.util.placement_group import PlacementGroup, placement_group
 from ray.util.scheduling_strategies import PlacementGroupSchedulingStrategy
 
 from openrlhf.models import Actor, get_llm_for_sequence_regression
+from openrlhf.trainer.ppo_utils.wire import decode_model_inputs
 from openrlhf.trainer.ray.utils import ray_noset_visible_devices
 from openrlhf.utils.deepspeed import DeepspeedStrategy
+from openrlhf.utils.tracer import get_tracer, init_tracer, traced
 
 
 class DistributedTorchRayActor:
@@ -55,10 +57,15 @@ class BasePPORole(DistributedTorchRayActor):
         # configure strategy
         self.strategy = strategy
         strategy.setup_distributed()
+        init_tracer(type(self).__name__, self._rank, enabled=bool(getattr(strategy.args, "trace_dir", None)))
 
     def init_model_from_pretrained(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def get_trace_events(self) -> List[dict]:
+        """Spans recorded since the last call, merged into the step trace by the actor."""
+        return get_tracer().collect()
+
 
 @ray.remote(num_gpus=1)
 class ReferenceModelRayActor(BasePPORole):
@@ -71,6 +78,7 @@ class ReferenceModelRayActor(BasePPORole):
             load_in_4bit=strategy.args.load_in_4bit,
             ds_config=strategy.get_ds_eval_config(offload=strategy.args.ref_reward_offload),
             packing_samples=strategy.args.packing_samples,
+            logprobs_chunk_size=getattr(strategy.args, "logprobs_chunk_size", 0),
         )
         strategy.print(model)
 
@@ -80,6 +88,7 @@ class ReferenceModelRayActor(BasePPORole):
         self.model = self.strategy.prepare(model, is_rlhf=True)
         self.model.eval()
 
+    @traced()
     def forward(
         self,
         sequences: torch.LongTensor,
@@ -89,6 +98,7 @@ class ReferenceModelRayActor(BasePPORole):
         packed_seq_lens: Optional[list[int]] = None,
         visual_inputs: Optional[dict] = None,
     ) -> torch.Tensor:
+        sequences, attention_mask, visual_inputs = decode_model_inputs(sequences, attention_mask, visual_inputs)
         if visual_inputs is None:
             visual_inputs = {}
         device = torch.cuda.current_device()
@@ -133,9 +143,11 @@ class RewardModelRayActor(BasePPORole):
         self.model = self.strategy.prepare(model, is_rlhf=True)
         self.model.eval()
 
+    @traced()
     def forward(
         self, sequences: torch.LongTensor, attention_mask: Optional[torch.Tensor] = None, packed_seq_lens=None, visual_inputs: Optional[dict] = None,
     ) -> torch.Tensor:
+        sequences, attention_mask, visual_inputs = decode_model_inputs(sequences, attention_mask, visual_inputs)
         device = torch.cuda.current_device()
         if visual_inputs is None:
             visual_inputs = {}
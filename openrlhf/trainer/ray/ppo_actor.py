@@ -2,6 +2,7 @@ import itertools
 import math
 import os
 import socket
+import time
 from typing import Callable, Dict, List
 
 import deepspeed
@@ -17,9 +18,10 @@ from openrlhf.trainer.ppo_utils import Experience, RemoteExperienceMaker
 from openrlhf.utils import blending_datasets, get_tokenizer, get_vl_processor
 from openrlhf.utils.deepspeed import DeepspeedStrategy
 from openrlhf.utils.distributed_util import init_process_group
+from openrlhf.utils.tracer import trace_span
 
 from .launcher import BasePPORole
-from .utils import get_physical_gpu_id
+from .utils import get_physical_gpu_id, pack_weight_bucket, plan_weight_buckets
 
 
 class ActorPPOTrainer(PPOTrainer):
@@ -122,8 +124,9 @@ class ActorPPOTrainer(PPOTrainer):
 
     def ppo_train(self, global_steps):
         # 1. ensure all experience makers done
-        self.experience_maker.flush()
-        torch.distributed.barrier()
+        with trace_span("flush_experience"):
+            self.experience_maker.flush()
+            torch.distributed.barrier()
         status = {}
 
         # 2. triger remote critic model training
@@ -131,7 +134,8 @@ class ActorPPOTrainer(PPOTrainer):
             critic_status_ref = self.critic.fit.remote()
             # sync for colocate_all_models
             if self.strategy.args.colocate_all_models:
-                status.update(ray.get(critic_status_ref))
+                with trace_span("wait_critic_fit"):
+                    status.update(ray.get(critic_status_ref))
 
         if self.strategy.args.colocate_all_models:
             torch.distributed.barrier()
@@ -151,17 +155,41 @@ class ActorPPOTrainer(PPOTrainer):
                         refs = []
                         for engine in self.vllm_engines:
                             refs.append(engine.wake_up.remote())
-                        ray.get(refs)
+                        with trace_span("vllm_wake_up"):
+                            ray.get(refs)
                 torch.distributed.barrier()
-                self._broadcast_to_vllm()
+                start = time.time()
+                with trace_span("broadcast_to_vllm"):
+                    self._broadcast_to_vllm()
+                status["weight_sync_time"] = time.time() - start
 
         # 5. wait remote critic model training done
         if self.critic_train_remote and not self.strategy.args.colocate_all_models:
-            status.update(ray.get(critic_status_ref))
+            with trace_span("wait_critic_fit"):
+                status.update(ray.get(critic_status_ref))
         torch.distributed.barrier()
 
         return status
 
+    def collect_trace_events(self) -> List[dict]:
+        """
+        Also pull the spans of the critic, reference and reward models driven by this rank, and of the
+        vLLM engines on rank 0. Remote models shared by several ranks hand out their spans only once.
+        """
+        refs = []
+        if self.critic is not None:
+            refs.append(self.critic.get_trace_events.remote())
+        if self.initial_model is not None:
+            refs.append(self.initial_model.get_trace_events.remote())
+        if self.reward_model:
+            refs.extend(rm.get_trace_events.remote() for rm in self.reward_model)
+        if self.vllm_engines is not None and torch.distributed.get_rank() == 0:
+            refs.extend(engine.get_trace_events.remote() for engine in self.vllm_engines)
+        events = super().collect_trace_events()
+        for remote_events in ray.get(refs):
+            events.extend(remote_events)
+        return events
+
     def training_step(self, experience: Experience, global_steps) -> Dict[str, float]:
         return self.training_step_actor(experience)
 
@@ -174,71 +202,124 @@ class ActorPPOTrainer(PPOTrainer):
                 cache_reset_refs.append(engine.reset_prefix_cache.remote())
 
         torch.cuda.empty_cache()
+        if self.strategy.args.lora_rank > 0:
+            self._broadcast_lora_to_vllm()
+        else:
+            self._broadcast_params_to_vllm()
+
+        if cache_reset_refs:
+            ray.get(cache_reset_refs)
+        torch.cuda.empty_cache()
+        torch.distributed.barrier()
+
+    def _broadcast_lora_to_vllm(self):
+        """
+        Only send the LoRA adapter: the vLLM engines keep the frozen base weights loaded at startup
+        and apply the adapter at generation time, so a sync moves a few MB instead of the whole model.
+        """
         model = self.actor.model.module
-        count, num_params = 0, len(list(model.named_parameters()))
-        for name, param in model.named_parameters():
-            count += 1  # empty_cache at last param
-
-            # broadcast
-            if not self.use_cuda_ipc:
-                use_ray = getattr(self.strategy.args, "vllm_sync_with_ray", False)
-                # Fire all vllm engines for broadcast
+        adapter_name = model.active_adapter
+        lora_params = [(name, param) for name, param in model.named_parameters() if "lora_" in name]
+        with deepspeed.zero.GatheredParameters(
+            [param for _, param in lora_params], enabled=self.strategy.args.zero_stage == 3
+        ):
+            if torch.distributed.get_rank() == 0:
+                # use the key format of peft's saved adapters, which drops the adapter name
+                state_dict = {
+                    name.replace(f".{adapter_name}.", "."): param.data.to("cpu", copy=True)
+                    for name, param in lora_params
+                }
+
+        if torch.distributed.get_rank() == 0:
+            state_dict_ref = ray.put(state_dict)
+            peft_config = model.peft_config[adapter_name].to_dict()
+            ray.get([engine.update_lora.remote(state_dict_ref, peft_config) for engine in self.vllm_engines])
+
+    def _broadcast_params_to_vllm(self):
+        model = self.actor.model.module
+        zero_stage_3 = self.strategy.args.zero_stage == 3
+        params = list(model.named_parameters())
+        params_meta = [
+            (name, param.dtype, param.ds_shape if zero_stage_3 else param.shape) for name, param in params
+        ]
+        bucket_size = getattr(self.strategy.args, "vllm_sync_bucket_size_mb", 256) * 1024 * 1024
+        buckets = plan_weight_buckets(params_meta, bucket_size)
+
+        # broadcast
+        if not self.use_cuda_ipc:
+            use_ray = getattr(self.strategy.args, "vllm_sync_with_ray", False)
+            # the broadcast of a bucket overlaps with the gather of the next one, so at most two are alive
+            in_flight = None
+            for count, bucket in enumerate(buckets, 1):
+                names = [params_meta[i][0] for i in bucket]
+                shapes = [params_meta[i][2] for i in bucket]
+                bucket_params = [params[i][1] for i in bucket]
+
+                # For ZeRO-3, allgather the sharded parameters of the bucket, rank 0 broadcasts them to all engines
+                with deepspeed.zero.GatheredParameters(bucket_params, enabled=zero_stage_3):
+                    if torch.distributed.get_rank() == 0:
+                        flat = pack_weight_bucket([param.data for param in bucket_params])
+
                 if torch.distributed.get_rank() == 0:
-                    shape = param.shape if self.strategy.args.zero_stage != 3 else param.ds_shape
+                    # Fire all vllm engines for broadcast
                     refs = [
-                        engine.update_weight.remote(
-                            name, dtype=param.dtype, shape=shape, empty_cache=count == num_params
+                        engine.update_weight_bucket.remote(
+                            names, dtype=params_meta[bucket[0]][1], shapes=shapes, empty_cache=count == len(buckets)
                         )
                         for engine in self.vllm_engines
                     ]
+                    if use_ray:
+                        import ray.util.collective as collective
+
+                        collective.broadcast(flat, 0, group_name=self._model_update_group)
+                        handle = None
+                    else:
+                        handle = torch.distributed.broadcast(flat, 0, group=self._model_update_group, async_op=True)
+                    if in_flight is not None:
+                        self._wait_bucket_broadcast(*in_flight)
+                    # keep flat referenced until its broadcast is done
+                    in_flight = (handle, refs, flat)
+            if in_flight is not None:
+                self._wait_bucket_broadcast(*in_flight)
+        # CUDA IPC
+        else:
+            from torch.multiprocessing.reductions import reduce_tensor
 
-                # For ZeRO-3, allgather sharded parameter and broadcast to all vllm engines by rank 0
-                with deepspeed.zero.GatheredParameters([param], enabled=self.strategy.args.zero_stage == 3):
-                    if torch.distributed.get_rank() == 0:
-                        if use_ray:
-                            import ray.util.collective as collective
-
-                            collective.broadcast(param.data, 0, group_name=self._model_update_group)
-                        else:
-                            torch.distributed.broadcast(param.data, 0, group=self._model_update_group)
-                        ray.get(refs)
-            # CUDA IPC
-            else:
-                from torch.multiprocessing.reductions import reduce_tensor
+            for count, bucket in enumerate(buckets, 1):
+                bucket_params = [params[i][1] for i in bucket]
+                # For ZeRO-3, allgather sharded parameters of the bucket and share them with the colocated vllm engines
+                with deepspeed.zero.GatheredParameters(bucket_params, enabled=zero_stage_3):
+                    flat = pack_weight_bucket([param.data for param in bucket_params])
 
-                # For ZeRO-3, allgather sharded parameter and broadcast to all vllm engines by rank 0
-                with deepspeed.zero.GatheredParameters([param], enabled=self.strategy.args.zero_stage == 3):
-                    weight = param.data.clone()
-                    ipc_handle = reduce_tensor(weight)
+                ipc_handle = {get_physical_gpu_id(): reduce_tensor(flat)}
+                ipc_handle_list = [None] * torch.distributed.get_world_size()
+                torch.distributed.all_gather_object(ipc_handle_list, ipc_handle)
 
-                    ipc_handle = {get_physical_gpu_id(): ipc_handle}
-                    ipc_handle_list = [None] * torch.distributed.get_world_size()
-                    torch.distributed.all_gather_object(ipc_handle_list, ipc_handle)
+                if torch.distributed.get_rank() == 0:
+                    ipc_handles = {}
+                    for d in ipc_handle_list:
+                        ipc_handles.update(d)
 
-                    if torch.distributed.get_rank() == 0:
-                        ipc_handles = {}
-                        for d in ipc_handle_list:
-                            ipc_handles.update(d)
-
-                        shape = param.shape if self.strategy.args.zero_stage != 3 else param.ds_shape
-                        refs = [
-                            engine.update_weight_cuda_ipc.remote(
-                                name,
-                                dtype=param.dtype,
-                                shape=shape,
-                                ipc_handles=ipc_handles,
-                                empty_cache=count == num_params,
-                            )
-                            for engine in self.vllm_engines
-                        ]
-                        ray.get(refs)
-                    torch.distributed.barrier()
-                    torch.cuda.synchronize()
+                    refs = [
+                        engine.update_weight_bucket_cuda_ipc.remote(
+                            [params_meta[i][0] for i in bucket],
+                            dtype=params_meta[bucket[0]][1],
+                            shapes=[params_meta[i][2] for i in bucket],
+                            ipc_handles=ipc_handles,
+                            empty_cache=count == len(buckets),
+                        )
+                        for engine in self.vllm_engines
+                    ]
+                    ray.get(refs)
+                torch.distributed.barrier()
+                torch.cuda.synchronize()
+                del flat
 
-        if cache_reset_refs:
-            ray.get(cache_reset_refs)
-        torch.cuda.empty_cache()
-        torch.distributed.barrier()
+    @staticmethod
+    def _wait_bucket_broadcast(handle, refs, flat):
+        if handle is not None:
+            handle.wait()
+        ray.get(refs)
 
     def _save_checkpoint(self, args, tag, client_states):
         # call remote critic
@@ -291,6 +372,7 @@ class ActorModelRayActor(BasePPORole):
             lora_dropout=strategy.args.lora_dropout,
             ds_config=strategy.get_ds_train_config(is_actor=True),
             packing_samples=strategy.args.packing_samples,
+            logprobs_chunk_size=getattr(strategy.args, "logprobs_chunk_size", 0),
         )
         strategy.print(actor)
         # Support freeze some parameter
@@ -395,7 +477,11 @@ class ActorModelRayActor(BasePPORole):
             prompts_data, self.tokenizer, strategy, input_template=args.input_template
         )
         self.prompts_dataloader = strategy.setup_dataloader(
-            self.prompts_dataset, args.rollout_batch_size // strategy.world_size, True, True
+            self.prompts_dataset,
+            args.rollout_batch_size // strategy.world_size,
+            True,
+            True,
+            collate_fn=self.prompts_dataset.collate_fn,
         )
 
         if args.pretrain_data:
@@ -4,57 +4,47 @@ from typing import Dict, Optional, Union
 
 import ray
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers.trainer import get_scheduler
 
 from openrlhf.models import get_llm_for_sequence_regression
 from openrlhf.trainer import PPOTrainer
-from openrlhf.trainer.ppo_utils import Experience
+from openrlhf.trainer.ppo_utils import Experience, MetricsAccumulator, WireBatch
+from openrlhf.trainer.ppo_utils.wire import decode_model_inputs
 from openrlhf.utils import get_tokenizer, get_vl_processor
 from openrlhf.utils.deepspeed import DeepspeedStrategy
+from openrlhf.utils.tracer import trace_span, traced
 
 from .launcher import BasePPORole
 
 
 class CriticPPOTrainer(PPOTrainer):
     def ppo_train(self):
-        # replay buffer may be empty at first, we should rebuild at each training
-        dataloader = DataLoader(
-            self.replay_buffer,
-            batch_size=self.replay_buffer.sample_batch_size,
-            shuffle=True,
-            drop_last=True,
-            pin_memory=self.dataloader_pin_memory,
-            collate_fn=self.replay_buffer.collate_fn,
-        )
+        dataloader, sampler = self.setup_replay_dataloader()
         device = torch.cuda.current_device()
 
-        status_list = []
+        metrics = MetricsAccumulator(self.strategy)
         status_mean = {}
         for epoch in range(self.max_epochs):
+            sampler.set_epoch(self.replay_epochs)
+            self.replay_epochs += 1
             pbar = tqdm(
                 dataloader,
                 desc=f"Train epoch [{epoch + 1}/{self.max_epochs}]",
                 disable=not self.strategy.is_rank_0(),
             )
             for experience in pbar:
-                experience.to_device(device)
-                status = self.training_step(experience)
-
-                # for DP
-                status = self.strategy.all_reduce(status)
-
-                status_list.append(status)
-                pbar.set_postfix(status)
-
-        if status_list:
-            status_mean = status_list[0]
-            for m in status_list[1:]:
-                for k, v in m.items():
-                    status_mean[k] += v
-            for k in status_mean.keys():
-                status_mean[k] /= len(status_list)
+                with trace_span("training_step", epoch=epoch):
+                    # no-op when the batch was prefetched
+                    experience.to_device(device)
+                    status = self.training_step(experience)
+                metrics.update(status)
+
+            # reduced for DP once at the end, the progress bar shows the local means of the epoch
+            pbar.set_postfix(metrics.local())
+
+        if metrics.ops:
+            status_mean = metrics.reduce()
         return status_mean
 
     def training_step(self, experience: Experience) -> Dict[str, float]:
@@ -152,6 +142,7 @@ class CriticModelRayActor(BasePPORole):
             eps_clip=args.eps_clip,
         )
 
+    @traced()
     def forward(
         self,
         sequences: torch.LongTensor,
@@ -161,6 +152,7 @@ class CriticModelRayActor(BasePPORole):
         visual_inputs=None,
     ) -> torch.Tensor:
         """Generates critic values."""
+        sequences, attention_mask, visual_inputs = decode_model_inputs(sequences, attention_mask, visual_inputs)
         device = torch.cuda.current_device()
         self.critic.eval()
         if visual_inputs is None:
@@ -173,10 +165,14 @@ class CriticModelRayActor(BasePPORole):
         self.critic.train()  # reset model state
         return value.to("cpu")
 
+    @traced()
     def append(self, experience):
         """Append experience to replay buffer."""
+        if isinstance(experience, WireBatch):
+            experience = Experience.from_wire(experience)
         self.trainer.replay_buffer.append(experience)
 
+    @traced()
     def fit(self):
         """Train critic model with the replay buffer."""
         torch.cuda.empty_cache()
@@ -206,6 +202,7 @@ class CriticModelRayActor(BasePPORole):
                 args.save_path + "_critic",
             )
 
+    @traced()
     def save_checkpoint(self, tag):
         args = self.strategy.args
         self.strategy.save_ckpt(
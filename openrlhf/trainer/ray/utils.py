@@ -1,3 +1,4 @@
+import math
 import os
 
 
@@ -28,3 +29,49 @@ def get_physical_gpu_id():
     device = torch.cuda.current_device()
     props = torch.cuda.get_device_properties(device)
     return str(props.uuid)
+
+
+def plan_weight_buckets(params_meta, bucket_size):
+    """
+    Group consecutive parameters into buckets of at most bucket_size bytes for weight sync.
+
+    Args:
+        params_meta: list of (name, dtype, shape) in model order.
+        bucket_size: max bytes of a bucket. A larger parameter gets a bucket of its own.
+
+    Returns:
+        list of buckets, each a list of indices into params_meta. All parameters of a bucket share one dtype,
+        so that a bucket can be sent as a single flat tensor.
+    """
+    buckets = []
+    bucket, bucket_bytes, bucket_dtype = [], 0, None
+    for i, (_, dtype, shape) in enumerate(params_meta):
+        nbytes = math.prod(shape) * dtype.itemsize
+        if bucket and (dtype != bucket_dtype or bucket_bytes + nbytes > bucket_size):
+            buckets.append(bucket)
+            bucket, bucket_bytes = [], 0
+        bucket.append(i)
+        bucket_bytes += nbytes
+        bucket_dtype = dtype
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def pack_weight_bucket(tensors):
+    """Flatten tensors of one dtype into a single contiguous tensor."""
+    import torch
+
+    return torch.cat([t.reshape(-1) for t in tensors])
+
+
+def unpack_weight_bucket(flat, names, shapes):
+    """Inverse of pack_weight_bucket: returns [(name, tensor)] as views into flat."""
+    weights = []
+    offset = 0
+    for name, shape in zip(names, shapes):
+        numel = math.prod(shape)
+        weights.append((name, flat[offset : offset + numel].view(shape)))
+        offset += numel
+    assert offset == flat.numel(), f"bucket size mismatch: {offset} != {flat.numel()}"
+    return weights
@@ -1,4 +1,8 @@
+import asyncio
+import json
 import os
+import shutil
+import tempfile
 
 import numpy as np
 import ray
@@ -7,6 +11,7 @@ from ray.util.scheduling_strategies import PlacementGroupSchedulingStrategy
 from vllm import LLM
 
 from openrlhf.utils.logging_utils import init_logger
+from openrlhf.utils.tracer import get_tracer, init_tracer, trace_span, traced
 
 logger = init_logger(__name__)
 
@@ -18,21 +23,46 @@ def get_all_env_variables():
     return os.environ
 
 
+def _setup_vllm_env(bundle_indices, kwargs):
+    if kwargs.get("distributed_executor_backend") == "ray":
+        # a hack to make the script work.
+        # stop ray from manipulating CUDA_VISIBLE_DEVICES
+        # at the top-level when the distributed_executor_backend is ray.
+        os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+    # every worker will use 0.2 GPU, so that we can schedule
+    # 2 instances on the same GPUs.
+    if bundle_indices is not None:
+        os.environ["VLLM_RAY_PER_WORKER_GPUS"] = "0.2"
+        os.environ["VLLM_RAY_BUNDLE_INDICES"] = ",".join(map(str, bundle_indices))
+        print(f"creating LLM with bundle_indices={bundle_indices}")
+
+
+def _init_engine_tracer(engine_cls, kwargs):
+    engine_index, trace = kwargs.pop("engine_index", 0), kwargs.pop("trace", False)
+    init_tracer(engine_cls.__name__, engine_index, enabled=trace)
+
+
+def _new_lora_request(lora_dir, old_request, state_dict, peft_config):
+    """Save a new version of the LoRA adapter in peft format and return the request that loads it."""
+    from safetensors.torch import save_file
+    from vllm.lora.request import LoRARequest
+
+    # a new id makes vLLM load the adapter again instead of reusing the cached previous version
+    lora_id = old_request.lora_int_id + 1 if old_request is not None else 1
+    path = os.path.join(lora_dir, str(lora_id))
+    os.makedirs(path, exist_ok=True)
+    save_file(state_dict, os.path.join(path, "adapter_model.safetensors"))
+    with open(os.path.join(path, "adapter_config.json"), "w") as f:
+        json.dump(peft_config, f, default=list)
+    return LoRARequest(f"actor_lora_{lora_id}", lora_id, path)
+
+
 @ray.remote
 class LLMRayActor:
 
     def __init__(self, *args, bundle_indices: list = None, **kwargs):
-        if kwargs.get("distributed_executor_backend") == "ray":
-            # a hack to make the script work.
-            # stop ray from manipulating CUDA_VISIBLE_DEVICES
-            # at the top-level when the distributed_executor_backend is ray.
-            os.environ.pop("CUDA_VISIBLE_DEVICES", None)
-        # every worker will use 0.2 GPU, so that we can schedule
-        # 2 instances on the same GPUs.
-        if bundle_indices is not None:
-            os.environ["VLLM_RAY_PER_WORKER_GPUS"] = "0.2"
-            os.environ["VLLM_RAY_BUNDLE_INDICES"] = ",".join(map(str, bundle_indices))
-            print(f"creating LLM with bundle_indices={bundle_indices}")
+        _setup_vllm_env(bundle_indices, kwargs)
+        _init_engine_tracer(type(self), kwargs)
 
         # Number of actors that will send prompt to this engine
         self.num_actors = kwargs.pop("num_actors")
@@ -40,6 +70,10 @@ class LLMRayActor:
         self.requests = {}
         self.responses = {}
 
+        # LoRA adapter pushed by update_lora, None until the first sync
+        self.lora_request = None
+        self.lora_dir = tempfile.mkdtemp(prefix="openrlhf_lora_")
+
         self.llm = LLM(*args, **kwargs)
 
     def init_process_group(self, master_address, master_port, rank_offset, world_size, group_name, backend, use_ray):
@@ -54,12 +88,41 @@ class LLMRayActor:
     def update_weight_cuda_ipc(self, name, dtype, shape, ipc_handles, empty_cache=False):
         return self.llm.collective_rpc("update_weight_cuda_ipc", args=(name, dtype, shape, ipc_handles, empty_cache))
 
+    @traced()
+    def update_weight_bucket(self, names, dtype, shapes, empty_cache=False):
+        return self.llm.collective_rpc("update_weight_bucket", args=(names, dtype, shapes, empty_cache))
+
+    @traced()
+    def update_weight_bucket_cuda_ipc(self, names, dtype, shapes, ipc_handles, empty_cache=False):
+        return self.llm.collective_rpc(
+            "update_weight_bucket_cuda_ipc", args=(names, dtype, shapes, ipc_handles, empty_cache)
+        )
+
+    @traced()
+    def update_lora(self, state_dict, peft_config):
+        """
+        Generate with a new version of the actor's LoRA adapter from the next request on
+        """
+        old_request = self.lora_request
+        self.lora_request = _new_lora_request(self.lora_dir, old_request, state_dict, peft_config)
+        if old_request is not None:
+            self.llm.llm_engine.remove_lora(old_request.lora_int_id)
+            shutil.rmtree(old_request.lora_path, ignore_errors=True)
+
+    @traced()
     def reset_prefix_cache(self):
         self.llm.llm_engine.reset_prefix_cache()
 
+    def get_prefix_cache_hit_rate(self):
+        from vllm.utils import Device
+
+        return self.llm.llm_engine.scheduler[0].get_prefix_cache_hit_rate(Device.GPU)
+
+    @traced()
     def sleep(self, level=1):
         self.llm.sleep(level=level)
 
+    @traced()
     def wake_up(self):
         self.llm.wake_up()
 
@@ -79,7 +142,10 @@ class LLMRayActor:
 
             if len(requests) > 0:
                 # For now we assume that all requests have the same sampling params
-                responses = self.llm.generate(sampling_params=sampling_params, prompt_token_ids=requests)
+                with trace_span("generate", num_requests=len(requests)):
+                    responses = self.llm.generate(
+                        sampling_params=sampling_params, prompt_token_ids=requests, lora_request=self.lora_request
+                    )
             else:
                 responses = []
 
@@ -108,7 +174,10 @@ class LLMRayActor:
 
             if len(requests) > 0:
                 # For now we assume that all requests have the same sampling params
-                responses = self.llm.generate(vllm_vision_input, sampling_params=sampling_params)
+                with trace_span("generate", num_requests=len(requests)):
+                    responses = self.llm.generate(
+                        requests, sampling_params=sampling_params, lora_request=self.lora_request
+                    )
             else:
                 responses = []
 
@@ -127,6 +196,142 @@ class LLMRayActor:
         """
         return self.responses.pop(actor_rank)
 
+    def get_trace_events(self):
+        return get_tracer().collect()
+
+
+@ray.remote
+class LLMRayActorAsync:
+    """
+    Streaming counterpart of LLMRayActor backed by vLLM's AsyncLLMEngine.
+
+    Actors submit their prompts independently, every prompt is scheduled as soon as it arrives,
+    and finished outputs are pulled with `pull_responses` in completion order, so callers can start
+    working on short responses while long ones are still decoding.
+    """
+
+    def __init__(self, *args, bundle_indices: list = None, **kwargs):
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        _setup_vllm_env(bundle_indices, kwargs)
+        _init_engine_tracer(type(self), kwargs)
+        # requests are not batched across actors, so the number of senders is irrelevant
+        kwargs.pop("num_actors")
+        self.request_counter = 0
+        self.queues = {}
+        self.tasks = set()
+        self.lora_request = None
+        self.lora_dir = tempfile.mkdtemp(prefix="openrlhf_lora_")
+
+        self.llm = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(*args, **kwargs))
+
+    def init_process_group(self, master_address, master_port, rank_offset, world_size, group_name, backend, use_ray):
+        return self.llm.engine.collective_rpc(
+            "init_process_group",
+            args=(master_address, master_port, rank_offset, world_size, group_name, backend, use_ray),
+        )
+
+    def update_weight(self, name, dtype, shape, empty_cache=False):
+        return self.llm.engine.collective_rpc("update_weight", args=(name, dtype, shape, empty_cache))
+
+    def update_weight_cuda_ipc(self, name, dtype, shape, ipc_handles, empty_cache=False):
+        return self.llm.engine.collective_rpc(
+            "update_weight_cuda_ipc", args=(name, dtype, shape, ipc_handles, empty_cache)
+        )
+
+    @traced()
+    def update_weight_bucket(self, names, dtype, shapes, empty_cache=False):
+        return self.llm.engine.collective_rpc("update_weight_bucket", args=(names, dtype, shapes, empty_cache))
+
+    @traced()
+    def update_weight_bucket_cuda_ipc(self, names, dtype, shapes, ipc_handles, empty_cache=False):
+        return self.llm.engine.collective_rpc(
+            "update_weight_bucket_cuda_ipc", args=(names, dtype, shapes, ipc_handles, empty_cache)
+        )
+
+    @traced()
+    def update_lora(self, state_dict, peft_config):
+        """
+        Generate with a new version of the actor's LoRA adapter from the next request on
+        """
+        old_request = self.lora_request
+        self.lora_request = _new_lora_request(self.lora_dir, old_request, state_dict, peft_config)
+        if old_request is not None:
+            self.llm.engine.remove_lora(old_request.lora_int_id)
+            shutil.rmtree(old_request.lora_path, ignore_errors=True)
+
+    @traced()
+    def reset_prefix_cache(self):
+        self.llm.engine.reset_prefix_cache()
+
+    def get_prefix_cache_hit_rate(self):
+        from vllm.utils import Device
+
+        return self.llm.engine.scheduler[0].get_prefix_cache_hit_rate(Device.GPU)
+
+    @traced()
+    def sleep(self, level=1):
+        self.llm.engine.sleep(level=level)
+
+    @traced()
+    def wake_up(self):
+        self.llm.engine.wake_up()
+
+    async def add_requests(self, actor_rank, *, sampling_params, prompt_token_ids):
+        """
+        Start generating the requests of an actor, without waiting for the other actors
+        """
+        self._submit(actor_rank, sampling_params, [{"prompt_token_ids": ids} for ids in prompt_token_ids])
+
+    async def add_requests_vlm(self, actor_rank, *, sampling_params, vllm_vision_input):
+        """
+        Start generating the requests of an actor, without waiting for the other actors
+        """
+        self._submit(actor_rank, sampling_params, vllm_vision_input)
+
+    async def pull_responses(self, actor_rank, min_num=1):
+        """
+        Wait until at least min_num requests of the actor have finished, then return every finished
+        (index, output) pair in completion order. index is the position of the request in its add_requests call.
+        """
+        queue = self.queues.setdefault(actor_rank, asyncio.Queue())
+        responses = [await queue.get() for _ in range(min_num)]
+        while not queue.empty():
+            responses.append(queue.get_nowait())
+        for _, output in responses:
+            if isinstance(output, BaseException):
+                raise output
+        return responses
+
+    def _submit(self, actor_rank, sampling_params, prompts):
+        queue = self.queues.setdefault(actor_rank, asyncio.Queue())
+        for index, prompt in enumerate(prompts):
+            request_id = f"{actor_rank}-{self.request_counter}"
+            self.request_counter += 1
+            # keep a reference so the task is not garbage collected before it finishes
+            task = asyncio.create_task(self._generate(queue, index, prompt, sampling_params, request_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _generate(self, queue, index, prompt, sampling_params, request_id):
+        # requests run concurrently, so their spans overlap on the engine's trace thread
+        with trace_span("generate_request", request_id=request_id):
+            try:
+                async for output in self.llm.generate(
+                    prompt, sampling_params, request_id, lora_request=self.lora_request
+                ):
+                    pass
+            except Exception as e:
+                output = e
+        queue.put_nowait((index, output))
+
+    def get_trace_events(self):
+        return get_tracer().collect()
+
+
+# max_lora_rank values accepted by vLLM
+VLLM_LORA_RANKS = (8, 16, 32, 64, 128, 256)
+
 
 def create_vllm_engines(
     num_engines: int,
@@ -140,11 +345,23 @@ def create_vllm_engines(
     shared_pg=None,
     gpu_memory_utilization=None,
     vllm_enable_sleep=False,
+    async_engine=False,
+    lora_rank=0,
+    prefix_routing=False,
+    trace=False,
 ):
     import vllm
 
     assert vllm.__version__ >= "0.7.0", "OpenRLHF only supports vllm >= 0.7.0"
 
+    actor_cls = LLMRayActorAsync if async_engine else LLMRayActor
+    lora_kwargs = {}
+    if lora_rank > 0:
+        # LoRA actors sync only their adapter, which vLLM applies on top of the pretrained weights
+        max_lora_rank = next((r for r in VLLM_LORA_RANKS if r >= lora_rank), None)
+        if max_lora_rank is None:
+            raise ValueError(f"vLLM supports LoRA ranks up to {VLLM_LORA_RANKS[-1]}, got --lora_rank {lora_rank}")
+        lora_kwargs = dict(enable_lora=True, max_lora_rank=max_lora_rank, max_loras=1)
     vllm_engines = []
     num_gpus = int(tensor_parallel_size == 1)
     distributed_executor_backend = "uni" if tensor_parallel_size == 1 else "ray"
@@ -178,13 +395,16 @@ def create_vllm_engines(
                 placement_group=pg, placement_group_capture_child_tasks=True, placement_group_bundle_index=0
             )
 
-        if num_engines >= num_total_actors:
+        if prefix_routing:
+            # the router may send the prompts of any actor to any engine
+            num_actors = num_total_actors
+        elif num_engines >= num_total_actors:
             num_actors = 1
         else:
             num_actors = num_total_actors // num_engines + int(i < num_total_actors % num_engines)
 
         vllm_engines.append(
-            LLMRayActor.options(
+            actor_cls.options(
                 num_cpus=0,
                 num_gpus=num_gpus,
                 scheduling_strategy=scheduling_strategy,
@@ -203,6 +423,9 @@ def create_vllm_engines(
                 gpu_memory_utilization=gpu_memory_utilization,
                 bundle_indices=bundle_indices if shared_pg else None,
                 enable_sleep_mode=vllm_enable_sleep,
+                engine_index=i,
+                trace=trace,
+                **lora_kwargs,
             )
         )
 
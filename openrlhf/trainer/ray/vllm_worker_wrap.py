@@ -1,9 +1,11 @@
+import math
+
 import torch
 from vllm.worker.worker import Worker
 
 from openrlhf.utils.distributed_util import init_process_group
 from openrlhf.utils.logging_utils import init_logger
-from .utils import get_physical_gpu_id
+from .utils import get_physical_gpu_id, unpack_weight_bucket
 
 logger = init_logger(__name__)
 
@@ -73,3 +75,36 @@ class WorkerWrap(Worker):
         weight = func(*list_args)
         self.model_runner.model.load_weights(weights=[(name, weight)])
         torch.cuda.synchronize()
+
+    def update_weight_bucket(self, names, dtype, shapes, empty_cache=False):
+        """Broadcast a flat bucket of weights from source rank 0 (actor model) and load all of them at once"""
+        assert dtype == self.model_config.dtype, f"mismatch dtype: src {dtype}, dst {self.model_config.dtype}"
+        flat = torch.empty(sum(math.prod(shape) for shape in shapes), dtype=dtype, device="cuda")
+        if self._model_update_with_ray:
+            import ray.util.collective as collective
+
+            collective.broadcast(flat, 0, group_name=self._model_update_group)
+        else:
+            torch.distributed.broadcast(flat, 0, group=self._model_update_group)
+
+        self.model_runner.model.load_weights(weights=unpack_weight_bucket(flat, names, shapes))
+        del flat
+        if empty_cache:
+            # return the bucket buffers to the device once the last bucket is loaded
+            torch.cuda.empty_cache()
+
+    def update_weight_bucket_cuda_ipc(self, names, dtype, shapes, ipc_handles=None, empty_cache=False):
+        assert dtype == self.model_config.dtype, f"mismatch dtype: src {dtype}, dst {self.model_config.dtype}"
+
+        handle = ipc_handles[get_physical_gpu_id()]
+        func, args = handle
+        list_args = list(args)
+        # the key is to change device id to the current device id
+        # in case two processes have different CUDA_VISIBLE_DEVICES
+        list_args[6] = self.device.index
+        flat = func(*list_args)
+        self.model_runner.model.load_weights(weights=unpack_weight_bucket(flat, names, shapes))
+        torch.cuda.synchronize()
+        del flat
+        if empty_cache:
+            torch.cuda.empty_cache()
@@ -1,9 +1,16 @@
+import asyncio
+import random
+import threading
 import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
 import ray
 import requests
 import torch
 
 from openrlhf.utils.logging_utils import init_logger
+from openrlhf.utils.tracer import trace_span
 
 logger = init_logger(__name__)
 
@@ -45,6 +52,201 @@ def remote_rm_fn_ray(api_url, queries, prompts, score_key="rewards"):
     return remote_rm_fn(api_url, queries, prompts, score_key)
 
 
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+
+
+class RemoteRewardClient:
+    """Asynchronous client for remote reward model APIs.
+
+    Requests are issued from a background event loop over a pooled aiohttp session, so `submit`
+    returns immediately and reward scoring overlaps with the rest of experience making.
+
+    Args:
+        urls (List[str]): Reward API endpoints, every submission is scored by each of them.
+        batch_size (int, optional): Coalesce submissions until this many queries are pending for a URL.
+            A number <= 0 sends every submission as its own request. Defaults to 0.
+        batch_wait (float, optional): Max seconds a partial batch waits for more submissions. Defaults to 0.05.
+        max_concurrency (int, optional): Max in-flight requests (and pooled connections) per URL. Defaults to 8.
+        timeout (float, optional): Timeout of a single request in seconds. Defaults to 180.
+        max_retries (int, optional): Attempts per request before the futures fail. Defaults to 5.
+        backoff_base (float, optional): Base of the exponential backoff between retries. Defaults to 0.5.
+        backoff_max (float, optional): Upper bound of the backoff in seconds. Defaults to 30.
+        hedge_delay (float, optional): Send a duplicate request if the first one has not finished after
+            this many seconds and keep whichever returns first. None disables hedging. Defaults to None.
+        score_key (str, optional): Key of the scores in the response. Defaults to "rewards".
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        batch_size: int = 0,
+        batch_wait: float = 0.05,
+        max_concurrency: int = 8,
+        timeout: float = 180,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        hedge_delay: Optional[float] = None,
+        score_key: str = "rewards",
+    ) -> None:
+        self.urls = list(urls)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.score_key = score_key
+
+        self._pending = {url: [] for url in self.urls}
+        self._pending_size = {url: 0 for url in self.urls}
+        self._flush_handles = {url: None for url in self.urls}
+
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="remote-rm-client", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._init_session(), self._loop).result()
+
+    async def _init_session(self):
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self._semaphores = {url: asyncio.Semaphore(self.max_concurrency) for url in self.urls}
+
+    def submit(self, queries: List[str], prompts: List[str]) -> List[Future]:
+        """Schedule `queries` for scoring and return one future of a (len(queries),) tensor per URL."""
+        futures = []
+        for url in self.urls:
+            future = Future()
+            self._loop.call_soon_threadsafe(self._enqueue, url, queries, prompts, future)
+            futures.append(future)
+        return futures
+
+    def _enqueue(self, url, queries, prompts, future):
+        self._pending[url].append((queries, prompts, future))
+        self._pending_size[url] += len(queries)
+        if self._pending_size[url] >= self.batch_size:
+            self._flush(url)
+        elif self._flush_handles[url] is None:
+            self._flush_handles[url] = self._loop.call_later(self.batch_wait, self._flush, url)
+
+    def _flush(self, url):
+        if self._flush_handles[url] is not None:
+            self._flush_handles[url].cancel()
+            self._flush_handles[url] = None
+        items, self._pending[url], self._pending_size[url] = self._pending[url], [], 0
+        if items:
+            self._loop.create_task(self._send_batch(url, items))
+
+    async def _send_batch(self, url, items):
+        queries, prompts = [], []
+        for item_queries, item_prompts, _ in items:
+            queries.extend(item_queries)
+            prompts.extend(item_prompts)
+        try:
+            scores = await self._request_with_retries(url, {"query": queries, "prompts": prompts})
+            assert len(scores) == len(queries), f"expect {len(queries)} scores from {url}, got {len(scores)}"
+        except Exception as e:
+            for _, _, future in items:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for item_queries, _, future in items:
+            future.set_result(torch.tensor(scores[offset : offset + len(item_queries)]))
+            offset += len(item_queries)
+
+    async def _request_with_retries(self, url, data):
+        for attempt in range(self.max_retries):
+            try:
+                return await self._hedged_request(url, data)
+            except Exception as e:
+                logger.info(f"Request error for {url} (attempt {attempt + 1}/{self.max_retries}), please check: {e}")
+                with self._stats_lock:
+                    self._stats["errors"] += 1
+            if attempt + 1 < self.max_retries:
+                # exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt)))
+        raise Exception(f"Request error for {self.max_retries} times. Please check the API server {url}.")
+
+    async def _hedged_request(self, url, data):
+        if self.hedge_delay is None:
+            return await self._request(url, data)
+
+        primary = asyncio.ensure_future(self._request(url, data))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+        if done:
+            return primary.result()
+
+        with self._stats_lock:
+            self._stats["hedges"] += 1
+        pending = {primary, asyncio.ensure_future(self._request(url, data))}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def _request(self, url, data):
+        async with self._semaphores[url]:
+            start = time.perf_counter()
+            # runs on the client's event loop thread, the span lands on the trace of the calling actor
+            with trace_span("remote_rm_request", url=url, num_queries=len(data["query"])):
+                async with self._session.post(url, json=data) as response:
+                    response.raise_for_status()
+                    response = await response.json()
+            self._record_latency(time.perf_counter() - start)
+        assert self.score_key in response, f"{self.score_key} not in {response}"
+        return response.get(self.score_key)
+
+    def _record_latency(self, latency):
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._latencies.append(latency)
+
+    def _reset_stats(self):
+        self._stats = {"requests": 0, "errors": 0, "hedges": 0}
+        self._latencies = []
+
+    def get_stats(self, reset: bool = True) -> Dict[str, float]:
+        """Request counters and a latency histogram (counts of requests with latency <= bucket seconds)."""
+        with self._stats_lock:
+            stats = {f"remote_rm_{k}": v for k, v in self._stats.items()}
+            latencies = sorted(self._latencies)
+            if reset:
+                self._reset_stats()
+        if latencies:
+            for q in (50, 90, 99):
+                stats[f"remote_rm_latency_p{q}"] = latencies[min(len(latencies) - 1, len(latencies) * q // 100)]
+            stats["remote_rm_latency_max"] = latencies[-1]
+            count = 0
+            for bucket in LATENCY_BUCKETS:
+                while count < len(latencies) and latencies[count] <= bucket:
+                    count += 1
+                stats[f"remote_rm_latency_le_{bucket}s"] = count
+        return stats
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
 if __name__ == "__main__":
     # test utils
     url = "http:xxx/get_rm_score"
@@ -0,0 +1,161 @@
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time_ns()
+        self.tracer._record(self.name, self.start, end - self.start, self.args)
+        return False
+
+
+class SpanTracer:
+    """
+    Lightweight span tracer for the PPO loop, one per process.
+
+    Spans are recorded as Chrome trace "complete" events with wall clock timestamps, so that the spans
+    of the driver, the Ray actors and the vLLM engines line up once they are merged. Every span carries
+    the role and rank of its process and the training step it belongs to. When disabled, `span` returns
+    a shared no-op context manager and nothing is recorded.
+
+    Args:
+        role: Name of the process kind, e.g. the Ray actor class, one trace process per role.
+        rank: Rank of the process within its role, one trace thread per rank.
+        enabled: Whether spans are recorded.
+    """
+
+    def __init__(self, role: str = "trainer", rank: int = 0, enabled: bool = False):
+        self.configure(role, rank, enabled)
+
+    def configure(self, role: str, rank: int, enabled: bool):
+        self.role = role
+        self.rank = rank
+        self.enabled = enabled
+        self.step = None
+        self.events = []
+
+    def set_step(self, step: int):
+        self.step = step
+
+    def span(self, name: str, **args):
+        """Context manager timing the enclosed block as a span, args are attached to the trace event."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def traced(self, name: Optional[str] = None):
+        """Decorator recording every call of a function as a span."""
+
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Span(self, span_name, {}):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def collect(self, reset: bool = True) -> List[dict]:
+        """Recorded events, for the process that merges the trace of a step."""
+        events = self.events
+        if reset:
+            self.events = []
+        return events
+
+    def _record(self, name, start_ns, duration_ns, args):
+        # list.append is atomic, so spans may be recorded from background threads
+        self.events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start_ns / 1000,
+                "dur": duration_ns / 1000,
+                "pid": self.role,
+                "tid": self.rank,
+                "args": {"step": self.step, **args},
+            }
+        )
+
+
+_tracer = SpanTracer()
+
+
+def get_tracer() -> SpanTracer:
+    """The tracer of this process."""
+    return _tracer
+
+
+def init_tracer(role: str, rank: int, enabled: bool) -> SpanTracer:
+    _tracer.configure(role, rank, enabled)
+    return _tracer
+
+
+def trace_span(name: str, **args):
+    """Shortcut for get_tracer().span(name, **args)."""
+    return _tracer.span(name, **args)
+
+
+def traced(name: Optional[str] = None):
+    """Shortcut for get_tracer().traced(name), usable on methods of Ray actors."""
+    return _tracer.traced(name)
+
+
+def summarize_spans(events: List[dict]) -> Dict[str, float]:
+    """Time spent in every span per role, in seconds, averaged over the ranks of the role and its max rank."""
+    totals = defaultdict(lambda: defaultdict(float))
+    for event in events:
+        if event.get("ph") == "X":
+            totals[(event["pid"], event["name"])][event["tid"]] += event["dur"] / 1e6
+    stats = {}
+    for (role, name), per_rank in totals.items():
+        stats[f"{role}/{name}_time"] = sum(per_rank.values()) / len(per_rank)
+        stats[f"{role}/{name}_time_max"] = max(per_rank.values())
+    return stats
+
+
+def write_chrome_trace(events: List[dict], path: str, step: Optional[int] = None):
+    """
+    Write events as a Chrome trace JSON, viewable in Perfetto or chrome://tracing.
+
+    Roles become trace processes and ranks their threads. Events recorded without a step, e.g. by
+    remote actors that do not know the training step, are assigned to step.
+    """
+    pids = {}
+    trace_events = []
+    for event in events:
+        role = event["pid"]
+        if role not in pids:
+            pids[role] = len(pids)
+            trace_events.append({"name": "process_name", "ph": "M", "pid": pids[role], "args": {"name": role}})
+        if event["args"].get("step") is None:
+            event["args"]["step"] = step
+        trace_events.append({**event, "pid": pids[role], "args": {"rank": event["tid"], **event["args"]}})
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_path, path)
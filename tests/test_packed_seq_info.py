@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+utils = pytest.importorskip("openrlhf.models.utils")
+
+pytestmark = pytest.mark.unit
+
+
+def baseline_reset_position_ids(attention_mask):
+    position_ids = torch.zeros_like(attention_mask, dtype=torch.long)
+    for i in range(attention_mask.size(0)):
+        mask = attention_mask[i]
+        seq_num = mask.max().item()
+        for index in range(1, seq_num + 1):
+            sample_mask = mask == index
+            sample_length = sample_mask.sum().item()
+            position_ids[i, sample_mask] = torch.arange(sample_length, device=mask.device)
+    return position_ids
+
+
+def baseline_cu_seqlens(packed_seq_lens):
+    cu_seqlens = torch.cumsum(torch.tensor(packed_seq_lens, dtype=torch.int32), dim=-1, dtype=torch.int32)
+    return torch.nn.functional.pad(cu_seqlens, (1, 0), value=0)
+
+
+def baseline_action_log_probs(log_probs, num_actions, packed_seq_lens):
+    action_log_probs = []
+    offset = 0
+    for num_action, seq_len in zip(num_actions, packed_seq_lens):
+        start, end = max(0, offset + seq_len - num_action - 1), offset + seq_len - 1
+        action_log_probs.append(log_probs[:, start:end])
+        offset += seq_len
+    return torch.cat(action_log_probs, dim=1)
+
+
+def packed_attention_mask(packed_seq_lens, total_len):
+    mask = torch.cat([torch.full((n,), i + 1) for i, n in enumerate(packed_seq_lens)])
+    return torch.nn.functional.pad(mask, (0, total_len - mask.numel())).unsqueeze(0)
+
+
+CASES = [
+    # packed_seq_lens, num_actions, padding
+    ([5], [3], 0),
+    ([3, 2, 4, 1], [2, 1, 3, 1], 0),
+    ([3, 2, 4, 1], [2, 1, 3, 1], 6),
+    ([7, 1, 6], [7, 1, 2], 3),
+    ([4, 9, 2, 8], None, 0),
+    ([4, 9, 2, 8], None, 5),
+]
+
+
+@pytest.mark.parametrize("packed_seq_lens,num_actions,padding", CASES)
+def test_packed_seq_info_matches_baseline(packed_seq_lens, num_actions, padding):
+    total_len = sum(packed_seq_lens) + padding
+    info = utils.PackedSeqInfo.build(packed_seq_lens, num_actions, total_len=total_len)
+
+    assert info.cu_seqlens.dtype == torch.int32
+    assert torch.equal(info.cu_seqlens, baseline_cu_seqlens(packed_seq_lens))
+    expected_position_ids = baseline_reset_position_ids(packed_attention_mask(packed_seq_lens, total_len))
+    assert torch.equal(info.position_ids, expected_position_ids)
+
+    if num_actions is None:
+        assert info.action_indices is None
+    else:
+        log_probs = torch.randn(1, total_len - 1)
+        expected = baseline_action_log_probs(log_probs, num_actions, packed_seq_lens)
+        assert torch.equal(info.gather_actions(log_probs), expected)
+
+
+def test_packed_seq_info_accepts_tensor_lengths():
+    info = utils.PackedSeqInfo.build(torch.tensor([3, 2]), [1, 1])
+    assert info.packed_seq_lens == [3, 2]
+    assert torch.equal(info.eos_indices, torch.tensor([2, 4]))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_reset_position_ids_matches_baseline(seed):
+    generator = torch.Generator().manual_seed(seed)
+    rows = []
+    for _ in range(3):
+        lens = torch.randint(1, 8, (int(torch.randint(1, 6, (1,), generator=generator)),), generator=generator)
+        rows.append(packed_attention_mask(lens.tolist(), 40).squeeze(0))
+    attention_mask = torch.stack(rows)
+    assert torch.equal(utils.reset_position_ids(attention_mask), baseline_reset_position_ids(attention_mask))
+
+
+def test_reset_position_ids_single_sample_without_padding():
+    attention_mask = torch.ones(2, 6, dtype=torch.long)
+    assert torch.equal(utils.reset_position_ids(attention_mask), torch.arange(6).expand(2, 6))
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import torch
+
+pytest.importorskip("aiohttp")
+remote_rm_utils = pytest.importorskip("openrlhf.utils.remote_rm_utils")
+
+pytestmark = pytest.mark.unit
+
+
+class StubRewardServer:
+    """
+    Local reward API, the score of a query is its length. Behaviors by path:
+        /ok: answers at once.
+        /flaky: fails the first `failures` requests with a 500.
+        /slow_first: the first request sleeps `delay` seconds, the others answer at once.
+        /hang: every request sleeps `delay` seconds.
+    """
+
+    def __init__(self, failures=2, delay=2.0):
+        self.failures = failures
+        self.delay = delay
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server.lock:
+                    server.calls[self.path] += 1
+                    call = server.calls[self.path]
+                if self.path == "/flaky" and call <= server.failures:
+                    self.send_error(500)
+                    return
+                if (self.path == "/slow_first" and call == 1) or self.path == "/hang":
+                    time.sleep(server.delay)
+                body = json.dumps({"rewards": [float(len(q)) for q in data["query"]]}).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on this request
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = StubRewardServer()
+    yield server
+    server.close()
+
+
+def make_client(url, **kwargs):
+    kwargs = {"backoff_base": 0.01, "backoff_max": 0.05, **kwargs}
+    return remote_rm_utils.RemoteRewardClient([url], **kwargs)
+
+
+def test_scores_are_returned_in_order(server):
+    client = make_client(server.url("/ok"))
+    try:
+        (future,) = client.submit(["a", "bbb", "cc"], ["p"] * 3)
+        assert torch.equal(future.result(timeout=10), torch.tensor([1.0, 3.0, 2.0]))
+    finally:
+        client.close()
+
+
+def test_submissions_are_coalesced_into_one_request(server):
+    client = make_client(server.url("/ok"), batch_size=4, batch_wait=5)
+    try:
+        first = client.submit(["a", "bb"], ["p"] * 2)[0]
+        second = client.submit(["ccc", "dddd"], ["p"] * 2)[0]
+        assert torch.equal(first.result(timeout=10), torch.tensor([1.0, 2.0]))
+        assert torch.equal(second.result(timeout=10), torch.tensor([3.0, 4.0]))
+        assert server.calls["/ok"] == 1
+    finally:
+        client.close()
+
+
+def test_failed_requests_are_retried(server):
+    client = make_client(server.url("/flaky"), max_retries=3)
+    try:
+        (future,) = client.submit(["ab"], ["p"])
+        assert torch.equal(future.result(timeout=10), torch.tensor([2.0]))
+        assert server.calls["/flaky"] == 3
+        stats = client.get_stats()
+        assert stats["remote_rm_errors"] == 2
+        assert stats["remote_rm_requests"] == 1
+    finally:
+        client.close()
+
+
+def test_futures_fail_after_max_retries(server):
+    client = make_client(server.url("/flaky"), max_retries=2)
+    try:
+        (future,) = client.submit(["ab"], ["p"])
+        with pytest.raises(Exception, match="2 times"):
+            future.result(timeout=10)
+        assert server.calls["/flaky"] == 2
+    finally:
+        client.close()
+
+
+def test_slow_request_is_hedged(server):
+    client = make_client(server.url("/slow_first"), hedge_delay=0.1)
+    try:
+        start = time.perf_counter()
+        (future,) = client.submit(["abc"], ["p"])
+        assert torch.equal(future.result(timeout=10), torch.tensor([3.0]))
+        # answered by the hedge, well before the first request returns
+        assert time.perf_counter() - start < server.delay
+        assert server.calls["/slow_first"] == 2
+        assert client.get_stats()["remote_rm_hedges"] == 1
+    finally:
+        client.close()
+
+
+def test_requests_time_out(server):
+    server.delay = 1.0
+    client = make_client(server.url("/hang"), timeout=0.2, max_retries=2)
+    try:
+        start = time.perf_counter()
+        (future,) = client.submit(["abc"], ["p"])
+        with pytest.raises(Exception):
+            future.result(timeout=10)
+        assert time.perf_counter() - start < 2 * server.delay
+        assert client.get_stats()["remote_rm_errors"] == 2
+    finally:
+        client.close()
@@ -0,0 +1,103 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+replay_buffer = pytest.importorskip("openrlhf.trainer.ppo_utils.replay_buffer")
+Experience = replay_buffer.Experience
+
+pytestmark = pytest.mark.unit
+
+
+class LocalStrategy:
+    def all_reduce(self, data, op="mean"):
+        return data
+
+
+def make_padded_experience(prompt_lens, response_lens):
+    prompt_width, response_width = max(prompt_lens), max(response_lens)
+    prompt_lens, response_lens = torch.tensor(prompt_lens), torch.tensor(response_lens)
+    prompt_mask = torch.arange(prompt_width) >= prompt_width - prompt_lens.unsqueeze(1)
+    action_mask = torch.arange(response_width) < response_lens.unsqueeze(1)
+    attention_mask = torch.cat([prompt_mask, action_mask], dim=1).long()
+    fields = {key: torch.randn(len(prompt_lens), response_width) * action_mask for key in replay_buffer.ACTION_KEYS}
+    fields["action_mask"] = action_mask
+    return Experience(
+        sequences=torch.randint(1, 100, attention_mask.shape) * attention_mask,
+        attention_mask=attention_mask,
+        info={"reward": torch.randn(len(prompt_lens))},
+        **fields,
+    )
+
+
+def unpadded(experience, i):
+    """The sequence and action fields of sample i without padding."""
+    seq_mask, act_mask = experience.attention_mask[i].bool(), experience.action_mask[i]
+    fields = {key: getattr(experience, key)[i][seq_mask] for key in replay_buffer.SEQUENCE_KEYS}
+    fields.update({key: getattr(experience, key)[i][act_mask] for key in replay_buffer.ACTION_KEYS})
+    return fields
+
+
+def test_left_pad_segments_matches_per_sample_padding():
+    lens = torch.tensor([3, 1, 5, 2])
+    starts = torch.tensor([1, 4, 5, 10])
+    flat = torch.cat([torch.zeros(1), torch.arange(1.0, 12.0)])
+    padded = replay_buffer.left_pad_segments(flat, replay_buffer.left_pad_index(starts, starts + lens))
+    expected = torch.stack([F.pad(flat[s : s + n], (5 - n, 0)) for s, n in zip(starts.tolist(), lens.tolist())])
+    assert torch.equal(padded, expected)
+
+
+def test_collate_returns_left_padded_samples():
+    torch.manual_seed(0)
+    experiences = [make_padded_experience([2, 4, 1], [3, 1, 2]), make_padded_experience([3, 3], [4, 2])]
+    buffer = replay_buffer.NaiveReplayBuffer(2, cpu_offload=False)
+    for experience in experiences:
+        buffer.append(experience)
+    samples = [unpadded(experience, i) for experience in experiences for i in range(len(experience.sequences))]
+    assert len(buffer) == len(samples)
+    assert buffer.sequence_lengths().tolist() == [s["sequences"].numel() for s in samples]
+
+    batch = [4, 0, 2]
+    experience = buffer.collate_fn(batch)
+    for key in replay_buffer.SEQUENCE_KEYS + replay_buffer.ACTION_KEYS:
+        values = [samples[i][key] for i in batch]
+        max_len = max(v.numel() for v in values)
+        assert torch.equal(getattr(experience, key), torch.stack([F.pad(v, (max_len - v.numel(), 0)) for v in values]))
+
+
+@pytest.mark.parametrize("packing_samples", [False, True])
+def test_normalize_keeps_padding_zero(packing_samples):
+    torch.manual_seed(0)
+    experience = make_padded_experience([2, 4, 1], [3, 1, 2])
+    if packing_samples:
+        samples = [unpadded(experience, i) for i in range(3)]
+        fields = {key: [s[key] for s in samples] for key in ("sequences",) + replay_buffer.ACTION_KEYS}
+        fields.pop("action_mask")
+        experience = Experience(attention_mask=None, action_mask=None, info=experience.info, **fields)
+    buffer = replay_buffer.NaiveReplayBuffer(2, cpu_offload=False, packing_samples=packing_samples)
+    buffer.append(experience)
+    buffer.normalize("advantages", LocalStrategy())
+
+    advantages = buffer.collate_fn([0, 1, 2]).advantages
+    if packing_samples:
+        advantages = torch.cat(advantages)
+    else:
+        advantages = advantages[buffer.collate_fn([0, 1, 2]).action_mask]
+    assert advantages.mean().abs() < 1e-5
+    assert (advantages.std(unbiased=False) - 1).abs() < 1e-4
+    if not packing_samples:
+        # the padding of the shorter samples is still zero
+        assert torch.equal(buffer.collate_fn([1, 0]).advantages[0, :2], torch.zeros(2))
+
+
+def test_limit_keeps_the_latest_samples():
+    torch.manual_seed(0)
+    experiences = [make_padded_experience([2, 3], [1, 2]) for _ in range(3)]
+    buffer = replay_buffer.NaiveReplayBuffer(2, cpu_offload=False, limit=3)
+    for experience in experiences:
+        buffer.append(experience)
+    samples = [unpadded(experience, i) for experience in experiences for i in range(2)][-3:]
+    assert len(buffer) == 3
+    collated = buffer.collate_fn([0, 1, 2])
+    for i, sample in enumerate(samples):
+        n = sample["sequences"].numel()
+        assert torch.equal(collated.sequences[i, -n:], sample["sequences"])
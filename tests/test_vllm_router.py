@@ -0,0 +1,133 @@
+import pytest
+
+vllm_router = pytest.importorskip("openrlhf.trainer.ppo_utils.vllm_router")
+PrefixAffinityRouter = vllm_router.PrefixAffinityRouter
+
+pytestmark = pytest.mark.unit
+
+
+class StubEngine:
+    """Records the prompts it is sent and counts prefix cache hits."""
+
+    def __init__(self, prefix_len):
+        self.prefix_len = prefix_len
+        self.prefixes = set()
+        self.prompts = []
+        self.cache_hits = 0
+
+    def generate(self, prompts):
+        for prompt in prompts:
+            prefix = tuple(prompt[: self.prefix_len])
+            self.cache_hits += prefix in self.prefixes
+            self.prefixes.add(prefix)
+            self.prompts.append(prompt)
+
+
+def dispatch(router, engines, prompts, **kwargs):
+    assignments = router.route(prompts, [len(p) for p in prompts], **kwargs)
+    for engine, indices in zip(engines, assignments):
+        engine.generate([prompts[i] for i in indices])
+    return assignments
+
+
+def make_prompts(num_prefixes, per_prefix, prefix_len=4, suffix_len=4):
+    return [
+        [p] * prefix_len + [1000 + p * per_prefix + i] * suffix_len
+        for p in range(num_prefixes)
+        for i in range(per_prefix)
+    ]
+
+
+def test_engine_order_is_stable_across_instances():
+    first, second = PrefixAffinityRouter(8, prefix_len=4), PrefixAffinityRouter(8, prefix_len=4)
+    for prompt in make_prompts(16, 1) + ["some text prompt", "another one"]:
+        order = first.engine_order(prompt)
+        assert sorted(order) == list(range(8))
+        assert order == second.engine_order(prompt)
+
+    # only the prefix decides the order
+    assert first.engine_order([1, 2, 3, 4, 5]) == first.engine_order([1, 2, 3, 4, 6])
+
+
+def test_routing_is_identical_across_instances():
+    prompts = make_prompts(10, 3)
+    first, second = PrefixAffinityRouter(4, prefix_len=4), PrefixAffinityRouter(4, prefix_len=4)
+    assert first.route(prompts, [8] * len(prompts), decode_len=16) == second.route(
+        prompts, [8] * len(prompts), decode_len=16
+    )
+
+
+def test_prompts_sharing_a_prefix_hit_one_engine():
+    router = PrefixAffinityRouter(4, prefix_len=4, balance_slack=1.0)
+    engines = [StubEngine(4) for _ in range(4)]
+    prompts = make_prompts(8, 4)
+    assignments = dispatch(router, engines, prompts, decode_len=16)
+
+    assert sorted(i for indices in assignments for i in indices) == list(range(len(prompts)))
+    for indices in assignments:
+        assert indices == sorted(indices)
+    # with enough slack every prompt keeps its preferred engine, one cache miss per prefix
+    assert router.stats()["affinity_rate"] == 1.0
+    assert sum(engine.cache_hits for engine in engines) == len(prompts) - 8
+
+
+def test_full_engine_falls_back_within_capacity():
+    router = PrefixAffinityRouter(2, prefix_len=4, balance_slack=0.0)
+    prompts = make_prompts(1, 4)
+    preferred = router.engine_order(prompts[0])[0]
+    assignments = router.route(prompts, [8] * 4, decode_len=8)
+
+    # all prompts prefer the same engine, the capacity of (1 + 0) * average load moves half of them
+    assert assignments[preferred] == [0, 1]
+    assert assignments[1 - preferred] == [2, 3]
+    stats = router.stats()
+    assert stats["affinity_rate"] == 0.5
+    assert stats["load_imbalance"] == 1.0
+    assert stats[f"engine_{preferred}_requests"] == 2
+
+
+def test_prompt_over_capacity_goes_to_least_loaded_engine():
+    router = PrefixAffinityRouter(3, prefix_len=4, balance_slack=0.0)
+    prompts = make_prompts(3, 1)
+    # the first prompt alone exceeds the capacity of every engine
+    assignments = router.route(prompts, [100, 1, 1], decode_len=0)
+    big = next(e for e, indices in enumerate(assignments) if 0 in indices)
+    assert big == 0
+    assert all(0 not in indices for e, indices in enumerate(assignments) if e != big)
+    assert sum(len(indices) for indices in assignments) == 3
+
+
+def test_observe_updates_expected_decode_length():
+    router = PrefixAffinityRouter(2, prefix_len=4, decode_len_momentum=0.5)
+    short, long = [1] * 4, [2] * 4
+    router.observe([short, long], [10, 30])
+    assert router.decode_len == 20
+    assert router.prefix_decode_len[router.prefix_key(short)] == 10
+
+    router.observe([short], [20])
+    assert router.prefix_decode_len[router.prefix_key(short)] == 15
+    assert router.decode_len == 20
+
+    # known prefixes cost their own decode length, new ones the global mean
+    new = [3] * 4
+    router.route([short, long, new], [4, 4, 4], num_samples=2, decode_len=1000)
+    assert sum(router.loads) == 3 * 4 + 2 * (15 + 30 + 20)
+
+
+def test_observe_ignores_empty_rollouts():
+    router = PrefixAffinityRouter(2)
+    router.observe([], [])
+    assert router.decode_len is None
+    assert not router.prefix_decode_len
+
+
+def test_least_recently_seen_prefixes_are_evicted():
+    router = PrefixAffinityRouter(2, prefix_len=4, max_tracked_prefixes=2)
+    a, b, c = [1] * 4, [2] * 4, [3] * 4
+    router.observe([a, b], [10, 20])
+    # seeing a again makes b the least recently seen
+    router.observe([a], [10])
+    router.observe([c], [30])
+
+    assert list(router.prefix_decode_len) == [router.prefix_key(a), router.prefix_key(c)]
+    assert len(router.prefix_decode_len) == router.max_tracked_prefixes
@@ -0,0 +1,86 @@
+import pytest
+import torch
+
+# importing openrlhf.trainer.ray pulls in ray, deepspeed and the trainers
+weight_buckets = pytest.importorskip("openrlhf.trainer.ray.utils")
+pack_weight_bucket = weight_buckets.pack_weight_bucket
+plan_weight_buckets = weight_buckets.plan_weight_buckets
+unpack_weight_bucket = weight_buckets.unpack_weight_bucket
+
+pytestmark = pytest.mark.unit
+
+
+def make_params():
+    generator = torch.Generator().manual_seed(0)
+    shapes_dtypes = [
+        ("embed", (16, 8), torch.float32),
+        ("norm", (8,), torch.float32),
+        ("q_proj", (8, 8), torch.bfloat16),
+        ("k_proj", (8, 8), torch.bfloat16),
+        ("huge", (64, 64), torch.bfloat16),
+        ("bias", (8,), torch.bfloat16),
+        ("scale", (), torch.float32),
+        ("lm_head", (16, 8), torch.float16),
+    ]
+    return [(name, torch.randn(shape, generator=generator).to(dtype)) for name, shape, dtype in shapes_dtypes]
+
+
+def round_trip(params, bucket_size):
+    meta = [(name, t.dtype, tuple(t.shape)) for name, t in params]
+    buckets = plan_weight_buckets(meta, bucket_size)
+    received = []
+    for bucket in buckets:
+        flat = pack_weight_bucket([params[i][1] for i in bucket])
+        received += unpack_weight_bucket(flat, [meta[i][0] for i in bucket], [meta[i][2] for i in bucket])
+    return buckets, received
+
+
+@pytest.mark.parametrize("bucket_size", [1, 256, 1024, 2**20])
+def test_round_trip_mixed_dtypes(bucket_size):
+    params = make_params()
+    buckets, received = round_trip(params, bucket_size)
+
+    # every parameter exactly once, in model order
+    assert [i for bucket in buckets for i in bucket] == list(range(len(params)))
+    assert [name for name, _ in received] == [name for name, _ in params]
+    for (_, sent), (_, got) in zip(params, received):
+        assert got.dtype == sent.dtype and got.shape == sent.shape
+        assert torch.equal(got, sent)
+
+    for bucket in buckets:
+        assert len({params[i][1].dtype for i in bucket}) == 1
+        nbytes = sum(params[i][1].numel() * params[i][1].element_size() for i in bucket)
+        assert len(bucket) == 1 or nbytes <= bucket_size
+
+
+def test_tensor_bigger_than_bucket_gets_its_own_bucket():
+    params = make_params()
+    huge = [name for name, _ in params].index("huge")
+    buckets, _ = round_trip(params, 256)
+    assert [huge] in buckets
+
+
+def test_consecutive_parameters_share_a_bucket():
+    params = make_params()
+    buckets, _ = round_trip(params, 2**20)
+    # one bucket per run of equal dtypes
+    assert buckets == [[0, 1], [2, 3, 4, 5], [6], [7]]
+
+
+def test_unpacked_weights_are_views_of_the_bucket():
+    params = make_params()[:2]
+    flat = pack_weight_bucket([t for _, t in params])
+    weights = unpack_weight_bucket(flat, ["embed", "norm"], [(16, 8), (8,)])
+    flat.zero_()
+    assert all(not w.any() for _, w in weights)
+
+
+def test_empty_input():
+    assert plan_weight_buckets([], 1024) == []
+    assert unpack_weight_bucket(torch.empty(0), [], []) == []
+
+
+def test_size_mismatch_is_detected():
+    flat = pack_weight_bucket([torch.ones(4), torch.ones(2)])
+    with pytest.raises(AssertionError):
+        unpack_weight_bucket(flat, ["a"], [(4,)])